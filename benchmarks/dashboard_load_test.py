@@ -0,0 +1,469 @@
+"""
+Load test for the Dash dashboard on localhost.
+
+Starts dashboard_app on 127.0.0.1 (or attaches to one already running
+locally with --url), then N virtual analysts replay seeded sessions:
+page navigations (display_page) followed by the callbacks the browser
+would fire on that page — sales filters and zoom, cohort slices, table
+paging/sorting/filtering — as POSTs to /_dash-update-component.
+
+Reports throughput, p50/p95/p99 latency per callback and server RSS as
+JSON with a stable layout, so runs on different commits can be diffed
+(--compare previous.json).
+
+    python benchmarks/dashboard_load_test.py --users 50 --duration 60
+    DASHBOARD_SNAPSHOT=latest python benchmarks/dashboard_load_test.py --users 50
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+ANALYSIS_DIR = ROOT / "src" / "analysis"
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+LOCAL_HOSTS = ('127.0.0.1', 'localhost', '::1')
+DEFAULT_PORT = 8051
+STARTUP_TIMEOUT_SECONDS = 120
+MEMORY_SAMPLE_SECONDS = 0.5
+
+# Приложение без debug и reloader: один процесс, память которого и меряем
+SERVER_BOOTSTRAP = (
+    "import sys, dashboard_app; "
+    "dashboard_app.app.run(host='127.0.0.1', port=int(sys.argv[1]), debug=False, threaded=True)"
+)
+
+
+def rss_bytes(pid):
+    """Resident set size of a process (None where it cannot be read)."""
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except ImportError:
+        pass
+    except Exception:
+        return None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class MemorySampler:
+    """Background sampling of server RSS while the test runs."""
+
+    def __init__(self, pid, interval=MEMORY_SAMPLE_SECONDS):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            value = rss_bytes(self.pid)
+            if value is not None:
+                self.samples.append(value)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def summary(self):
+        if not self.samples:
+            return None
+        mb = np.array(self.samples) / 2 ** 20
+        return {'start_mb': round(float(mb[0]), 1), 'peak_mb': round(float(mb.max()), 1),
+                'end_mb': round(float(mb[-1]), 1), 'samples': len(mb)}
+
+
+def start_server(port):
+    process = subprocess.Popen(
+        [sys.executable, '-c', SERVER_BOOTSTRAP, str(port)],
+        cwd=ANALYSIS_DIR, env=os.environ.copy(),
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    deadline = time.time() + STARTUP_TIMEOUT_SECONDS
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Dashboard exited on startup:\n{process.stderr.read().decode(errors='replace')}")
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/_dash-layout')
+            if conn.getresponse().status == 200:
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"Dashboard did not start within {STARTUP_TIMEOUT_SECONDS}s")
+
+
+class DashClient:
+    """One keep-alive connection per virtual user."""
+
+    def __init__(self, host, port, timeout=60):
+        self.conn = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def request(self, method, path, body=None):
+        payload = json.dumps(body).encode() if body is not None else None
+        headers = {'Content-Type': 'application/json'} if payload else {}
+        try:
+            self.conn.request(method, path, body=payload, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            # Сервер закрыл соединение — переподключаемся один раз
+            self.conn.close()
+            self.conn.request(method, path, body=payload, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        # 204: колбэк вернул no_update
+        return response.status, (json.loads(data) if data and response.status == 200 else None)
+
+    def close(self):
+        self.conn.close()
+
+
+def find_components(node, predicate, found=None):
+    """Walk a serialized Dash layout and collect the props of matching components."""
+    found = [] if found is None else found
+    if isinstance(node, dict):
+        props = node.get('props')
+        if isinstance(props, dict) and predicate(props):
+            found.append(props)
+        for value in node.values():
+            find_components(value, predicate, found)
+    elif isinstance(node, list):
+        for value in node:
+            find_components(value, predicate, found)
+    return found
+
+
+def callback_outputs(client):
+    """'output' strings of the app's callbacks, keyed by callback name."""
+    _, dependencies = client.request('GET', '/_dash-dependencies')
+    markers = {
+        'display_page': 'page-content.children',
+        'update_sales_figures': 'sales-daily-revenue.figure',
+        'update_paged_table': '"paged-table"',
+        'update_cohort_slice': 'cohort-slice.children',
+    }
+    return {name: next(d['output'] for d in dependencies if marker in d['output'])
+            for name, marker in markers.items()}
+
+
+class Session:
+    """Seeded sequence of page visits and callbacks for one virtual analyst."""
+
+    def __init__(self, client, outputs, rng, stats):
+        self.client = client
+        self.outputs = outputs
+        self.rng = rng
+        self.stats = stats
+
+    def call(self, name, outputs, inputs, state=None, changed=None):
+        body = {
+            'output': self.outputs[name],
+            'outputs': outputs,
+            'inputs': inputs,
+            'state': state or [],
+            'changedPropIds': changed or [],
+        }
+        started = time.perf_counter()
+        try:
+            status, response = self.client.request('POST', '/_dash-update-component', body)
+        except (OSError, http.client.HTTPException):
+            status, response = None, None
+        self.stats.record(name, time.perf_counter() - started, status in (200, 204))
+        return response
+
+    def open_page(self, pathname):
+        response = self.call('display_page', {'id': 'page-content', 'property': 'children'},
+                             [{'id': 'url', 'property': 'pathname', 'value': pathname}],
+                             changed=['url.pathname'])
+        return response['response']['page-content']['children'] if response else None
+
+    def sales_figures(self, start, end, categories=None, states=None, relayout=None, changed='sales-date-range.start_date'):
+        outputs = [{'id': graph, 'property': 'figure'}
+                   for graph in ('sales-daily-revenue', 'sales-daily-orders', 'sales-top-categories')]
+        inputs = [
+            {'id': 'sales-date-range', 'property': 'start_date', 'value': start},
+            {'id': 'sales-date-range', 'property': 'end_date', 'value': end},
+            {'id': 'sales-category', 'property': 'value', 'value': categories},
+            {'id': 'sales-state', 'property': 'value', 'value': states},
+            {'id': 'sales-daily-revenue', 'property': 'relayoutData', 'value': relayout},
+            {'id': 'sales-daily-orders', 'property': 'relayoutData', 'value': None},
+        ]
+        self.call('update_sales_figures', outputs, inputs, changed=[changed])
+
+    def paged_table(self, table_id, page, sort_by, filter_query):
+        outputs = [{'id': table_id, 'property': 'data'}, {'id': table_id, 'property': 'page_count'}]
+        inputs = [
+            {'id': table_id, 'property': 'page_current', 'value': page},
+            {'id': table_id, 'property': 'page_size', 'value': 20},
+            {'id': table_id, 'property': 'sort_by', 'value': sort_by},
+            {'id': table_id, 'property': 'filter_query', 'value': filter_query},
+        ]
+        response = self.call('update_paged_table', outputs, inputs,
+                             state=[{'id': table_id, 'property': 'id', 'value': table_id}],
+                             changed=[json.dumps(table_id, separators=(',', ':'), sort_keys=True) + '.page_current'])
+        if not response:
+            return []
+        return next(iter(response['response'].values()), {}).get('data') or []
+
+    def filter_query(self, rows):
+        """DataTable filter_query (syntax of paged_tables.parse_filter_query) built from values of a shown row."""
+        row = self.rng.choice(rows)
+        parts = []
+        for column in self.rng.sample(sorted(row), min(len(row), self.rng.randint(1, 2))):
+            value = row[column]
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                parts.append(f"{{{column}}} {self.rng.choice(['>=', '<', '='])} {value}")
+            elif isinstance(value, str) and value and '&&' not in value:
+                parts.append(f'{{{column}}} contains "{value[:self.rng.randint(1, 4)]}"')
+        return ' && '.join(parts)
+
+    def visit_sales(self):
+        page = self.open_page('/')
+        picker = find_components(page, lambda p: p.get('id') == 'sales-date-range')
+        if not picker or not picker[0].get('min_date_allowed'):
+            return
+        min_date = date.fromisoformat(str(picker[0]['min_date_allowed'])[:10])
+        max_date = date.fromisoformat(str(picker[0]['max_date_allowed'])[:10])
+        options = {
+            dim: [o['value'] for o in (find_components(page, lambda p, d=dim: p.get('id') == d) or [{}])[0].get('options', [])]
+            for dim in ('sales-category', 'sales-state')
+        }
+
+        # Первый показ страницы — весь диапазон, затем несколько изменений фильтров и зум
+        self.sales_figures(min_date.isoformat(), max_date.isoformat())
+        span = (max_date - min_date).days
+        for _ in range(self.rng.randint(1, 4)):
+            start = min_date + timedelta(days=self.rng.randint(0, max(span - 30, 0)))
+            end = min(start + timedelta(days=self.rng.choice([30, 90, 180, 365])), max_date)
+            categories = self.rng.sample(options['sales-category'], min(len(options['sales-category']), self.rng.randint(0, 2)))
+            states = self.rng.sample(options['sales-state'], min(len(options['sales-state']), self.rng.randint(0, 2)))
+            self.sales_figures(start.isoformat(), end.isoformat(), categories or None, states or None,
+                               changed='sales-category.value' if categories else 'sales-date-range.start_date')
+            if self.rng.random() < 0.5:
+                zoom_start = start + timedelta(days=self.rng.randint(0, max((end - start).days // 2, 0)))
+                relayout = {'xaxis.range[0]': zoom_start.isoformat(), 'xaxis.range[1]': end.isoformat()}
+                self.sales_figures(start.isoformat(), end.isoformat(), categories or None, states or None,
+                                   relayout=relayout, changed='sales-daily-revenue.relayoutData')
+
+    def visit_tables(self, page):
+        for table in find_components(page, lambda p: isinstance(p.get('id'), dict) and p['id'].get('type') == 'paged-table'):
+            columns = [c['id'] for c in table.get('columns', [])]
+            rows = self.paged_table(table['id'], 0, [], '')
+            for _ in range(self.rng.randint(0, 3)):
+                sort_by = [{'column_id': self.rng.choice(columns), 'direction': self.rng.choice(['asc', 'desc'])}]
+                # Часть запросов — с фильтром по значениям из первой страницы
+                filter_query = self.filter_query(rows) if rows and self.rng.random() < 0.5 else ''
+                self.paged_table(table['id'], 0 if filter_query else self.rng.randint(0, 3), sort_by, filter_query)
+
+    def visit_cohorts(self):
+        page = self.open_page('/cohorts')
+        self.visit_tables(page)
+        dropdowns = find_components(page, lambda p: str(p.get('id', '')).startswith('cohort-filter-'))
+        if not dropdowns:
+            return
+        for _ in range(self.rng.randint(1, 3)):
+            inputs = [{'id': d['id'], 'property': 'value',
+                       'value': self.rng.choice([o['value'] for o in d['options']])} for d in dropdowns]
+            self.call('update_cohort_slice', {'id': 'cohort-slice', 'property': 'children'}, inputs,
+                      changed=[f"{dropdowns[0]['id']}.value"])
+
+    def visit_logistics(self):
+        self.visit_tables(self.open_page('/logistics'))
+
+    def run_once(self):
+        visits = [self.visit_sales, self.visit_cohorts, self.visit_logistics]
+        self.rng.shuffle(visits)
+        for visit in visits:
+            visit()
+
+
+class CallbackStats:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, ok):
+        with self._lock:
+            self.samples.setdefault(name, []).append(seconds * 1000)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def summary(self, wall_seconds):
+        result = {}
+        for name in sorted(self.samples):
+            ms = np.array(self.samples[name])
+            result[name] = {
+                'count': len(ms),
+                'errors': self.errors.get(name, 0),
+                'throughput_rps': round(len(ms) / wall_seconds, 2),
+                'mean_ms': round(float(ms.mean()), 2),
+                'p50_ms': round(float(np.percentile(ms, 50)), 2),
+                'p95_ms': round(float(np.percentile(ms, 95)), 2),
+                'p99_ms': round(float(np.percentile(ms, 99)), 2),
+                'max_ms': round(float(ms.max()), 2),
+            }
+        return result
+
+
+def run_user(host, port, outputs, seed, deadline, iterations, think_seconds, stats):
+    rng = random.Random(seed)
+    client = DashClient(host, port)
+    session = Session(client, outputs, rng, stats)
+    try:
+        done = 0
+        while time.time() < deadline and (iterations is None or done < iterations):
+            session.run_once()
+            done += 1
+            if think_seconds:
+                time.sleep(rng.uniform(0, think_seconds))
+    except Exception as e:
+        print(f"User {seed} stopped: {e}")
+    finally:
+        client.close()
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_load_test(users=10, duration=30, iterations=None, seed=42, think_seconds=0.0, url=None, pid=None):
+    if url:
+        parts = urlsplit(url)
+        if parts.hostname not in LOCAL_HOSTS:
+            raise ValueError(f"Load tests run against localhost only, got {parts.hostname}")
+        host, port, server = parts.hostname, parts.port or 80, None
+    else:
+        host, port = '127.0.0.1', DEFAULT_PORT
+        print(f"Starting dashboard on http://{host}:{port} ...")
+        server = start_server(port)
+        pid = server.pid
+
+    sampler = MemorySampler(pid).start() if pid else None
+    stats = CallbackStats()
+    try:
+        probe = DashClient(host, port)
+        outputs = callback_outputs(probe)
+        probe.close()
+
+        started = time.perf_counter()
+        deadline = time.time() + duration
+        threads = [
+            threading.Thread(target=run_user,
+                             args=(host, port, outputs, seed + i, deadline, iterations, think_seconds, stats))
+            for i in range(users)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - started
+    finally:
+        if sampler:
+            sampler.stop()
+        if server:
+            server.terminate()
+            server.wait(timeout=30)
+
+    callbacks = stats.summary(wall)
+    total = sum(c['count'] for c in callbacks.values())
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'snapshot_mode': bool(os.environ.get('DASHBOARD_SNAPSHOT')),
+            'users': users, 'duration_s': duration, 'iterations': iterations,
+            'seed': seed, 'think_s': think_seconds,
+        },
+        'totals': {
+            'requests': total,
+            'errors': sum(c['errors'] for c in callbacks.values()),
+            'wall_s': round(wall, 2),
+            'throughput_rps': round(total / wall, 2) if wall else 0.0,
+        },
+        'callbacks': callbacks,
+        'server_memory': sampler.summary() if sampler else None,
+    }
+
+
+def compare(current, previous):
+    """Per-callback p50/p95/p99 and throughput change vs an earlier result."""
+    print(f"\nVs {previous['meta'].get('commit')} ({previous['meta'].get('started_at')}):")
+    for name, stats in current['callbacks'].items():
+        before = previous['callbacks'].get(name)
+        if not before:
+            print(f"  {name}: new")
+            continue
+        changes = []
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps'):
+            delta = (stats[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+            changes.append(f"{key} {before[key]} -> {stats[key]} ({delta:+.1f}%)")
+        print(f"  {name}: " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=10, help="concurrent virtual analysts")
+    parser.add_argument('--duration', type=float, default=30, help="seconds to run")
+    parser.add_argument('--iterations', type=int, help="sessions per user (stops earlier than --duration)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--think', type=float, default=0.0, help="max think time between sessions, seconds")
+    parser.add_argument('--url', help="attach to a dashboard already running on localhost")
+    parser.add_argument('--pid', type=int, help="server pid for memory sampling with --url")
+    parser.add_argument('--output', type=Path, help="result JSON (default: benchmarks/results/load_test-<commit>.json)")
+    parser.add_argument('--compare', type=Path, help="earlier result JSON to compare against")
+    args = parser.parse_args()
+
+    result = run_load_test(args.users, args.duration, args.iterations, args.seed, args.think, args.url, args.pid)
+
+    output = args.output or RESULTS_DIR / f"load_test-{result['meta']['commit'] or 'local'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2, sort_keys=True))
+
+    totals = result['totals']
+    print(f"{totals['requests']} requests, {totals['errors']} errors, {totals['throughput_rps']} req/s")
+    for name, stats in result['callbacks'].items():
+        print(f"  {name:24s} n={stats['count']:6d}  p50={stats['p50_ms']:8.2f}  "
+              f"p95={stats['p95_ms']:8.2f}  p99={stats['p99_ms']:8.2f} ms")
+    if result['server_memory']:
+        print(f"Server RSS: {result['server_memory']['start_mb']} -> peak {result['server_memory']['peak_mb']} MB")
+    print(f"Results: {output}")
+
+    if args.compare:
+        compare(result, json.loads(args.compare.read_text()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+"""
+End-to-end benchmark of the pipeline stages with regression thresholds.
+
+Fixture data is generated by src/etl/generate_synthetic_data.py at a few
+small scale factors (cached in benchmarks/fixtures/). Every round loads a
+fixture into a fresh SQLite file and runs each stage in pipeline order:
+the etl_pipeline functions, upsert_sqlite, every create_marts builder,
+cohort / RFM / SLA computations, final_metrics.calculate_all_metrics and
+the dashboard's load_sales_data. Time is the median over --repeat rounds;
+peak memory comes from one extra round under tracemalloc.
+
+Results are compared with benchmarks/baselines.json; the run exits with
+status 1 if any stage got slower (or hungrier) than the threshold allows.
+
+    python benchmarks/run_benchmarks.py                      # compare with baselines
+    python benchmarks/run_benchmarks.py --update-baseline    # record new baselines
+    python benchmarks/run_benchmarks.py --scales 0.1 --stages "marts|sla" --threshold 0.5
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import platform
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+BENCH_DIR = Path(__file__).resolve().parent
+FIXTURES_DIR = BENCH_DIR / "fixtures"
+RESULTS_DIR = BENCH_DIR / "results"
+WORK_DIR = BENCH_DIR / "work"
+BASELINES = BENCH_DIR / "baselines.json"
+
+sys.path.append(str(ROOT / "src" / "etl"))
+sys.path.append(str(ROOT / "src" / "analysis"))
+
+import etl_pipeline
+import create_marts
+import cohort_analysis
+import cohort_cube
+import dashboard_app
+import final_metrics
+import metric_registry
+import rfm_analysis
+import sla_analysis
+from generate_synthetic_data import generate_dataset
+from sketches import register_sketch_functions
+
+DEFAULT_SCALES = [0.02, 0.1, 0.5]
+FIXTURE_SEED = 7
+DEFAULT_REPEAT = 3
+
+# Регрессия: медленнее baseline больше чем на threshold (доля) и больше чем на MIN_DELTA
+DEFAULT_TIME_THRESHOLD = 0.25
+DEFAULT_MEMORY_THRESHOLD = 0.25
+MIN_DELTA_SECONDS = 0.05
+MIN_DELTA_MB = 2.0
+
+
+# --- Этапы: каждый получает общий контекст раунда ---------------------------------
+
+def stage_load_csv(ctx):
+    ctx['orders'] = etl_pipeline.load_csv("olist_orders.csv")
+    ctx['customers'] = etl_pipeline.load_csv("olist_customers.csv")
+    ctx['products'] = etl_pipeline.load_csv("olist_products.csv")
+    ctx['items'] = etl_pipeline.load_csv("olist_order_items.csv")
+    ctx['sellers'] = etl_pipeline.load_csv("olist_sellers.csv")
+    ctx['geolocation'] = etl_pipeline.load_csv("olist_geolocation.csv")
+
+
+def stage_deduplicate_customers(ctx):
+    ctx['customers'] = etl_pipeline.deduplicate_customers(ctx['customers'])
+
+
+def stage_deduplicate_sellers(ctx):
+    ctx['sellers'] = etl_pipeline.deduplicate_sellers(ctx['sellers'])
+
+
+def stage_build_geolocation(ctx):
+    ctx['geolocation'] = etl_pipeline.build_geolocation(ctx['geolocation'])
+
+
+def stage_transform_orders(ctx):
+    ctx['orders'] = etl_pipeline.transform_orders(ctx['orders'], ctx['customers']['customer_id'].unique())
+
+
+def stage_transform_items(ctx):
+    ctx['items'] = etl_pipeline.transform_items(ctx['items'])
+
+
+def stage_add_order_totals(ctx):
+    ctx['orders'] = etl_pipeline.add_order_totals(ctx['orders'], ctx['items'])
+
+
+def stage_upsert_sqlite(ctx):
+    etl_pipeline.upsert_sqlite(ctx['orders'], ctx['customers'], ctx['products'], ctx['items'],
+                               ctx['sellers'], ctx['geolocation'])
+
+
+def stage_update_incremental_state(ctx):
+    etl_pipeline.update_incremental_state(ctx['orders'], ctx['customers'])
+
+
+def stage_cohort_retention(ctx):
+    cohort_analysis.calculate_cohort_retention(ctx['conn'])
+
+
+def stage_cohort_state(ctx):
+    cohort_analysis.refresh_cohort_state(ctx['conn'], rebuild=True)
+
+
+def stage_cohort_cube(ctx):
+    orders = cohort_cube.load_customer_orders(ctx['conn'])
+    cohort_cube.save_cohort_cube(ctx['conn'], cohort_cube.build_cohort_cube(orders))
+
+
+def stage_rfm(ctx):
+    rfm = rfm_analysis.compute_rfm(rfm_analysis.load_orders(ctx['conn']))
+    rfm_analysis.save_rfm_mart(ctx['conn'], rfm)
+
+
+def stage_sla_sketches(ctx):
+    sla_analysis.build_delivery_sketches(ctx['conn'])
+
+
+def stage_sla_metrics(ctx):
+    sla_analysis.calculate_sla_metrics(ctx['conn'])
+    sla_analysis.calculate_overall_sla(ctx['conn'])
+
+
+def stage_final_metrics(ctx):
+    # Кэш реестра метрик сбрасываем: меряем вычисление, а не попадание в кэш
+    metric_registry._cache.clear()
+    final_metrics.calculate_all_metrics(ctx['conn'])
+
+
+def stage_load_sales_data(ctx):
+    dashboard_app.DB_PATH = ctx['db_path']
+    metric_registry._cache.clear()
+    dashboard_app.load_sales_data()
+
+
+def _mart_stage(builder):
+    return lambda ctx: builder(ctx['conn'])
+
+
+STAGES = [
+    ('etl.load_csv', stage_load_csv),
+    ('etl.deduplicate_customers', stage_deduplicate_customers),
+    ('etl.deduplicate_sellers', stage_deduplicate_sellers),
+    ('etl.build_geolocation', stage_build_geolocation),
+    ('etl.transform_orders', stage_transform_orders),
+    ('etl.transform_items', stage_transform_items),
+    ('etl.add_order_totals', stage_add_order_totals),
+    ('etl.upsert_sqlite', stage_upsert_sqlite),
+    ('etl.update_incremental_state', stage_update_incremental_state),
+    ('marts.daily_category', _mart_stage(create_marts.create_daily_category_mart)),
+    ('marts.daily_category_state', _mart_stage(create_marts.create_daily_category_state_mart)),
+    ('marts.weekly_city', _mart_stage(create_marts.create_weekly_city_mart)),
+    ('marts.product_performance', _mart_stage(create_marts.create_product_performance_mart)),
+    ('marts.delivery_analysis', _mart_stage(create_marts.create_delivery_analysis_mart)),
+    ('cohort.retention', stage_cohort_retention),
+    ('cohort.state', stage_cohort_state),
+    ('cohort.cube', stage_cohort_cube),
+    ('rfm.compute', stage_rfm),
+    ('sla.sketches', stage_sla_sketches),
+    ('sla.metrics', stage_sla_metrics),
+    ('final_metrics.calculate_all_metrics', stage_final_metrics),
+    ('dashboard.load_sales_data', stage_load_sales_data),
+]
+
+
+# --- Запуск -----------------------------------------------------------------------
+
+def fixture_dir(scale, seed=FIXTURE_SEED):
+    path = FIXTURES_DIR / f"scale-{scale:g}-seed-{seed}"
+    if not (path / "olist_orders.csv").exists():
+        print(f"Generating fixture x{scale:g} -> {path}")
+        generate_dataset(path, scale=scale, seed=seed, geolocation=True)
+    return path
+
+
+def run_round(data_dir, stages, trace_memory=False):
+    """
+    Run the stages once against a fresh database; {stage: (seconds, peak_bytes | None)}
+    for the selected stages. Earlier stages they depend on are run but not reported.
+    """
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+    WORK_DIR.mkdir(parents=True)
+    db_path = WORK_DIR / "bench.db"
+
+    # Этапы ETL читают CSV фикстуры и пишут в отдельную базу
+    etl_pipeline.DATA_DIR = data_dir
+    etl_pipeline.DB_PATH = db_path
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    register_sketch_functions(conn)
+    ctx = {'conn': conn, 'db_path': db_path}
+
+    last = max(i for i, (name, _) in enumerate(STAGES) if name in stages)
+    timings = {}
+    try:
+        for name, stage in STAGES[:last + 1]:
+            if name not in stages:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    stage(ctx)
+                continue
+            gc.collect()
+            if trace_memory:
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                stage(ctx)
+            elapsed = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1] - baseline if trace_memory else None
+            timings[name] = (elapsed, peak)
+    finally:
+        conn.close()
+        # Отчёт дедупликации пишется в DATA_DIR — фикстуру оставляем чистой
+        (Path(data_dir) / "deduplication_report.txt").unlink(missing_ok=True)
+    return timings
+
+
+def benchmark_scale(scale, stages, repeat):
+    data_dir = fixture_dir(scale)
+    rounds = [run_round(data_dir, stages) for _ in range(repeat)]
+
+    tracemalloc.start()
+    try:
+        memory = run_round(data_dir, stages, trace_memory=True)
+    finally:
+        tracemalloc.stop()
+
+    result = {}
+    for name in rounds[0]:
+        seconds = np.array([r[name][0] for r in rounds])
+        result[name] = {
+            'seconds': round(float(np.median(seconds)), 4),
+            'min_seconds': round(float(seconds.min()), 4),
+            'peak_mb': round(memory[name][1] / 2 ** 20, 2),
+        }
+    return result
+
+
+def find_regressions(current, baseline, time_threshold, memory_threshold):
+    """[(scale, stage, metric, baseline, current)] for every stage past its threshold."""
+    regressions = []
+    for scale, stages in current['scales'].items():
+        for name, stats in stages.items():
+            before = baseline.get('scales', {}).get(scale, {}).get(name)
+            if not before:
+                continue
+            if (stats['seconds'] > before['seconds'] * (1 + time_threshold)
+                    and stats['seconds'] - before['seconds'] > MIN_DELTA_SECONDS):
+                regressions.append((scale, name, 'seconds', before['seconds'], stats['seconds']))
+            if (stats['peak_mb'] > before['peak_mb'] * (1 + memory_threshold)
+                    and stats['peak_mb'] - before['peak_mb'] > MIN_DELTA_MB):
+                regressions.append((scale, name, 'peak_mb', before['peak_mb'], stats['peak_mb']))
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(current, baseline):
+    for scale, stages in current['scales'].items():
+        print(f"\nScale x{scale}")
+        print(f"  {'stage':40s} {'seconds':>9s} {'baseline':>9s} {'change':>8s} {'peak MB':>9s}")
+        for name, stats in stages.items():
+            before = baseline.get('scales', {}).get(scale, {}).get(name)
+            if before and before['seconds']:
+                change = f"{(stats['seconds'] - before['seconds']) / before['seconds'] * 100:+.0f}%"
+                base = f"{before['seconds']:.4f}"
+            else:
+                change, base = "", "-"
+            print(f"  {name:40s} {stats['seconds']:9.4f} {base:>9s} {change:>8s} {stats['peak_mb']:9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pipeline benchmarks with regression thresholds")
+    parser.add_argument('--scales', type=float, nargs='+', default=DEFAULT_SCALES)
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="timed rounds per scale")
+    parser.add_argument('--stages', help="regex: run only matching stages")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_TIME_THRESHOLD,
+                        help="allowed slowdown vs baseline (0.25 = +25%%)")
+    parser.add_argument('--memory-threshold', type=float, default=DEFAULT_MEMORY_THRESHOLD)
+    parser.add_argument('--baseline', type=Path, default=BASELINES)
+    parser.add_argument('--update-baseline', action='store_true', help="store this run as the new baseline")
+    parser.add_argument('--output', type=Path, help="result JSON (default: benchmarks/results/bench-<commit>.json)")
+    args = parser.parse_args()
+
+    stages = [name for name, _ in STAGES if not args.stages or re.search(args.stages, name)]
+    current = {
+        'meta': {
+            'commit': git_commit(),
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+        },
+        'scales': {f"{scale:g}": benchmark_scale(scale, stages, args.repeat) for scale in args.scales},
+    }
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    output = args.output or RESULTS_DIR / f"bench-{current['meta']['commit'] or 'local'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(current, indent=2, sort_keys=True))
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    print_report(current, baseline)
+    print(f"\nResults: {output}")
+
+    if args.update_baseline:
+        # Новые значения дополняют baseline, остальные масштабы и этапы сохраняются
+        merged = {'meta': current['meta'], 'scales': baseline.get('scales', {})}
+        for scale, stages_stats in current['scales'].items():
+            merged['scales'].setdefault(scale, {}).update(stages_stats)
+        args.baseline.write_text(json.dumps(merged, indent=2, sort_keys=True))
+        print(f"Baseline updated: {args.baseline}")
+        return
+
+    if not baseline:
+        print(f"No baseline at {args.baseline} — run with --update-baseline to record one.")
+        return
+
+    regressions = find_regressions(current, baseline, args.threshold, args.memory_threshold)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) vs baseline {baseline['meta'].get('commit')}:")
+        for scale, name, metric, before, after in regressions:
+            print(f"  x{scale} {name}: {metric} {before} -> {after}")
+        sys.exit(1)
+    print("\nNo regressions vs baseline.")
+
+
+if __name__ == "__main__":
+    main()
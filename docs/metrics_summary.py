@@ -1,13 +1,13 @@
 import sqlite3
+import sys
 import pandas as pd
+from pathlib import Path
 
 DB_PATH = "data/ecommerce.db"
+ANALYSIS_DIR = Path(__file__).resolve().parents[1] / "src" / "analysis"
 
-
-def calculate_aov(conn):
-    """Average Order Value"""
-    query = "SELECT AVG(order_total) FROM fact_orders"
-    return conn.execute(query).fetchone()[0]
+sys.path.append(str(ANALYSIS_DIR))
+from metric_registry import compute_metrics
 
 
 def calculate_retention_m0_m1(conn):
@@ -49,19 +49,6 @@ def calculate_retention_m0_m1(conn):
     return df
 
 
-def calculate_late_delivery_share(conn):
-    """Доля опозданий доставки"""
-    query = """
-    SELECT 
-        ROUND(
-            SUM(CASE WHEN delivery_time_days > promised_time_days THEN 1 ELSE 0 END) * 100.0 / COUNT(*), 2
-        ) AS late_delivery_percent
-    FROM fact_orders
-    WHERE delivery_time_days IS NOT NULL AND promised_time_days IS NOT NULL
-    """
-    return conn.execute(query).fetchone()[0]
-
-
 def calculate_top_categories(conn, top_n=10):
     """Топ категории по выручке"""
     query = """
@@ -86,26 +73,21 @@ def main():
         print(f"Database not found at {DB_PATH}. Run ETL first.")
         return
 
-    # Базовые метрики
-    orders = pd.read_sql("SELECT * FROM fact_orders", conn)
-    gmv = orders['order_total'].sum()
-    num_orders = len(orders)
-    num_customers = orders['customer_id'].nunique()
-    aov = calculate_aov(conn)
+    # Базовые метрики — из единого реестра (те же определения, что в отчёте и дашборде)
+    metrics = compute_metrics(conn, ['gmv', 'total_orders', 'total_customers', 'aov', 'late_delivery_rate'])
 
     # Новые метрики
     retention_df = calculate_retention_m0_m1(conn)
-    late_delivery = calculate_late_delivery_share(conn)
     top_categories = calculate_top_categories(conn, 5)
 
     print("=" * 60)
     print("E-COMMERCE METRICS SUMMARY")
     print("=" * 60)
-    print(f"GMV: {gmv:.2f}")
-    print(f"Total Orders: {num_orders}")
-    print(f"Unique Customers: {num_customers}")
-    print(f"AOV (Average Order Value): {aov:.2f}")
-    print(f"Late Delivery Share: {late_delivery}%")
+    print(f"GMV: {metrics['gmv']:.2f}")
+    print(f"Total Orders: {metrics['total_orders']}")
+    print(f"Unique Customers: {metrics['total_customers']}")
+    print(f"AOV (Average Order Value): {metrics['aov']:.2f}")
+    print(f"Late Delivery Share: {metrics['late_delivery_rate']:.2f}%")
     print("\nTop Categories by Revenue:")
     print(top_categories.to_string(index=False))
     print("\nCohort Retention M0 → M1:")
@@ -0,0 +1,158 @@
+"""
+Single entry point for the pipeline scripts:
+
+    python -m src etl dq marts cohort cube rfm sla geo metrics
+    python -m src dashboard --port 8050
+    python -m src --startup
+
+Subcommands run in the given order in one warm interpreter: pandas, numpy
+and the shared analysis modules are imported once, and a script's module
+is imported only when its subcommand runs (matplotlib only when a chart is
+saved, Dash only for the dashboard). Import and run time of every
+subcommand are printed at the end; --startup measures the cold import time
+of each subcommand in a fresh interpreter instead of running anything.
+"""
+import argparse
+import importlib
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+SRC_DIR = Path(__file__).resolve().parent
+# Скрипты лежат плоско и импортируют соседей напрямую
+MODULE_DIRS = [SRC_DIR / "etl", SRC_DIR / "analysis"]
+
+COMMANDS = {
+    'etl': ('etl_pipeline', "load the Olist CSVs into SQLite and update incremental state"),
+    'dq': ('data_quality_checks', "PK / FK / status checks on the warehouse"),
+    'marts': ('create_marts', "rebuild the analytical marts"),
+    'cohort': ('cohort_analysis', "cohort retention matrix and chart"),
+    'cube': ('cohort_cube', "cohort cube for dashboard retention slices"),
+    'rfm': ('rfm_analysis', "RFM segmentation mart and chart"),
+    'sla': ('sla_analysis', "delivery SLA by city / category"),
+    'geo': ('geo_distance', "seller -> customer distance bands and per-seller SLA"),
+    'metrics': ('final_metrics', "final metrics report"),
+    'partitions': ('partitions', "monthly fact partitions: catalog and pruned-read check (--compact via the script)"),
+    'snapshot': ('dashboard_snapshot', "prebuilt dashboard snapshot bundle"),
+    'queries': ('query_log', "top SQL statements of the latest run"),
+    'dashboard': ('dashboard_app', "serve the Dash dashboard (must be last)"),
+}
+
+
+def _add_module_dirs():
+    for path in MODULE_DIRS:
+        if str(path) not in sys.path:
+            sys.path.append(str(path))
+
+
+def run_command(name, args):
+    """Import the subcommand's module and call its main(); returns (import_s, run_s)."""
+    module_name = COMMANDS[name][0]
+    started = time.perf_counter()
+    module = importlib.import_module(module_name)
+    imported = time.perf_counter()
+
+    if name == 'queries' and 'query_log' in sys.modules:
+        # Статистика этого процесса пишется при выходе — сбрасываем её заранее, чтобы попасть в отчёт
+        module.write_run_stats()
+
+    # main() скриптов с argparse не должны видеть аргументы CLI
+    saved_argv = sys.argv
+    sys.argv = [module.__file__]
+    try:
+        if name == 'dashboard':
+            module.main(host=args.host, port=args.port, debug=False)
+        else:
+            module.main()
+    finally:
+        sys.argv = saved_argv
+    return imported - started, time.perf_counter() - imported
+
+
+def print_timings(timings):
+    print("\n" + "=" * 60)
+    print(f"{'command':<12}{'import, s':>12}{'run, s':>12}")
+    print("-" * 60)
+    for name, import_s, run_s in timings:
+        print(f"{name:<12}{import_s:>12.2f}{run_s:>12.2f}")
+    print("-" * 60)
+    print(f"{'total':<12}{sum(i + r for _, i, r in timings):>24.2f}")
+
+
+def measure_startup(names):
+    """Cold import time of each subcommand, every one in a fresh interpreter."""
+    dirs = [str(p) for p in MODULE_DIRS]
+    print(f"{'command':<12}{'module':<22}{'import, s':>12}{'process, s':>12}")
+    print("-" * 60)
+    # Базовая линия: сам интерпретатор без импортов пайплайна
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], check=True)
+    print(f"{'(python)':<12}{'':<22}{0:>12.2f}{time.perf_counter() - started:>12.2f}")
+    for name in names:
+        module_name = COMMANDS[name][0]
+        code = (
+            "import sys, time; started = time.perf_counter(); "
+            f"sys.path.extend({dirs!r}); import {module_name}; "
+            "print(time.perf_counter() - started)"
+        )
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+        process_s = time.perf_counter() - started
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else result.returncode
+            print(f"{name:<12}{module_name:<22}  failed: {error}")
+            continue
+        import_s = float(result.stdout.strip().splitlines()[-1])
+        print(f"{name:<12}{module_name:<22}{import_s:>12.2f}{process_s:>12.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m src",
+        description="Run pipeline steps in one process",
+        epilog="\n".join(f"  {name:<10} {help_}" for name, (_, help_) in COMMANDS.items()),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('commands', nargs='*', metavar='command')
+    parser.add_argument('--startup', action='store_true',
+                        help="only measure cold import time of the commands (all by default)")
+    parser.add_argument('--host', default="127.0.0.1", help="dashboard host")
+    parser.add_argument('--port', type=int, default=8050, help="dashboard port")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.commands if name not in COMMANDS]
+    if unknown:
+        parser.error(f"unknown command(s): {', '.join(unknown)} (choose from {', '.join(COMMANDS)})")
+    if args.startup:
+        measure_startup(args.commands or list(COMMANDS))
+        return
+    if not args.commands:
+        parser.error("no commands given")
+    if 'dashboard' in args.commands[:-1]:
+        parser.error("dashboard blocks until stopped and must be the last command")
+
+    _add_module_dirs()
+    timings = []
+    failed = None
+    for name in args.commands:
+        print(f"\n>>> {name}: {COMMANDS[name][1]}")
+        try:
+            timings.append((name, *run_command(name, args)))
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                failed = name
+                break
+        except Exception as e:
+            print(f"{name} failed: {type(e).__name__}: {e}")
+            failed = name
+            break
+
+    print_timings(timings)
+    if failed:
+        print(f"Stopped at '{failed}'")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,9 +8,14 @@ except Exception:
     class PythonOperator:
         def __init__(self, *args, **kwargs): pass
 
+import os
 import subprocess
 import sys
 
+def run_cli(*commands):
+    # Одна задача — один процесс `python -m src`: тяжёлые импорты грузятся лениво и один раз
+    subprocess.run([sys.executable, "-m", "src", *commands], check=False)
+
 def extract():
     print("TASK extract: listing CSV files in data/")
     import os
@@ -18,19 +23,61 @@ def extract():
 
 def transform():
     print("TASK transform: executing ETL script")
-    subprocess.run([sys.executable, "src/etl/etl_pipeline.py"], check=False)
+    run_cli("etl")
 
 def load():
     print("TASK load: ensured by ETL (writes to SQLite)")
 
 def quality_check():
     print("TASK quality_check: running data quality checks")
-    subprocess.run([sys.executable, "src/etl/data_quality_checks.py"], check=False)
+    run_cli("dq")
+
+def build_marts():
+    print("TASK build_marts: refreshing analytical marts")
+    run_cli("marts")
+
+def cohort_analysis():
+    print("TASK cohort_analysis: cohort state and mart_cohort_retention")
+    run_cli("cohort")
+
+def cohort_cube():
+    print("TASK cohort_cube: precomputed cohort cube for dashboard slices")
+    run_cli("cube")
+
+def sla_analysis():
+    print("TASK sla_analysis: delivery SLA mart")
+    run_cli("sla")
+
+def geo_analysis():
+    print("TASK geo_analysis: seller -> customer distance marts")
+    run_cli("geo")
+
+def dashboard_snapshot():
+    print("TASK dashboard_snapshot: building dashboard snapshot bundle")
+    run_cli("snapshot")
+
+def query_report():
+    print("TASK query_report: top SQL statements of this run")
+    run_cli("queries")
 
 if __name__ == "__main__":
-    print("Simulating DAG: extract -> transform -> load -> quality_check")
+    # Общий id запуска: статистика SQL всех задач собирается в один отчёт
+    os.environ.setdefault("PIPELINE_RUN_ID", datetime.now().strftime("%Y%m%dT%H%M%S"))
+    print("Simulating DAG: extract -> transform -> load -> quality_check -> build_marts -> cohort_analysis -> cohort_cube -> sla_analysis -> geo_analysis -> dashboard_snapshot -> query_report")
     extract()
-    transform()
-    load()
-    quality_check()
+    if "--warm" in sys.argv:
+        # Все задачи после extract в одном прогретом процессе
+        run_cli("etl", "dq", "marts", "cohort", "cube", "sla", "geo", "snapshot", "queries")
+    else:
+        transform()
+        load()
+        quality_check()
+        build_marts()
+        # Снимок читает витрины когорт, куб и SLA — они должны быть собраны до него
+        cohort_analysis()
+        cohort_cube()
+        sla_analysis()
+        geo_analysis()
+        dashboard_snapshot()
+        query_report()
     print("DAG simulation complete:", datetime.now())
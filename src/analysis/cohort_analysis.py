@@ -1,81 +1,367 @@
 """
-Cohort retention analysis with 1/2/3 month retention rates.
+Cohort retention analysis: vectorized cohort x age matrix over integer
+month/week indices, keyed on customer_unique_id.
 """
-import sqlite3
 import pandas as pd
-import matplotlib.pyplot as plt
 from pathlib import Path
 import numpy as np
 
+from query_log import connect, read_sql
+
 DB = Path(__file__).resolve().parents[2] / "data" / "ecommerce.db"
 OUT_CHART = Path(__file__).resolve().parents[2] / "docs" / "cohort_retention_chart.png"
 OUT_DATA = Path(__file__).resolve().parents[2] / "docs" / "cohort_retention_data.csv"
 
 
-def calculate_cohort_retention(conn):
+# Горизонт (число периодов после когорты) и гранулярность ('month' / 'week')
+RETENTION_HORIZON = 3
+GRANULARITY = 'month'
+
+_EPOCH_WEEKDAY_SHIFT = 3  # 1970-01-01 — четверг, сдвиг до понедельника
+
+
+def to_period_index(order_days, granularity='month'):
+    """
+    Map days since 1970-01-01 to integer period indices.
+    month: months since 1970-01, week: ISO weeks (Monday start) since 1969-12-29.
+    """
+    order_days = np.asarray(order_days, dtype=np.int64)
+    if granularity == 'month':
+        return order_days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    if granularity == 'week':
+        return (order_days + _EPOCH_WEEKDAY_SHIFT) // 7
+    raise ValueError(f"Unknown granularity: {granularity}")
+
+
+def period_labels(periods, granularity='month'):
+    """Human-readable labels for integer period indices (2017-03 / 2017-03-06)."""
+    periods = np.asarray(periods, dtype=np.int64)
+    if granularity == 'month':
+        return np.datetime_as_string(periods.astype('datetime64[M]'))
+    days = periods * 7 - _EPOCH_WEEKDAY_SHIFT
+    return np.datetime_as_string(days.astype('datetime64[D]'))
+
+
+def build_cohort_matrix(customer_keys, order_days, granularity='month', horizon=None):
+    """
+    Count active customers per (cohort, age) in one vectorized pass.
+    Returns (cohort_periods, counts) where counts[i, k] is the number of
+    customers of cohort cohort_periods[i] active k periods after their first
+    purchase; counts[:, 0] is the cohort size.
+    """
+    codes, uniques = pd.factorize(pd.Series(customer_keys), sort=False)
+    periods = to_period_index(order_days, granularity)
+    if len(uniques) == 0:
+        return np.empty(0, dtype=np.int64), np.zeros((0, 1), dtype=np.int64)
+
+    p_min = periods.min()
+    span = int(periods.max() - p_min) + 1
+    rel = periods - p_min
+
+    # Уникальные пары (покупатель, период): один покупатель считается один раз за период
+    pairs = pd.unique(codes.astype(np.int64) * span + rel)
+    pair_customer = pairs // span
+    pair_period = pairs % span
+
+    first_period = np.full(len(uniques), span, dtype=np.int64)
+    np.minimum.at(first_period, pair_customer, pair_period)
+
+    cohort = first_period[pair_customer]
+    age = pair_period - cohort
+    n_ages = span if horizon is None else min(span, horizon + 1)
+    keep = age < n_ages
+
+    counts = np.bincount(
+        cohort[keep] * n_ages + age[keep],
+        minlength=span * n_ages
+    ).reshape(span, n_ages)
+
+    has_cohort = counts[:, 0] > 0
+    return np.flatnonzero(has_cohort) + p_min, counts[has_cohort]
+
+
+def calculate_cohort_retention(conn, horizon=RETENTION_HORIZON, granularity=GRANULARITY):
     """
-    Calculate cohort retention for 1, 2, 3 months.
-    Returns DataFrame with cohort_month, cohort_size, retention rates.
+    Calculate cohort retention for periods 1..horizon (horizon=None: all ages).
+    Cohorts are keyed on customer_unique_id (customer_id is per order in Olist).
+    Returns (DataFrame with cohort, cohort_size, retention rates; retention matrix in %).
     """
     query = """
     SELECT 
-        customer_id,
-        DATE(order_purchase_timestamp) AS order_date
-    FROM fact_orders
-    WHERE order_status NOT IN ('cancelled', 'unavailable')
-    ORDER BY customer_id, order_date
+        c.customer_unique_id,
+        CAST(julianday(o.order_purchase_timestamp) - 2440587.5 AS INTEGER) AS order_day
+    FROM fact_orders o
+    JOIN dim_customers c ON o.customer_id = c.customer_id
+    WHERE o.order_status NOT IN ('cancelled', 'unavailable')
+      AND o.order_purchase_timestamp IS NOT NULL
     """
-    df = pd.read_sql_query(query, conn, parse_dates=['order_date'])
+    df = read_sql(query, conn)
 
     if df.empty:
         print("No orders in database")
-        return pd.DataFrame()
-
-    # Определяем когорту (месяц первой покупки)
-    df['cohort_month'] = df.groupby('customer_id')['order_date'].transform('min').dt.to_period('M')
-    df['order_month'] = df['order_date'].dt.to_period('M')
-
-    # Создаём сводную таблицу
-    cohort_data = df.groupby(['cohort_month', 'order_month']).agg(
-        n_customers=('customer_id', 'nunique')
-    ).reset_index()
-
-    # Вычисляем разницу в месяцах между когортой и месяцем заказа
-    cohort_data['months_diff'] = (cohort_data['order_month'] - cohort_data['cohort_month']).apply(lambda x: x.n)
-
-    # Сводная таблица для матрицы удержания
-    retention_pivot = cohort_data.pivot_table(
-        index='cohort_month',
-        columns='months_diff',
-        values='n_customers',
-        aggfunc='sum'
+        return pd.DataFrame(), pd.DataFrame()
+
+    cohort_periods, counts = build_cohort_matrix(
+        df['customer_unique_id'].to_numpy(), df['order_day'].to_numpy(),
+        granularity=granularity, horizon=horizon
     )
+    return retention_from_counts(cohort_periods, counts, horizon, granularity)
 
-    # Размер когорты (месяц 0)
-    cohort_sizes = retention_pivot[0]
+
+def retention_from_counts(cohort_periods, counts, horizon=RETENTION_HORIZON, granularity=GRANULARITY):
+    """Turn a cohort x age count matrix into the result table and retention matrix."""
+    labels = period_labels(cohort_periods, granularity)
+    cohort_sizes = counts[:, 0]
 
     # Вычисляем проценты удержания
-    retention_rates = retention_pivot.div(cohort_sizes, axis=0) * 100
+    retention_rates = pd.DataFrame(
+        counts / cohort_sizes[:, None] * 100,
+        index=pd.Index(labels, name=f'cohort_{granularity}')
+    )
+
+    # Возраст когорты за пределами наблюдаемого периода — NaN, а не 0%
+    last_period = cohort_periods.max() if len(cohort_periods) else 0
+    observable = (last_period - cohort_periods)[:, None] >= np.arange(counts.shape[1])
+    retention_rates = retention_rates.where(observable)
 
-    # Создаём итоговый DataFrame
     result = pd.DataFrame({
-        'cohort_month': retention_rates.index.astype(str),
-        'cohort_size': cohort_sizes.values
+        f'cohort_{granularity}': labels,
+        'cohort_size': cohort_sizes
     })
 
-    # Добавляем удержание для 1, 2, 3 месяцев
-    for month in [1, 2, 3]:
-        col_name = f'retention_month_{month}'
-        if month in retention_rates.columns:
-            result[col_name] = retention_rates[month].round(2).values
+    n_ages = counts.shape[1] - 1 if horizon is None else horizon
+    for age in range(1, n_ages + 1):
+        col_name = f'retention_{granularity}_{age}'
+        if age in retention_rates.columns:
+            result[col_name] = retention_rates[age].round(2).values
         else:
             result[col_name] = np.nan
 
     return result, retention_rates
 
 
-def plot_cohort_retention(retention_rates, output_path):
+COHORT_STATE_DDL = """
+CREATE TABLE IF NOT EXISTS customer_cohort (
+    customer_unique_id TEXT PRIMARY KEY,
+    cohort_period INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS customer_activity (
+    customer_unique_id TEXT NOT NULL,
+    active_period INTEGER NOT NULL,
+    PRIMARY KEY (customer_unique_id, active_period)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS cohort_activity (
+    cohort_period INTEGER NOT NULL,
+    active_period INTEGER NOT NULL,
+    customers INTEGER NOT NULL,
+    PRIMARY KEY (cohort_period, active_period)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS cohort_applied_orders (
+    order_id TEXT PRIMARY KEY
+) WITHOUT ROWID;
+"""
+
+
+def ensure_cohort_state(conn):
+    """Create monthly cohort state tables (periods are months since 1970-01)."""
+    conn.executescript(COHORT_STATE_DDL)
+
+
+def _add_activity_deltas(conn, select_sql):
+    conn.execute(f"""
+        INSERT INTO cohort_activity (cohort_period, active_period, customers)
+        SELECT * FROM ({select_sql}) WHERE 1
+        ON CONFLICT(cohort_period, active_period)
+        DO UPDATE SET customers = customers + excluded.customers
+    """)
+
+
+def update_cohort_state(conn, batch):
+    """
+    Apply a batch of orders (customer_unique_id, order_day) to the cohort state.
+    Only new customers are inserted and only affected (cohort, active month)
+    cells are incremented. Re-applying overlapping batches is idempotent;
+    a customer whose batch contains an earlier purchase than the stored one
+    is moved to the earlier cohort.
+    Returns the number of new (customer, month) activity pairs.
+    """
+    if batch.empty:
+        return 0
+
+    pairs = pd.DataFrame({
+        'customer_unique_id': batch['customer_unique_id'].to_numpy(),
+        'active_period': to_period_index(batch['order_day'].to_numpy(), 'month'),
+    }).drop_duplicates()
+
+    with conn:
+        ensure_cohort_state(conn)
+        conn.execute("DROP TABLE IF EXISTS temp._cohort_batch")
+        conn.execute("""
+            CREATE TEMP TABLE _cohort_batch (
+                customer_unique_id TEXT NOT NULL,
+                active_period INTEGER NOT NULL,
+                PRIMARY KEY (customer_unique_id, active_period)
+            ) WITHOUT ROWID
+        """)
+        conn.executemany(
+            "INSERT INTO _cohort_batch VALUES (?, ?)",
+            zip(pairs['customer_unique_id'], pairs['active_period'].astype(int).tolist())
+        )
+
+        # Покупатели, у которых в батче есть более ранняя покупка, переезжают в новую когорту
+        conn.execute("DROP TABLE IF EXISTS temp._cohort_moved")
+        conn.execute("""
+            CREATE TEMP TABLE _cohort_moved (
+                customer_unique_id TEXT PRIMARY KEY,
+                old_cohort INTEGER NOT NULL,
+                new_cohort INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            INSERT INTO _cohort_moved
+            SELECT cc.customer_unique_id, cc.cohort_period AS old_cohort, b.first_period AS new_cohort
+            FROM customer_cohort cc
+            JOIN (
+                SELECT customer_unique_id, MIN(active_period) AS first_period
+                FROM _cohort_batch
+                GROUP BY customer_unique_id
+            ) b ON b.customer_unique_id = cc.customer_unique_id
+            WHERE b.first_period < cc.cohort_period
+        """)
+        _add_activity_deltas(conn, """
+            SELECT m.old_cohort, a.active_period, -COUNT(*)
+            FROM _cohort_moved m
+            JOIN customer_activity a ON a.customer_unique_id = m.customer_unique_id
+            GROUP BY m.old_cohort, a.active_period
+        """)
+        _add_activity_deltas(conn, """
+            SELECT m.new_cohort, a.active_period, COUNT(*)
+            FROM _cohort_moved m
+            JOIN customer_activity a ON a.customer_unique_id = m.customer_unique_id
+            GROUP BY m.new_cohort, a.active_period
+        """)
+        conn.execute("""
+            UPDATE customer_cohort
+            SET cohort_period = (
+                SELECT new_cohort FROM _cohort_moved m
+                WHERE m.customer_unique_id = customer_cohort.customer_unique_id
+            )
+            WHERE customer_unique_id IN (SELECT customer_unique_id FROM _cohort_moved)
+        """)
+
+        conn.execute("""
+            INSERT OR IGNORE INTO customer_cohort (customer_unique_id, cohort_period)
+            SELECT customer_unique_id, MIN(active_period)
+            FROM _cohort_batch
+            GROUP BY customer_unique_id
+        """)
+
+        # Инкремент только для новых пар (покупатель, месяц)
+        conn.execute("DELETE FROM _cohort_batch WHERE EXISTS ("
+                     " SELECT 1 FROM customer_activity a"
+                     " WHERE a.customer_unique_id = _cohort_batch.customer_unique_id"
+                     "   AND a.active_period = _cohort_batch.active_period)")
+        new_pairs = conn.execute("SELECT COUNT(*) FROM _cohort_batch").fetchone()[0]
+        _add_activity_deltas(conn, """
+            SELECT cc.cohort_period, b.active_period, COUNT(*)
+            FROM _cohort_batch b
+            JOIN customer_cohort cc ON cc.customer_unique_id = b.customer_unique_id
+            GROUP BY cc.cohort_period, b.active_period
+        """)
+        conn.execute("INSERT INTO customer_activity SELECT customer_unique_id, active_period FROM _cohort_batch")
+        conn.execute("DELETE FROM cohort_activity WHERE customers = 0")
+
+        conn.execute("DROP TABLE temp._cohort_batch")
+        conn.execute("DROP TABLE temp._cohort_moved")
+
+    return new_pairs
+
+
+def load_new_orders(conn):
+    """Non-cancelled orders not yet applied to the cohort state, whatever their purchase date."""
+    query = """
+    SELECT 
+        o.order_id,
+        c.customer_unique_id,
+        CAST(julianday(o.order_purchase_timestamp) - 2440587.5 AS INTEGER) AS order_day
+    FROM fact_orders o
+    JOIN dim_customers c ON o.customer_id = c.customer_id
+    WHERE o.order_status NOT IN ('cancelled', 'unavailable')
+      AND o.order_purchase_timestamp IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM cohort_applied_orders a WHERE a.order_id = o.order_id)
+    """
+    return read_sql(query, conn)
+
+
+def refresh_cohort_state(conn, rebuild=False):
+    """
+    Bring the cohort state up to date with fact_orders.
+    Orders are tracked by order_id in cohort_applied_orders, so an order
+    loaded later with an earlier purchase date is still applied (and moves
+    its customer to the earlier cohort).
+    """
+    ensure_cohort_state(conn)
+    if rebuild:
+        with conn:
+            conn.execute("DELETE FROM customer_cohort")
+            conn.execute("DELETE FROM customer_activity")
+            conn.execute("DELETE FROM cohort_activity")
+            conn.execute("DELETE FROM cohort_applied_orders")
+
+    batch = load_new_orders(conn)
+    new_pairs = update_cohort_state(conn, batch)
+
+    if not batch.empty:
+        # Повторное применение идемпотентно, поэтому отметка после коммита состояния безопасна
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO cohort_applied_orders (order_id) VALUES (?)",
+                ((order_id,) for order_id in batch['order_id'])
+            )
+    return len(batch), new_pairs
+
+
+def counts_from_cells(cells, horizon=None):
+    """
+    Densify sparse (cohort_period, age, customers) cells into
+    (cohort_periods, counts) as returned by build_cohort_matrix.
+    """
+    if horizon is not None:
+        cells = cells[cells['age'] <= horizon]
+    if cells.empty:
+        return np.empty(0, dtype=np.int64), np.zeros((0, 1), dtype=np.int64)
+
+    cohort_periods, cohort_idx = np.unique(cells['cohort_period'].to_numpy(), return_inverse=True)
+    n_ages = int(cells['age'].max()) + 1 if horizon is None else horizon + 1
+
+    counts = np.zeros((len(cohort_periods), n_ages), dtype=np.int64)
+    counts[cohort_idx, cells['age'].to_numpy()] = cells['customers'].to_numpy()
+
+    has_cohort = counts[:, 0] > 0
+    return cohort_periods[has_cohort], counts[has_cohort]
+
+
+def load_cohort_counts(conn, horizon=None):
+    """Dense cohort x age count matrix read from the cohort_activity state table."""
+    cells = read_sql(
+        "SELECT cohort_period, active_period - cohort_period AS age, customers FROM cohort_activity",
+        conn
+    )
+    return counts_from_cells(cells, horizon)
+
+
+def retention_from_state(conn, horizon=RETENTION_HORIZON):
+    """Monthly retention table and matrix regenerated from the state tables only."""
+    cohort_periods, counts = load_cohort_counts(conn, horizon)
+    if len(cohort_periods) == 0:
+        return pd.DataFrame(), pd.DataFrame()
+    return retention_from_counts(cohort_periods, counts, horizon, 'month')
+
+
+def plot_cohort_retention(retention_rates, output_path, granularity=GRANULARITY):
     """Plot cohort retention heatmap"""
+    import matplotlib.pyplot as plt
+
     plt.figure(figsize=(12, 8))
 
     # Матрица удержания
@@ -87,8 +373,9 @@ def plot_cohort_retention(retention_rates, output_path):
 
     # Подписи осей
     plt.title('Cohort Retention Analysis', fontsize=16, pad=20)
-    plt.xlabel('Months After Cohort', fontsize=12)
-    plt.ylabel('Cohort Month', fontsize=12)
+    unit = granularity.capitalize()
+    plt.xlabel(f'{unit}s After Cohort', fontsize=12)
+    plt.ylabel(f'Cohort {unit}', fontsize=12)
 
     # Подписи значений
     for i in range(len(data_to_plot)):
@@ -111,25 +398,26 @@ def check_repeat_customers(conn):
     """Check if customers make repeat purchases"""
     query = """
     SELECT 
-        customer_id,
-        COUNT(DISTINCT DATE(order_purchase_timestamp)) as purchase_days,
-        COUNT(DISTINCT order_id) as orders_count,
-        MIN(DATE(order_purchase_timestamp)) as first_purchase,
-        MAX(DATE(order_purchase_timestamp)) as last_purchase
-    FROM fact_orders
-    WHERE order_status NOT IN ('cancelled', 'unavailable')
-    GROUP BY customer_id
-    HAVING COUNT(DISTINCT order_id) > 1
+        c.customer_unique_id,
+        COUNT(DISTINCT DATE(o.order_purchase_timestamp)) as purchase_days,
+        COUNT(DISTINCT o.order_id) as orders_count,
+        MIN(DATE(o.order_purchase_timestamp)) as first_purchase,
+        MAX(DATE(o.order_purchase_timestamp)) as last_purchase
+    FROM fact_orders o
+    JOIN dim_customers c ON o.customer_id = c.customer_id
+    WHERE o.order_status NOT IN ('cancelled', 'unavailable')
+    GROUP BY c.customer_unique_id
+    HAVING COUNT(DISTINCT o.order_id) > 1
     ORDER BY orders_count DESC
     LIMIT 10
     """
-    repeat_customers = pd.read_sql_query(query, conn)
+    repeat_customers = read_sql(query, conn)
     return repeat_customers
 
 
 def main():
     """Main function to calculate and display cohort retention"""
-    conn = sqlite3.connect(DB)
+    conn = connect(DB)
 
     print("=" * 60)
     print("COHORT RETENTION ANALYSIS")
@@ -146,8 +434,13 @@ def main():
         print("   ⚠️  NO REPEAT CUSTOMERS FOUND!")
         print("   This explains why retention is 0%")
 
-    # Вычисляем удержание
-    cohort_df, retention_matrix = calculate_cohort_retention(conn)
+    # Обновляем состояние когорт только новыми заказами и считаем удержание по нему
+    if GRANULARITY == 'month':
+        batch_size, new_pairs = refresh_cohort_state(conn)
+        print(f"\n🔄 Cohort state updated: {batch_size} orders read, {new_pairs} new customer-months")
+        cohort_df, retention_matrix = retention_from_state(conn)
+    else:
+        cohort_df, retention_matrix = calculate_cohort_retention(conn)
 
     if cohort_df.empty:
         print("No data available for cohort analysis")
@@ -158,25 +451,25 @@ def main():
     print("\n📊 COHORT RETENTION RATES:")
     print("-" * 60)
 
+    retention_cols = [col for col in cohort_df.columns if col.startswith('retention_')]
+
     # Заменяем NaN на 0% для наглядности
     display_df = cohort_df.copy()
-    for col in ['retention_month_1', 'retention_month_2', 'retention_month_3']:
+    for col in retention_cols:
         display_df[col] = display_df[col].fillna(0)
 
     print(display_df.to_string(index=False))
 
     # Ключевые метрики
-    avg_retention_m1 = cohort_df['retention_month_1'].mean(skipna=True)
-    avg_retention_m2 = cohort_df['retention_month_2'].mean(skipna=True)
-    avg_retention_m3 = cohort_df['retention_month_3'].mean(skipna=True)
+    avg_retention = {col: cohort_df[col].mean(skipna=True) for col in retention_cols}
 
     print("\n📈 AVERAGE RETENTION RATES:")
-    print(f"  Month 1: {avg_retention_m1:.2f}%")
-    print(f"  Month 2: {avg_retention_m2:.2f}%")
-    print(f"  Month 3: {avg_retention_m3:.2f}%")
+    for col, value in avg_retention.items():
+        age = col.rsplit('_', 1)[-1]
+        print(f"  {GRANULARITY.capitalize()} {age}: {value:.2f}%")
 
     # Проверяем, есть ли вообще данные для удержания
-    if avg_retention_m1 == 0 and avg_retention_m2 == 0 and avg_retention_m3 == 0:
+    if all(value == 0 for value in avg_retention.values()):
         print("\n⚠️  WARNING: All retention rates are 0%")
         print("   Possible reasons:")
         print("   1. No repeat customers in dataset")
@@ -187,9 +480,15 @@ def main():
     cohort_df.to_csv(OUT_DATA, index=False)
     print(f"\n💾 Data saved to: {OUT_DATA}")
 
+    # Таблица для постраничного вывода в дашборде
+    cohort_df.to_sql("mart_cohort_retention", conn, if_exists="replace", index=False)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_mart_cohort_retention_cohort "
+                 f"ON mart_cohort_retention(cohort_{GRANULARITY})")
+    conn.commit()
+
     # Строим график (если есть данные)
     if not retention_matrix.isna().all().all():
-        plot_cohort_retention(retention_matrix.fillna(0), OUT_CHART)
+        plot_cohort_retention(retention_matrix.fillna(0), OUT_CHART, GRANULARITY)
         print(f"📊 Chart saved to: {OUT_CHART}")
 
     conn.close()
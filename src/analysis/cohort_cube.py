@@ -0,0 +1,229 @@
+"""
+Precomputed cohort cube: monthly retention counts for every combination of
+configured customer dimensions (with 'all' rollups), built in one pass over
+the facts and stored in an indexed table, so any retention slice is a keyed
+lookup instead of a rescan of fact_orders.
+"""
+import itertools
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from cohort_analysis import RETENTION_HORIZON, counts_from_cells, retention_from_counts, to_period_index
+from query_log import connect, read_sql
+
+DB = Path(__file__).resolve().parents[2] / "data" / "ecommerce.db"
+
+CUBE_TABLE = "cohort_cube"
+ALL = "all"
+UNKNOWN = "unknown"
+
+# Измерения куба (атрибуты покупателя на момент первой покупки)
+CUBE_DIMENSIONS = ['customer_state', 'first_category', 'value_band']
+
+# Границы диапазонов стоимости первого заказа (R$)
+VALUE_BANDS = [0, 50, 100, 200, 500, np.inf]
+VALUE_BAND_LABELS = ['0-50', '50-100', '100-200', '200-500', '500+']
+
+
+def load_customer_orders(conn):
+    """Non-cancelled orders with customer state, order value and first item category."""
+    orders = read_sql("""
+        SELECT
+            c.customer_unique_id,
+            c.customer_state,
+            o.order_id,
+            o.order_purchase_timestamp,
+            CAST(julianday(o.order_purchase_timestamp) - 2440587.5 AS INTEGER) AS order_day
+        FROM fact_orders o
+        JOIN dim_customers c ON o.customer_id = c.customer_id
+        WHERE o.order_status NOT IN ('cancelled', 'unavailable')
+          AND o.order_purchase_timestamp IS NOT NULL
+    """, conn)
+
+    items = read_sql("""
+        SELECT i.order_id, i.order_item_id, i.price + i.freight_value AS item_value, p.product_category_name
+        FROM fact_order_items i
+        LEFT JOIN dim_products p ON i.product_id = p.product_id
+    """, conn)
+
+    order_value = items.groupby('order_id')['item_value'].sum().rename('order_value')
+    first_category = (
+        items.sort_values(['order_id', 'order_item_id'])
+        .drop_duplicates('order_id')
+        .set_index('order_id')['product_category_name']
+        .rename('order_category')
+    )
+    return orders.join(order_value, on='order_id').join(first_category, on='order_id')
+
+
+def customer_attributes(orders):
+    """Per-customer cube dimensions taken from the customer's first order."""
+    first = (
+        orders.sort_values(['customer_unique_id', 'order_purchase_timestamp', 'order_id'])
+        .drop_duplicates('customer_unique_id')
+        .set_index('customer_unique_id')
+    )
+    value_band = pd.cut(first['order_value'], bins=VALUE_BANDS, labels=VALUE_BAND_LABELS, right=False)
+
+    return pd.DataFrame({
+        'customer_state': first['customer_state'],
+        'first_category': first['order_category'],
+        'value_band': value_band.astype(object),
+    }).fillna(UNKNOWN)
+
+
+def build_cohort_cube(orders, dimensions=None):
+    """
+    Count active customers per (dimension values, cohort month, age) for every
+    subset of dimensions rolled up to 'all' (2^d grouping sets).
+    Returns a long DataFrame: dimensions..., cohort_period, age, customers.
+    """
+    dimensions = dimensions or CUBE_DIMENSIONS
+    attrs = customer_attributes(orders)[dimensions]
+
+    customer_codes = attrs.index.get_indexer(orders['customer_unique_id'])
+    periods = to_period_index(orders['order_day'].to_numpy(), 'month')
+
+    # Уникальные пары (покупатель, месяц) и когорта покупателя
+    p_min = periods.min()
+    span = int(periods.max() - p_min) + 1
+    pairs = pd.unique(customer_codes.astype(np.int64) * span + (periods - p_min))
+    pair_customer = pairs // span
+    pair_period = pairs % span
+
+    first_period = np.full(len(attrs), span, dtype=np.int64)
+    np.minimum.at(first_period, pair_customer, pair_period)
+    cohort = first_period[pair_customer]
+    age = pair_period - cohort
+
+    # Коды измерений; код len(levels) означает 'all'
+    dim_codes, dim_levels = [], []
+    for dim in dimensions:
+        codes, levels = pd.factorize(attrs[dim], sort=True)
+        dim_codes.append(codes[pair_customer].astype(np.int64))
+        dim_levels.append(np.append(levels.astype(object), ALL))
+    radices = [len(levels) for levels in dim_levels] + [span, span]
+
+    frames = []
+    for rollup in itertools.product([False, True], repeat=len(dimensions)):
+        key = np.zeros(len(pairs), dtype=np.int64)
+        for codes, levels, rolled in zip(dim_codes, dim_levels, rollup):
+            key = key * len(levels) + (len(levels) - 1 if rolled else codes)
+        key = (key * span + cohort) * span + age
+
+        cell_counts = pd.Series(key).value_counts(sort=False)
+        keys = cell_counts.index.to_numpy()
+
+        decoded = []
+        for radix in reversed(radices):
+            decoded.append(keys % radix)
+            keys = keys // radix
+        decoded.reverse()
+
+        frame = {dim: dim_levels[i][decoded[i]] for i, dim in enumerate(dimensions)}
+        frame['cohort_period'] = decoded[-2] + p_min
+        frame['age'] = decoded[-1]
+        frame['customers'] = cell_counts.to_numpy()
+        frames.append(pd.DataFrame(frame))
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def save_cohort_cube(conn, cube, dimensions=None):
+    """Replace the cube table; the primary key makes every slice a keyed range lookup."""
+    dimensions = dimensions or CUBE_DIMENSIONS
+    key_cols = dimensions + ['cohort_period', 'age']
+    columns = ", ".join(f"{dim} TEXT NOT NULL" for dim in dimensions)
+
+    with conn:
+        conn.execute(f"DROP TABLE IF EXISTS {CUBE_TABLE}")
+        conn.execute(f"""
+            CREATE TABLE {CUBE_TABLE} (
+                {columns},
+                cohort_period INTEGER NOT NULL,
+                age INTEGER NOT NULL,
+                customers INTEGER NOT NULL,
+                PRIMARY KEY ({", ".join(key_cols)})
+            ) WITHOUT ROWID
+        """)
+        placeholders = ", ".join("?" for _ in range(len(key_cols) + 1))
+        conn.executemany(
+            f"INSERT INTO {CUBE_TABLE} VALUES ({placeholders})",
+            cube[key_cols + ['customers']].astype(object).itertuples(index=False, name=None)
+        )
+
+
+def cube_dimension_values(conn, dimensions=None):
+    """Distinct values per dimension (for filter dropdowns), 'all' first."""
+    dimensions = dimensions or CUBE_DIMENSIONS
+    values = {}
+    for dim in dimensions:
+        rows = conn.execute(f"SELECT DISTINCT {dim} FROM {CUBE_TABLE} WHERE {dim} != ? ORDER BY {dim}", (ALL,))
+        levels = [r[0] for r in rows]
+        if dim == 'value_band':
+            order = {label: i for i, label in enumerate(VALUE_BAND_LABELS)}
+            levels.sort(key=lambda label: order.get(label, len(order)))
+        values[dim] = [ALL] + levels
+    return values
+
+
+def _slice_params(dimensions, filters):
+    unknown = set(filters) - set(dimensions)
+    if unknown:
+        raise ValueError(f"Unknown cube dimensions: {sorted(unknown)}")
+    return [filters.get(dim) or ALL for dim in dimensions]
+
+
+def retention_from_cells(cells, horizon=RETENTION_HORIZON):
+    cohort_periods, counts = counts_from_cells(cells, horizon)
+    if len(cohort_periods) == 0:
+        return pd.DataFrame(), pd.DataFrame()
+    return retention_from_counts(cohort_periods, counts, horizon, 'month')
+
+
+def load_cohort_slice(conn, horizon=RETENTION_HORIZON, dimensions=None, **filters):
+    """
+    Retention table and matrix for one slice, e.g.
+    load_cohort_slice(conn, customer_state='SP', value_band='50-100').
+    Unspecified dimensions are taken as 'all'.
+    """
+    dimensions = dimensions or CUBE_DIMENSIONS
+    params = _slice_params(dimensions, filters)
+    where = " AND ".join(f"{dim} = ?" for dim in dimensions)
+    cells = read_sql(
+        f"SELECT cohort_period, age, customers FROM {CUBE_TABLE} WHERE {where}",
+        conn, params=params
+    )
+    return retention_from_cells(cells, horizon)
+
+
+def cohort_slice_from_cube(cube, horizon=RETENTION_HORIZON, dimensions=None, **filters):
+    """load_cohort_slice over an in-memory copy of the cube table (dashboard snapshot)."""
+    dimensions = dimensions or CUBE_DIMENSIONS
+    params = _slice_params(dimensions, filters)
+    mask = np.ones(len(cube), dtype=bool)
+    for dim, value in zip(dimensions, params):
+        mask &= (cube[dim] == value).to_numpy()
+    return retention_from_cells(cube.loc[mask, ['cohort_period', 'age', 'customers']], horizon)
+
+
+def main():
+    conn = connect(DB)
+
+    orders = load_customer_orders(conn)
+    if orders.empty:
+        print("No orders in DB — run ETL first.")
+        conn.close()
+        return
+
+    cube = build_cohort_cube(orders)
+    save_cohort_cube(conn, cube)
+    print(f"{CUBE_TABLE} created: {len(cube)} rows, dimensions: {', '.join(CUBE_DIMENSIONS)}")
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,224 @@
-import sqlite3
-import pandas as pd
 from pathlib import Path
 
+import pandas as pd
+
+from partitions import CATALOG_TABLE, UNDATED_KEY, read_range
+from query_log import connect, read_sql
+from sketches import build_group_sketches
+
 DB_PATH = Path(__file__).resolve().parents[2] / "data" / "ecommerce.db"
 
+# Хэши партиций, из которых собраны витрины по дате покупки
+MART_STATE_TABLE = "mart_partition_state"
+DIMENSIONS_KEY = "_dimensions"
+DATE_MARTS = ["mart_daily_category", "mart_daily_category_state", "mart_weekly_city"]
 
-def create_daily_category_mart(conn):
-    query = """
-    SELECT 
-        DATE(o.order_purchase_timestamp) AS order_date,
-        p.product_category_name,
-        COUNT(DISTINCT o.order_id) AS orders_count,
-        COUNT(DISTINCT o.customer_id) AS customers_count,
-        SUM(i.price + i.freight_value) AS revenue,
-        COUNT(i.order_item_id) AS items_count,
-        AVG(i.price + i.freight_value) AS avg_order_value
-    FROM fact_orders o
-    JOIN fact_order_items i ON o.order_id = i.order_id
-    JOIN dim_products p ON i.product_id = p.product_id
-    WHERE p.product_category_name IS NOT NULL
-    GROUP BY DATE(o.order_purchase_timestamp), p.product_category_name
-    ORDER BY order_date DESC, revenue DESC
+# Детализация витрин: {orders} / {items} — fact_orders или партиции периода
+DAILY_CATEGORY_DETAIL = """
+SELECT 
+    DATE(o.order_purchase_timestamp) AS order_date,
+    p.product_category_name,
+    o.order_id,
+    c.customer_unique_id AS customer_key,
+    i.price + i.freight_value AS item_value
+FROM {orders} o
+JOIN dim_customers c ON o.customer_id = c.customer_id
+JOIN {items} i ON o.order_id = i.order_id
+JOIN dim_products p ON i.product_id = p.product_id
+WHERE p.product_category_name IS NOT NULL
+  AND {in_range}
+"""
+
+DAILY_CATEGORY_STATE_DETAIL = """
+SELECT 
+    DATE(o.order_purchase_timestamp) AS order_date,
+    p.product_category_name,
+    c.customer_state,
+    o.order_id,
+    c.customer_unique_id AS customer_key,
+    i.price + i.freight_value AS item_value
+FROM {orders} o
+JOIN dim_customers c ON o.customer_id = c.customer_id
+JOIN {items} i ON o.order_id = i.order_id
+JOIN dim_products p ON i.product_id = p.product_id
+WHERE p.product_category_name IS NOT NULL
+  AND c.customer_state IS NOT NULL
+  AND {in_range}
+"""
+
+WEEKLY_CITY_DETAIL = """
+SELECT 
+    DATE(o.order_purchase_timestamp, 'weekday 0', '-6 days') AS week_start,
+    c.customer_city,
+    o.order_id,
+    c.customer_unique_id AS customer_key,
+    i.price + i.freight_value AS item_value
+FROM {orders} o
+JOIN dim_customers c ON o.customer_id = c.customer_id
+JOIN {items} i ON o.order_id = i.order_id
+WHERE c.customer_city IS NOT NULL
+  AND {in_range}
+"""
+
+
+def aggregate_detail(detail, keys, with_counts=True):
+    """
+    Mart rows from one item-level detail pass: detail holds the mart keys,
+    order_id, customer_key and item_value (price + freight) per order item.
+    revenue / items_count / avg_order_value and the orders_hll / customers_hll
+    sketches come from the same groups; with_counts adds orders_count /
+    customers_count as the sketch estimates, i.e. what hll_count returns
+    for the row, so no COUNT(DISTINCT) pass is needed.
     """
-    df = pd.read_sql_query(query, conn)
-    df.to_sql("mart_daily_category", conn, if_exists="replace", index=False)
-    print(f"mart_daily_category created: {len(df)} rows")
+    grouped = detail.groupby(keys, sort=True, dropna=False)
+    codes = grouped.ngroup().to_numpy()
+    mart = grouped['item_value'].agg(revenue='sum', items_count='size', avg_order_value='mean').reset_index()
 
+    mart['orders_hll'], orders_count = build_group_sketches(codes, detail['order_id'], len(mart), return_counts=True)
+    mart['customers_hll'], customers_count = build_group_sketches(codes, detail['customer_key'], len(mart), return_counts=True)
+    if with_counts:
+        mart['orders_count'] = orders_count
+        mart['customers_count'] = customers_count
+    return mart
 
-def create_weekly_city_mart(conn):
-    query = """
-    SELECT 
-        DATE(o.order_purchase_timestamp, 'weekday 0', '-6 days') AS week_start,
-        c.customer_city,
-        COUNT(DISTINCT o.order_id) AS orders_count,
-        COUNT(DISTINCT c.customer_unique_id) AS customers_count,
-        SUM(i.price + i.freight_value) AS revenue,
-        AVG(i.price + i.freight_value) AS avg_order_value,
-        COUNT(i.order_item_id) AS items_count
-    FROM fact_orders o
-    JOIN dim_customers c ON o.customer_id = c.customer_id
-    JOIN fact_order_items i ON o.order_id = i.order_id
-    WHERE c.customer_city IS NOT NULL
-    GROUP BY week_start, c.customer_city
-    ORDER BY week_start DESC, revenue DESC
+
+def mart_detail(conn, sql, start=None, end=None):
+    """Detail rows of sql over the whole fact tables, or over the partitions of [start, end)."""
+    if start is None and end is None:
+        return read_sql(sql.format(orders="fact_orders", items="fact_order_items", in_range="1 = 1"), conn)
+    return read_range(conn, sql, start, end)
+
+
+def dimensions_fingerprint(conn):
+    """Hash of the dimension columns the date-keyed marts use."""
+    dims = [
+        read_sql("SELECT customer_id, customer_unique_id, customer_city, customer_state "
+                 "FROM dim_customers ORDER BY customer_id", conn),
+        read_sql("SELECT product_id, product_category_name FROM dim_products ORDER BY product_id", conn),
+    ]
+    return "/".join(f"{len(df)}:{int(pd.util.hash_pandas_object(df, index=False).sum()) & 0xFFFFFFFFFFFFFFFF:016x}"
+                    for df in dims)
+
+
+def partition_state(conn):
     """
-    df = pd.read_sql_query(query, conn)
-    df.to_sql("mart_weekly_city", conn, if_exists="replace", index=False)
-    print(f"mart_weekly_city created: {len(df)} rows")
+    {partition_key: content_hash} of the partition catalog plus the dimensions
+    fingerprint; None when the ETL has not written partitions.
+    """
+    if conn.execute(f"SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = '{CATALOG_TABLE}'").fetchone() is None:
+        return None
+    state = dict(conn.execute(f"SELECT partition_key, content_hash FROM {CATALOG_TABLE}").fetchall())
+    state[DIMENSIONS_KEY] = dimensions_fingerprint(conn)
+    return state
+
+
+def plan_refresh(conn, state):
+    """
+    Purchase-month spans [start, end) whose partitions changed since the marts
+    were built, or None when the date-keyed marts need a full rebuild (a mart
+    or the partition state is missing, the dimensions or undated orders changed).
+    """
+    if state is None:
+        return None
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if not set(DATE_MARTS + [MART_STATE_TABLE]) <= existing:
+        return None
+    built = dict(conn.execute(f"SELECT partition_key, content_hash FROM {MART_STATE_TABLE}").fetchall())
+    changed = sorted(key for key in set(state) | set(built) if state.get(key) != built.get(key))
+    if DIMENSIONS_KEY in changed or UNDATED_KEY in changed:
+        return None
+
+    # Соседние изменённые месяцы сливаются в один период
+    spans = []
+    for key in changed:
+        start = pd.Timestamp(f"{key}-01")
+        end = start + pd.DateOffset(months=1)
+        if spans and spans[-1][1] == start:
+            spans[-1][1] = end
+        else:
+            spans.append([start, end])
+    return [(start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')) for start, end in spans]
+
+
+def record_partition_state(conn, state):
+    with conn:
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {MART_STATE_TABLE} "
+                     f"(partition_key TEXT PRIMARY KEY, content_hash TEXT NOT NULL)")
+        conn.execute(f"DELETE FROM {MART_STATE_TABLE}")
+        conn.executemany(f"INSERT INTO {MART_STATE_TABLE} VALUES (?, ?)", sorted(state.items()))
+
+
+def week_span(start, end):
+    """Whole weeks (Monday-based, as week_start) covering purchase dates [start, end)."""
+    first = pd.Timestamp(start)
+    last = pd.Timestamp(end) - pd.Timedelta(days=1)
+    first -= pd.Timedelta(days=first.weekday())
+    last += pd.Timedelta(days=7 - last.weekday())
+    return first.strftime('%Y-%m-%d'), last.strftime('%Y-%m-%d')
+
+
+def write_mart(conn, table, build, detail_sql, date_column, spans=None):
+    """
+    Full rebuild of a date-keyed mart (spans=None) or replacement of its rows
+    in each [start, end) span of date_column, re-aggregated from the partitions.
+    """
+    if spans is None:
+        df = build(mart_detail(conn, detail_sql))
+        df.to_sql(table, conn, if_exists="replace", index=False)
+        print(f"{table} created: {len(df)} rows")
+        return
+
+    rows = 0
+    for start, end in spans:
+        df = build(mart_detail(conn, detail_sql, start, end))
+        # DELETE и вставка to_sql фиксируются одним коммитом
+        conn.execute(f"DELETE FROM {table} WHERE {date_column} >= ? AND {date_column} < ?", (start, end))
+        df.to_sql(table, conn, if_exists="append", index=False)
+        rows += len(df)
+    print(f"{table} refreshed: {rows} rows in {len(spans)} periods")
+
+
+def create_daily_category_mart(conn, spans=None):
+    keys = ['order_date', 'product_category_name']
+
+    def build(detail):
+        df = aggregate_detail(detail, keys)
+        return df.sort_values(['order_date', 'revenue'], ascending=False)[
+            keys + ['orders_count', 'customers_count', 'revenue', 'items_count', 'avg_order_value',
+                    'orders_hll', 'customers_hll']
+        ]
+
+    write_mart(conn, "mart_daily_category", build, DAILY_CATEGORY_DETAIL, 'order_date', spans)
+
+
+def create_daily_category_state_mart(conn, spans=None):
+    """Daily revenue by category and customer state — backs the dashboard filters."""
+    keys = ['order_date', 'product_category_name', 'customer_state']
+
+    def build(detail):
+        df = aggregate_detail(detail, keys, with_counts=False)
+        return df[keys + ['revenue', 'items_count', 'orders_hll', 'customers_hll']]
+
+    write_mart(conn, "mart_daily_category_state", build, DAILY_CATEGORY_STATE_DETAIL, 'order_date', spans)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_mart_dcs_date ON mart_daily_category_state(order_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_mart_dcs_category ON mart_daily_category_state(product_category_name, order_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_mart_dcs_state ON mart_daily_category_state(customer_state, order_date)")
+    conn.commit()
+
+
+def create_weekly_city_mart(conn, spans=None):
+    keys = ['week_start', 'customer_city']
+
+    def build(detail):
+        df = aggregate_detail(detail, keys)
+        return df.sort_values(['week_start', 'revenue'], ascending=False)[
+            keys + ['orders_count', 'customers_count', 'revenue', 'avg_order_value', 'items_count',
+                    'orders_hll', 'customers_hll']
+        ]
+
+    # Неделя может захватывать соседний месяц — пересчитываются недели целиком
+    write_mart(conn, "mart_weekly_city", build, WEEKLY_CITY_DETAIL, 'week_start',
+               None if spans is None else [week_span(start, end) for start, end in spans])
 
 
 def create_product_performance_mart(conn):
@@ -67,7 +239,7 @@ def create_product_performance_mart(conn):
     GROUP BY p.product_id, p.product_category_name
     ORDER BY total_revenue DESC
     """
-    df = pd.read_sql_query(query, conn)
+    df = read_sql(query, conn)
     df.to_sql("mart_product_performance", conn, if_exists="replace", index=False)
     print(f"mart_product_performance created: {len(df)} rows")
 
@@ -79,27 +251,42 @@ def create_delivery_analysis_mart(conn):
         p.product_category_name,
         COUNT(o.order_id) AS orders_count,
         AVG(o.delivery_time_days) AS avg_delivery_days,
-        SUM(CASE WHEN o.delivery_time_days > 30 THEN 1 ELSE 0 END) * 100.0 / COUNT(o.order_id) AS late_delivery_percent
+        SUM(o.is_late) * 100.0 / COUNT(o.order_id) AS late_delivery_percent
     FROM fact_orders o
     JOIN dim_customers c ON o.customer_id = c.customer_id
     JOIN fact_order_items i ON o.order_id = i.order_id
     JOIN dim_products p ON i.product_id = p.product_id
-    WHERE o.delivery_time_days IS NOT NULL 
+    WHERE o.is_delivered = 1
       AND c.customer_city IS NOT NULL 
       AND p.product_category_name IS NOT NULL
     GROUP BY c.customer_city, p.product_category_name
     ORDER BY orders_count DESC
     """
-    df = pd.read_sql_query(query, conn)
+    df = read_sql(query, conn)
     df.to_sql("mart_delivery_analysis", conn, if_exists="replace", index=False)
+    # Индексы под серверную сортировку / фильтрацию таблицы в дашборде
+    for column in ['customer_city', 'product_category_name', 'orders_count',
+                   'avg_delivery_days', 'late_delivery_percent']:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_mart_delivery_analysis_{column} "
+                     f"ON mart_delivery_analysis({column})")
+    conn.commit()
     print(f"mart_delivery_analysis created: {len(df)} rows")
 
 def main():
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = connect(DB_PATH)
 
-        create_daily_category_mart(conn)
-        create_weekly_city_mart(conn)
+        # Витрины по дате покупки: пересчитываются только изменившиеся месяцы
+        state = partition_state(conn)
+        spans = plan_refresh(conn, state)
+        if spans == []:
+            print("Date-keyed marts are up to date")
+        else:
+            create_daily_category_mart(conn, spans)
+            create_daily_category_state_mart(conn, spans)
+            create_weekly_city_mart(conn, spans)
+            if state is not None:
+                record_partition_state(conn, state)
         create_product_performance_mart(conn)
         create_delivery_analysis_mart(conn)
 
@@ -1,36 +1,72 @@
+import os
 import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+import numpy as np
 import pandas as pd
-from dash import Dash, dcc, html, Input, Output
+from dash import Dash, dash_table, dcc, html, Input, Output, State, MATCH, ctx, no_update
+from flask import jsonify
 import plotly.express as px
 from pathlib import Path
 
+from downsampling import downsample_series
+from metric_registry import compute_metrics
+from metric_snapshots import metric_history
+from paged_tables import frame_page, query_page, table_columns
+from query_log import connect, read_sql, top_statements
+from sketches import register_sketch_functions
+from cohort_cube import ALL, CUBE_DIMENSIONS, cohort_slice_from_cube, cube_dimension_values, load_cohort_slice
+from dashboard_snapshot import open_snapshot
+
 DB_PATH = Path(__file__).resolve().parents[2] / "data" / "ecommerce.db"
+DOCS_DIR = Path(__file__).resolve().parents[2] / "docs"
+
+# Как часто фоновый поток проверяет, изменилось ли хранилище (секунды)
+REFRESH_SECONDS = 30
+
+SALES_FILTER_MART = "mart_daily_category_state"
+FIGURE_CACHE_SIZE = 256
+SERIES_CACHE_SIZE = 64
+LATENCY_WINDOW = 1000
+
+QUERY_WORKERS = 4
+QUERY_TIMEOUT_SECONDS = 10
+# Данные с заглушками вместо упавших запросов кэшируются ненадолго, чтобы следующий запрос повторил попытку
+DEGRADED_TTL_SECONDS = 5
+SALES_KPIS = ['gmv', 'aov', 'total_orders', 'total_customers']
+SALES_KPI_FORMATS = {'gmv': "R${:,.0f}", 'aov': "R${:,.2f}", 'total_orders': "{:,.0f}", 'total_customers': "{:,.0f}"}
+DELIVERY_KPIS = ['avg_delivery_days', 'late_delivery_rate']
+
+PAGE_SIZE = 20
+PAGED_TABLES = {
+    'cohort_retention': {'table': 'mart_cohort_retention', 'title': "Cohort Retention Data",
+                         'source': "cohort_analysis.py"},
+    'sla_results': {'table': 'mart_sla_results', 'title': "SLA by City and Category",
+                    'source': "sla_analysis.py",
+                    'default_sort': [{'column_id': 'total_orders', 'direction': 'desc'}]},
+    'delivery_city_category': {'table': 'mart_delivery_analysis', 'title': "Delivery by City × Category",
+                               'source': "create_marts.py",
+                               'default_sort': [{'column_id': 'orders_count', 'direction': 'desc'}]},
+}
+
+GRANULARITY_TITLES = {'day': 'daily', 'week': 'weekly', 'month': 'monthly'}
+
+# Путь к бандлу dashboard_snapshot.py (или 'latest'): страницы и колбэки без SQL
+SNAPSHOT_ENV = "DASHBOARD_SNAPSHOT"
 
 app = Dash(__name__, title="E-commerce Analytics Dashboard")
 app.config.suppress_callback_exceptions = True
 
 
-def load_sales_data():
-    conn = sqlite3.connect(DB_PATH)
-
-    daily_sales = pd.read_sql("""
-        SELECT order_date, SUM(revenue) as revenue, SUM(orders_count) as orders_count
-        FROM mart_daily_category 
-        WHERE order_date IS NOT NULL
-        GROUP BY order_date
-        ORDER BY order_date
-    """, conn)
-
-    top_categories = pd.read_sql("""
-        SELECT product_category_name, total_revenue as revenue, orders_count
-        FROM mart_product_performance
-        WHERE product_category_name IS NOT NULL
-        ORDER BY total_revenue DESC
-        LIMIT 15
-    """, conn)
-
-    city_sales = pd.read_sql("""
-        SELECT customer_city, SUM(revenue) as revenue, SUM(orders_count) as orders_count
+def query_city_sales(conn):
+    # orders_count / customers_count через HLL-скетчи: покупатель в нескольких
+    # неделях не считается дважды
+    return read_sql("""
+        SELECT customer_city, SUM(revenue) as revenue,
+               hll_count(orders_hll) as orders_count,
+               hll_count(customers_hll) as customers_count
         FROM mart_weekly_city
         WHERE customer_city IS NOT NULL
         GROUP BY customer_city
@@ -38,167 +74,499 @@ def load_sales_data():
         LIMIT 15
     """, conn)
 
-    overall = pd.read_sql("""
-        SELECT 
-            COUNT(DISTINCT o.order_id) as total_orders,
-            COUNT(DISTINCT o.customer_id) as total_customers,
-            SUM(i.price + i.freight_value) as gmv,
-            AVG(i.price + i.freight_value) as aov
-        FROM fact_orders o
-        JOIN fact_order_items i ON o.order_id = i.order_id
-    """, conn)
-
-    delivery = pd.read_sql("""
-        SELECT 
-            AVG(delivery_time_days) as avg_delivery_days,
-            SUM(CASE WHEN delivery_time_days > 30 THEN 1 ELSE 0 END) * 100.0 / COUNT(*) as late_delivery_rate
-        FROM fact_orders
-        WHERE delivery_time_days IS NOT NULL
-    """, conn)
 
-    conn.close()
+def load_sales_data():
+    # Независимые запросы выполняются параллельно; медленный или упавший
+    # запрос заменяется заглушкой и портит только свою панель
+    results, timings = fan_out({
+        'city_sales': (query_city_sales, pd.DataFrame(columns=['customer_city', 'revenue'])),
+        'sales_filters': (load_sales_filter_options, {}),
+        # KPI — из единого реестра метрик (одно сканирование на грейн, кэш по версии данных)
+        'sales_kpis': (lambda conn: compute_metrics(conn, SALES_KPIS), {}),
+        'delivery_kpis': (lambda conn: compute_metrics(conn, DELIVERY_KPIS), {}),
+        # Тренд KPI — из сохранённых снимков запусков, без пересчёта по истории
+        'gmv_history': (lambda conn: metric_history(conn, 'gmv', per_watermark=True), pd.DataFrame()),
+    })
 
     return {
-        'daily_sales': daily_sales,
-        'top_categories': top_categories,
-        'city_sales': city_sales,
-        'overall': overall,
-        'delivery': delivery
+        'city_sales': results['city_sales'],
+        'metrics': {**results['sales_kpis'], **results['delivery_kpis']},
+        'gmv_history': results['gmv_history'],
+        'sales_filters': results['sales_filters'],
+        'degraded': sorted(name for name, timing in timings.items() if timing['status'] != 'ok'),
     }
 
-def load_cohort_data():
+
+def connect_readonly():
+    conn = connect(f"{DB_PATH.as_uri()}?mode=ro", uri=True, check_same_thread=False)
+    register_sketch_functions(conn)
+    return conn
+
+
+def _run_query(name, query, conns, durations):
+    started = time.perf_counter()
+    conn = connect_readonly()
+    conns[name] = conn
     try:
-        cohort_df = pd.read_csv(Path(__file__).resolve().parents[2] / "docs" / "cohort_retention_data.csv")
-        return cohort_df
-    except:
-        return pd.DataFrame()
+        return query(conn)
+    finally:
+        conn.close()
+        durations[name] = time.perf_counter() - started
+        query_stats.record(name, durations[name])
+
+
+def fan_out(queries, timeout=QUERY_TIMEOUT_SECONDS):
+    """
+    Run {name: (query(conn), fallback)} concurrently, each on its own
+    read-only connection. A query that fails or is still running at the
+    deadline is interrupted and replaced by its fallback.
+    Returns ({name: result}, {name: {'ms': ..., 'status': 'ok' | 'timeout' | 'error'}}).
+    """
+    started = time.perf_counter()
+    deadline = started + timeout
+    conns, durations = {}, {}
+    futures = {name: query_pool.submit(_run_query, name, query, conns, durations)
+               for name, (query, _) in queries.items()}
+
+    results, timings = {}, {}
+    for name, future in futures.items():
+        fallback = queries[name][1]
+        try:
+            results[name] = future.result(timeout=max(deadline - time.perf_counter(), 0))
+            status = 'ok'
+        except FutureTimeout:
+            # Ещё в очереди — отменяем; уже выполняется — прерываем запрос SQLite
+            if not future.cancel() and name in conns:
+                try:
+                    conns[name].interrupt()
+                except sqlite3.ProgrammingError:
+                    pass
+            results[name], status = fallback, 'timeout'
+        except Exception as e:
+            # Любая ошибка запроса (SQL, pandas, код построения) — заглушка только для этой панели
+            results[name], status = fallback, 'error'
+            print(f"Dashboard query {name} failed: {e}")
+        elapsed = durations.get(name, time.perf_counter() - started)
+        timings[name] = {'ms': round(elapsed * 1000, 2), 'status': status}
+        query_status[name] = status
+
+    return results, timings
+
+
+def load_sales_filter_options(conn):
+    """Date bounds, categories and states of the filter mart ({} if it is not built)."""
+    try:
+        min_date, max_date = conn.execute(
+            f"SELECT MIN(order_date), MAX(order_date) FROM {SALES_FILTER_MART}"
+        ).fetchone()
+        categories = [r[0] for r in conn.execute(
+            f"SELECT DISTINCT product_category_name FROM {SALES_FILTER_MART} ORDER BY 1")]
+        states = [r[0] for r in conn.execute(
+            f"SELECT DISTINCT customer_state FROM {SALES_FILTER_MART} ORDER BY 1")]
+    except sqlite3.OperationalError:
+        return {}
+    return {'min_date': min_date, 'max_date': max_date, 'categories': categories, 'states': states}
+
+
+def load_table_columns():
+    """Columns of every paged table ({} entry for tables not built yet)."""
+    conn = connect_readonly()
+    try:
+        return {name: table_columns(conn, spec['table']) for name, spec in PAGED_TABLES.items()}
+    finally:
+        conn.close()
 
 
-def load_sla_data():
+def load_cohort_filters():
+    """Dropdown options for the cohort cube dimensions ({} if the cube is not built)."""
+    conn = connect_readonly()
     try:
-        sla_df = pd.read_csv(Path(__file__).resolve().parents[2] / "docs" / "sla_analysis_results.csv")
-        return sla_df
-    except:
-        return pd.DataFrame()
+        return cube_dimension_values(conn)
+    except sqlite3.OperationalError:
+        return {}
+    finally:
+        conn.close()
+
+
+def format_kpi(metrics, name, fmt):
+    """KPI card value; a dash when its query timed out or failed."""
+    return fmt.format(metrics[name]) if name in metrics else "—"
+
+
+def render_retention_table(df):
+    return html.Table([
+        html.Thead(html.Tr([html.Th(col) for col in df.columns])),
+        html.Tbody([
+            html.Tr([html.Td(value) for value in row])
+            for row in df.itertuples(index=False, name=None)
+        ])
+    ], style={'width': '100%', 'borderCollapse': 'collapse'})
+
+
+def paged_table(name, columns):
+    """DataTable whose paging, sorting and filtering are answered by update_paged_table."""
+    if not columns:
+        return html.P(f"{PAGED_TABLES[name]['title']}: run {PAGED_TABLES[name]['source']} first.",
+                      style={'color': '#666', 'fontStyle': 'italic'})
+    return html.Div([
+        html.H3(PAGED_TABLES[name]['title']),
+        dash_table.DataTable(
+            id={'type': 'paged-table', 'name': name},
+            columns=[{'name': col, 'id': col} for col in columns],
+            page_action='custom', page_current=0, page_size=PAGE_SIZE,
+            sort_action='custom', sort_mode='multi', sort_by=[],
+            filter_action='custom', filter_query='',
+            style_table={'overflowX': 'auto'},
+        ),
+    ], style={'marginTop': '20px', 'padding': '20px', 'background': '#f5f5f5'})
+
+
+class DataCache:
+    """
+    In-process cache of page data keyed on the warehouse version: SQLite
+    PRAGMA data_version (changes when another connection, e.g. the ETL,
+    commits) plus the mtimes of the CSV outputs. Entries are loaded on first
+    use; a background thread reloads the loaded entries when the version
+    changes, so page loads are served from memory and stay fresh.
+    Degraded entries (a fan_out query fell back, or an entry built from such
+    data) expire after DEGRADED_TTL_SECONDS whatever the version. A key is
+    loaded by one thread at a time; concurrent callers wait for its result.
+    """
+
+    def __init__(self, loaders, csv_paths, refresh_seconds=REFRESH_SECONDS):
+        self.loaders = loaders
+        self.csv_paths = csv_paths
+        self.refresh_seconds = refresh_seconds
+        self._entries = {}
+        self._building = {}
+        self._lock = threading.Lock()
+        self._version_conn = None
+        self._refresher = None
+        self._local = threading.local()
+
+    def version(self):
+        with self._lock:
+            if self._version_conn is None:
+                # Только чтение: дашборд не должен создавать пустой ecommerce.db
+                self._version_conn = sqlite3.connect(f"{DB_PATH.as_uri()}?mode=ro", uri=True,
+                                                     check_same_thread=False)
+            data_version = self._version_conn.execute("PRAGMA data_version").fetchone()[0]
+        mtimes = tuple(path.stat().st_mtime_ns if path.exists() else None for path in self.csv_paths)
+        return data_version, mtimes
+
+    @staticmethod
+    def _is_fresh(entry, version):
+        return entry is not None and entry[0] == version and (entry[2] is None or time.monotonic() < entry[2])
+
+    def get(self, key):
+        self.start_refresher()
+        version = self.version()
+        entry = self._entries.get(key)
+        if not self._is_fresh(entry, version):
+            entry = self._load(key, version)
+        if entry[2] is not None:
+            # Страница, собранная из неполных данных, тоже неполная
+            building = getattr(self._local, 'degraded', [])
+            building[:] = [True] * len(building)
+        return entry[1]
+
+    def _load(self, key, version):
+        # Один загрузчик на ключ: запросы страниц и фоновый поток не грузят одно и то же параллельно
+        with self._lock:
+            key_lock = self._building.setdefault(key, threading.Lock())
+        with key_lock:
+            entry = self._entries.get(key)
+            if self._is_fresh(entry, version):
+                return entry
+
+            building = self._local.__dict__.setdefault('degraded', [])
+            building.append(False)
+            try:
+                value = self.loaders[key]()
+            finally:
+                degraded = building.pop()
+            if degraded or (isinstance(value, dict) and value.get('degraded')):
+                entry = (version, value, time.monotonic() + DEGRADED_TTL_SECONDS)
+            else:
+                entry = (version, value, None)
+            with self._lock:
+                self._entries[key] = entry
+        return entry
+
+    def refresh(self):
+        """Reload every loaded entry whose version is stale or whose degraded value expired."""
+        version = self.version()
+        for key, entry in list(self._entries.items()):
+            if not self._is_fresh(entry, version):
+                self._load(key, version)
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_seconds)
+            try:
+                self.refresh()
+            except (sqlite3.Error, pd.errors.DatabaseError, OSError) as e:
+                print(f"Dashboard data refresh failed: {e}")
+
+    def start_refresher(self):
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_loop, name="dashboard-refresh", daemon=True)
+            self._refresher.start()
+
+
+class LRUCache:
+    """Thread-safe LRU cache (figure JSON, filtered series) keyed on normalized parameters."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._building = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key, count):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            if count:
+                if value is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            return value
+
+    def get(self, key):
+        return self._lookup(key, count=True)
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def get_or_build(self, key, build):
+        """
+        Cached value or build() under a per-key lock: concurrent requests for
+        the same missing key wait for one build instead of repeating it
+        (and count as hits).
+        """
+        value = self._lookup(key, count=False)
+        if value is None:
+            with self._lock:
+                key_lock = self._building.setdefault(key, threading.Lock())
+            with key_lock:
+                value = self._lookup(key, count=True)
+                if value is None:
+                    value = build()
+                    self.put(key, value)
+            with self._lock:
+                self._building.pop(key, None)
+            return value
+
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._items),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+class LatencyStats:
+    """Latency samples per callback / query (last LATENCY_WINDOW calls)."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            self._samples.setdefault(name, deque(maxlen=self.window)).append(seconds * 1000)
+
+    def summary(self):
+        with self._lock:
+            samples = {name: np.array(values) for name, values in self._samples.items()}
+        return {
+            name: {
+                'calls': len(ms),
+                'mean_ms': round(float(ms.mean()), 2),
+                'p50_ms': round(float(np.percentile(ms, 50)), 2),
+                'p95_ms': round(float(np.percentile(ms, 95)), 2),
+                'max_ms': round(float(ms.max()), 2),
+            }
+            for name, ms in samples.items()
+        }
+
+
+cache = DataCache(
+    loaders={
+        'sales': load_sales_data,
+        'table_columns': load_table_columns,
+        'cohort_filters': load_cohort_filters,
+        # Готовые страницы тоже кэшируются: построение графиков дороже самих запросов
+        'page:/': lambda: build_sales_layout(cache.get('sales')),
+        'page:/cohorts': lambda: build_cohorts_layout(cache.get('table_columns'), cache.get('cohort_filters')),
+        'page:/logistics': lambda: build_logistics_layout(cache.get('sales'), cache.get('table_columns')),
+    },
+    csv_paths=[DOCS_DIR / "cohort_retention_data.csv", DOCS_DIR / "sla_analysis_results.csv"],
+)
+snapshot = open_snapshot(os.environ[SNAPSHOT_ENV]) if os.environ.get(SNAPSHOT_ENV) else None
 
 
-data = load_sales_data()
-cohort_data = load_cohort_data()
-sla_data = load_sla_data()
+def current_version():
+    return snapshot.version if snapshot else cache.version()
 
-sales_layout = html.Div([
-    html.H1("📊 Sales Dashboard", style={'textAlign': 'center'}),
+def build_sales_layout(data):
+    return html.Div([
+        html.H1("📊 Sales Dashboard", style={'textAlign': 'center'}),
 
-    # KPI Cards
-    html.Div([
+        # KPI Cards: за весь период, затем за выбранные даты (update_sales_kpis)
         html.Div([
-            html.H3(f"R${data['overall']['gmv'].iloc[0]:,.0f}"),
-            html.P("GMV (Gross Merchandise Value)")
-        ], style={'background': '#2E86AB', 'color': 'white', 'padding': '20px', 'borderRadius': '10px', 'textAlign': 'center'}),
-
+            html.Div([
+                html.H3(format_kpi(data['metrics'], 'gmv', SALES_KPI_FORMATS['gmv']), id='sales-kpi-gmv'),
+                html.P("GMV (Gross Merchandise Value)")
+            ], style={'background': '#2E86AB', 'color': 'white', 'padding': '20px', 'borderRadius': '10px', 'textAlign': 'center'}),
+
+            html.Div([
+                html.H3(format_kpi(data['metrics'], 'aov', SALES_KPI_FORMATS['aov']), id='sales-kpi-aov'),
+                html.P("AOV (Average Order Value)")
+            ], style={'background': '#A23B72', 'color': 'white', 'padding': '20px', 'borderRadius': '10px', 'textAlign': 'center'}),
+
+            html.Div([
+                html.H3(format_kpi(data['metrics'], 'total_orders', SALES_KPI_FORMATS['total_orders']), id='sales-kpi-total_orders'),
+                html.P("Total Orders")
+            ], style={'background': '#F18F01', 'color': 'white', 'padding': '20px', 'borderRadius': '10px', 'textAlign': 'center'}),
+
+            html.Div([
+                html.H3(format_kpi(data['metrics'], 'total_customers', SALES_KPI_FORMATS['total_customers']), id='sales-kpi-total_customers'),
+                html.P("Unique Customers")
+            ], style={'background': '#C73E1D', 'color': 'white', 'padding': '20px', 'borderRadius': '10px', 'textAlign': 'center'}),
+        ], style={'display': 'flex', 'justifyContent': 'space-around', 'flexWrap': 'wrap', 'gap': '20px', 'margin': '30px 0'}),
+
+        # Фильтры: ответы из mart_daily_category_state через кэш фигур
         html.Div([
-            html.H3(f"R${data['overall']['aov'].iloc[0]:,.2f}"),
-            html.P("AOV (Average Order Value)")
-        ], style={'background': '#A23B72', 'color': 'white', 'padding': '20px', 'borderRadius': '10px', 'textAlign': 'center'}),
-
+            html.Div([
+                html.Label("Order date"),
+                dcc.DatePickerRange(
+                    id='sales-date-range',
+                    min_date_allowed=data['sales_filters'].get('min_date'),
+                    max_date_allowed=data['sales_filters'].get('max_date'),
+                    start_date=data['sales_filters'].get('min_date'),
+                    end_date=data['sales_filters'].get('max_date'),
+                ),
+            ]),
+            html.Div([
+                html.Label("Category"),
+                dcc.Dropdown(id='sales-category', multi=True, placeholder="All categories",
+                             options=[{'label': v, 'value': v} for v in data['sales_filters'].get('categories', [])]),
+            ], style={'flex': '1'}),
+            html.Div([
+                html.Label("Customer state"),
+                dcc.Dropdown(id='sales-state', multi=True, placeholder="All states",
+                             options=[{'label': v, 'value': v} for v in data['sales_filters'].get('states', [])]),
+            ], style={'flex': '1'}),
+        ], style={'display': 'flex', 'gap': '20px', 'alignItems': 'flex-end', 'margin': '20px 0'}),
+
+        # Row 1: Daily trends
         html.Div([
-            html.H3(f"{data['overall']['total_orders'].iloc[0]:,}"),
-            html.P("Total Orders")
-        ], style={'background': '#F18F01', 'color': 'white', 'padding': '20px', 'borderRadius': '10px', 'textAlign': 'center'}),
+            dcc.Graph(id='sales-daily-revenue'),
+            dcc.Graph(id='sales-daily-orders'),
+        ], style={'display': 'flex', 'gap': '20px', 'margin': '20px 0'}),
 
+        # Row 2: Top categories and cities
         html.Div([
-            html.H3(f"{data['overall']['total_customers'].iloc[0]:,}"),
-            html.P("Unique Customers")
-        ], style={'background': '#C73E1D', 'color': 'white', 'padding': '20px', 'borderRadius': '10px', 'textAlign': 'center'}),
-    ], style={'display': 'flex', 'justifyContent': 'space-around', 'flexWrap': 'wrap', 'gap': '20px', 'margin': '30px 0'}),
-
-    # Row 1: Daily trends
-    html.Div([
+            dcc.Graph(id='sales-top-categories'),
+            dcc.Graph(
+                figure=px.bar(
+                    data['city_sales'].head(10),
+                    x='revenue', y='customer_city',
+                    orientation='h',
+                    title='Top 10 Cities by Revenue',
+                    labels={'revenue': 'Revenue (R$)', 'customer_city': 'City'}
+                ).update_layout(height=400, yaxis={'categoryorder': 'total ascending'})
+            ),
+        ], style={'display': 'flex', 'gap': '20px', 'margin': '20px 0'}),
+
+        # Row 3: GMV по снимкам метрик (по одному на водяной знак данных)
         dcc.Graph(
             figure=px.line(
-                data['daily_sales'],
-                x='order_date', y='revenue',
-                title='Daily Revenue Trend',
-                labels={'revenue': 'Revenue (R$)', 'order_date': 'Date'}
-            ).update_layout(height=400)
-        ),
-        dcc.Graph(
-            figure=px.line(
-                data['daily_sales'],
-                x='order_date', y='orders_count',
-                title='Daily Orders Trend',
-                labels={'orders_count': 'Orders', 'order_date': 'Date'}
-            ).update_layout(height=400)
-        ),
-    ], style={'display': 'flex', 'gap': '20px', 'margin': '20px 0'}),
-
-    # Row 2: Top categories and cities
-    html.Div([
-        dcc.Graph(
-            figure=px.bar(
-                data['top_categories'].head(10),
-                x='revenue', y='product_category_name',
-                orientation='h',
-                title='Top 10 Categories by Revenue',
-                labels={'revenue': 'Revenue (R$)', 'product_category_name': 'Category'}
-            ).update_layout(height=400, yaxis={'categoryorder': 'total ascending'})
-        ),
-        dcc.Graph(
-            figure=px.bar(
-                data['city_sales'].head(10),
-                x='revenue', y='customer_city',
-                orientation='h',
-                title='Top 10 Cities by Revenue',
-                labels={'revenue': 'Revenue (R$)', 'customer_city': 'City'}
-            ).update_layout(height=400, yaxis={'categoryorder': 'total ascending'})
-        ),
-    ], style={'display': 'flex', 'gap': '20px', 'margin': '20px 0'}),
-])
+                data['gmv_history'],
+                x='watermark', y='value', markers=True,
+                title='GMV by Data Watermark (metric snapshots)',
+                labels={'value': 'GMV (R$)', 'watermark': 'Data up to'}
+            ).update_layout(height=350)
+        ) if len(data['gmv_history']) > 1 else html.Div(),
+    ])
 
 # Cohorts page layout
-cohorts_layout = html.Div([
-    html.H1("Cohort Analysis", style={'textAlign': 'center'}),
+def build_cohorts_layout(table_columns, cohort_filters):
+    return html.Div([
+        html.H1("Cohort Analysis", style={'textAlign': 'center'}),
 
-    html.Div([
-        html.P("Analysis shows 0% retention as all customers make only one purchase.",
-               style={'textAlign': 'center', 'color': '#666', 'fontStyle': 'italic'})
-    ]),
+        html.Div([
+            html.P("Most Olist customers buy only once, so retention on the public dataset is close to 0%.",
+                   style={'textAlign': 'center', 'color': '#666', 'fontStyle': 'italic'})
+        ]),
 
-    html.Div([
-        html.H3("Cohort Retention Data"),
-        html.Table([
-            html.Thead(html.Tr([html.Th(col) for col in cohort_data.columns])),
-            html.Tbody([
-                html.Tr([html.Td(cohort_data.iloc[i][col]) for col in cohort_data.columns])
-                for i in range(min(len(cohort_data), 10))
-            ])
-        ], style={'width': '100%', 'borderCollapse': 'collapse'})
-    ], style={'marginTop': '20px', 'padding': '20px', 'background': '#f5f5f5'}),
-])
+        paged_table('cohort_retention', table_columns.get('cohort_retention')),
+
+        # Срезы удержания из cohort_cube (ключевой поиск, без сканирования fact_orders)
+        html.Div([
+            html.H3("Retention by Segment"),
+            html.Div([
+                html.Div([
+                    html.Label(dim.replace('_', ' ').title()),
+                    dcc.Dropdown(
+                        id=f'cohort-filter-{dim}',
+                        options=[{'label': v, 'value': v} for v in values],
+                        value=ALL,
+                        clearable=False
+                    )
+                ], style={'flex': '1'})
+                for dim, values in cohort_filters.items()
+            ], style={'display': 'flex', 'gap': '20px', 'marginBottom': '20px'}),
+            html.Div(id='cohort-slice')
+        ], style={'marginTop': '20px', 'padding': '20px', 'background': '#f5f5f5'}) if cohort_filters else html.Div(),
+    ])
 
 # Logistics page layout
-logistics_layout = html.Div([
-    html.H1("Logistics & SLA", style={'textAlign': 'center'}),
+def build_logistics_layout(data, table_columns):
+    return html.Div([
+        html.H1("Logistics & SLA", style={'textAlign': 'center'}),
 
-    # KPI Cards for logistics
-    html.Div([
+        # KPI Cards for logistics
         html.Div([
-            html.H3(f"{data['delivery']['avg_delivery_days'].iloc[0]:.1f}"),
-            html.P("Avg Delivery Days")
-        ], style={'background': '#2E86AB', 'color': 'white', 'padding': '20px', 'borderRadius': '10px', 'textAlign': 'center'}),
-
+            html.Div([
+                html.H3(format_kpi(data['metrics'], 'avg_delivery_days', "{:.1f}")),
+                html.P("Avg Delivery Days")
+            ], style={'background': '#2E86AB', 'color': 'white', 'padding': '20px', 'borderRadius': '10px', 'textAlign': 'center'}),
+
+            html.Div([
+                html.H3(format_kpi(data['metrics'], 'late_delivery_rate', "{:.1f}%")),
+                html.P("Late Delivery Rate (>30 days)")
+            ], style={'background': '#A23B72', 'color': 'white', 'padding': '20px', 'borderRadius': '10px', 'textAlign': 'center'}),
+        ], style={'display': 'flex', 'justifyContent': 'center', 'gap': '40px', 'margin': '30px 0'}),
+
+        # SLA Analysis
         html.Div([
-            html.H3(f"{data['delivery']['late_delivery_rate'].iloc[0]:.1f}%"),
-            html.P("Late Delivery Rate (>30 days)")
-        ], style={'background': '#A23B72', 'color': 'white', 'padding': '20px', 'borderRadius': '10px', 'textAlign': 'center'}),
-    ], style={'display': 'flex', 'justifyContent': 'center', 'gap': '40px', 'margin': '30px 0'}),
+            html.H2("Delivery Analysis"),
+            html.P("Based on data from SLA analysis")
+        ], style={'textAlign': 'center', 'margin': '20px 0'}),
 
-    # SLA Analysis
-    html.Div([
-        html.H2("Delivery Analysis"),
-        html.P("Based on data from SLA analysis")
-    ], style={'textAlign': 'center', 'margin': '20px 0'}),
-])
+        paged_table('sla_results', table_columns.get('sla_results')),
+        paged_table('delivery_city_category', table_columns.get('delivery_city_category')),
+    ])
 
 app.layout = html.Div([
     dcc.Location(id='url', refresh=False),
@@ -215,25 +583,282 @@ app.layout = html.Div([
 ])
 
 
+figure_cache = LRUCache(FIGURE_CACHE_SIZE)
+series_cache = LRUCache(SERIES_CACHE_SIZE)
+callback_stats = LatencyStats()
+query_stats = LatencyStats()
+query_status = {}
+query_pool = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="dashboard-query")
+
+
+def normalize_sales_filters(start_date, end_date, categories, states):
+    """Canonical cache key: ISO dates, sorted de-duplicated selections (empty = all)."""
+    return (
+        str(start_date)[:10] if start_date else None,
+        str(end_date)[:10] if end_date else None,
+        tuple(sorted(set(categories or []))),
+        tuple(sorted(set(states or []))),
+    )
+
+
+def query_filtered_sales(filters):
+    """Daily revenue/orders and revenue by category for one filter combination."""
+    start_date, end_date, categories, states = filters
+    where, params = ["1 = 1"], []
+    if start_date:
+        where.append("order_date >= ?")
+        params.append(start_date)
+    if end_date:
+        where.append("order_date <= ?")
+        params.append(end_date)
+    if categories:
+        where.append(f"product_category_name IN ({', '.join('?' for _ in categories)})")
+        params.extend(categories)
+    if states:
+        where.append(f"customer_state IN ({', '.join('?' for _ in states)})")
+        params.extend(states)
+    where = " AND ".join(where)
+
+    conn = connect_readonly()
+    try:
+        daily = read_sql(f"""
+            SELECT order_date, SUM(revenue) AS revenue, hll_count(orders_hll) AS orders_count
+            FROM {SALES_FILTER_MART}
+            WHERE {where}
+            GROUP BY order_date
+            ORDER BY order_date
+        """, conn, params=params)
+        by_category = read_sql(f"""
+            SELECT product_category_name, SUM(revenue) AS revenue
+            FROM {SALES_FILTER_MART}
+            WHERE {where}
+            GROUP BY product_category_name
+            ORDER BY revenue DESC
+            LIMIT 10
+        """, conn, params=params)
+    finally:
+        conn.close()
+    return daily, by_category
+
+
+def snapshot_sales(filters):
+    """query_filtered_sales over the snapshot frames (date range only)."""
+    start_date, end_date, _, _ = filters
+    daily, daily_category = snapshot.get('sales_daily'), snapshot.get('sales_daily_category')
+    if daily is None:
+        raise sqlite3.OperationalError(f"{SALES_FILTER_MART} is not in the snapshot")
+
+    # Каждый заказ относится к одному дню, поэтому дневные числа заказов можно брать срезом
+    in_range = pd.Series(True, index=daily.index)
+    category_in_range = pd.Series(True, index=daily_category.index)
+    if start_date:
+        in_range &= daily['order_date'] >= start_date
+        category_in_range &= daily_category['order_date'] >= start_date
+    if end_date:
+        in_range &= daily['order_date'] <= end_date
+        category_in_range &= daily_category['order_date'] <= end_date
+
+    by_category = (daily_category[category_in_range]
+                   .groupby('product_category_name', as_index=False)['revenue'].sum()
+                   .nlargest(10, 'revenue'))
+    return daily[in_range].reset_index(drop=True), by_category
+
+
+def visible_range(relayout):
+    """
+    x range from a graph's relayoutData: (start, end) ISO dates, None for
+    autorange / full history, False if the event did not touch the x axis.
+    """
+    if not relayout:
+        return None
+    if relayout.get('xaxis.autorange'):
+        return None
+    if 'xaxis.range[0]' in relayout:
+        return str(relayout['xaxis.range[0]'])[:10], str(relayout['xaxis.range[1]'])[:10]
+    if 'xaxis.range' in relayout:
+        start, end = relayout['xaxis.range']
+        return str(start)[:10], str(end)[:10]
+    return False
+
+
+def daily_trend_figure(daily, value_col, title, label, x_range, filters):
+    # Видимый диапазон -> недельные/месячные агрегаты при отдалении + LTTB, не больше TARGET_POINTS точек
+    start, end = x_range if x_range else (None, None)
+    points, granularity = downsample_series(daily, 'order_date', [value_col], start, end)
+    fig = px.line(points, x='order_date', y=value_col,
+                  title=f'{title} ({GRANULARITY_TITLES[granularity]})',
+                  labels={value_col: label, 'order_date': 'Date'})
+    # uirevision: зум пользователя сохраняется между обновлениями, смена фильтров его сбрасывает
+    fig.update_layout(height=400, uirevision=str(filters))
+    if x_range:
+        fig.update_xaxes(range=list(x_range))
+    return fig
+
+
+def build_sales_figures(filters, x_range=None):
+    """Figure JSON (dicts) for the filtered sales graphs; x_range limits the daily trends."""
+    try:
+        load = snapshot_sales if snapshot else query_filtered_sales
+        daily, by_category = series_cache.get_or_build((current_version(), filters), lambda: load(filters))
+    except (sqlite3.OperationalError, pd.errors.DatabaseError):
+        note = {'layout': {'title': {'text': 'Run create_marts.py to enable sales filters'}}}
+        return [note, note, note]
+
+    revenue = daily_trend_figure(daily, 'revenue', 'Revenue Trend', 'Revenue (R$)', x_range, filters)
+    orders = daily_trend_figure(daily, 'orders_count', 'Orders Trend', 'Orders', x_range, filters)
+    categories = px.bar(
+        by_category, x='revenue', y='product_category_name', orientation='h',
+        title='Top 10 Categories by Revenue',
+        labels={'revenue': 'Revenue (R$)', 'product_category_name': 'Category'}
+    ).update_layout(height=400, yaxis={'categoryorder': 'total ascending'})
+    return [fig.to_plotly_json() for fig in (revenue, orders, categories)]
+
+
 # Callback to switch pages
 @app.callback(
     Output('page-content', 'children'),
     [Input('url', 'pathname')]
 )
 def display_page(pathname):
-    if pathname == '/cohorts':
-        return cohorts_layout
-    elif pathname == '/logistics':
-        return logistics_layout
+    # Содержимое страницы строится по запросу из кэша (данные только нужной страницы);
+    # в режиме снимка — готовая страница из бандла
+    pages = snapshot or cache
+    if pathname in ('/cohorts', '/logistics'):
+        return pages.get(f'page:{pathname}')
+    return pages.get('page:/')
+
+
+@app.callback(
+    [Output('sales-daily-revenue', 'figure'),
+     Output('sales-daily-orders', 'figure'),
+     Output('sales-top-categories', 'figure')],
+    [Input('sales-date-range', 'start_date'),
+     Input('sales-date-range', 'end_date'),
+     Input('sales-category', 'value'),
+     Input('sales-state', 'value'),
+     Input('sales-daily-revenue', 'relayoutData'),
+     Input('sales-daily-orders', 'relayoutData')]
+)
+def update_sales_figures(start_date, end_date, categories, states, revenue_relayout=None, orders_relayout=None):
+    started = time.perf_counter()
+
+    # Зум одного графика тренда применяется к обоим; смена фильтров показывает весь диапазон
+    trigger = ctx.triggered_id if ctx.triggered else None
+    x_range = None
+    if trigger in ('sales-daily-revenue', 'sales-daily-orders'):
+        x_range = visible_range(revenue_relayout if trigger == 'sales-daily-revenue' else orders_relayout)
+        if x_range is False:
+            return no_update, no_update, no_update
+
+    # Версия данных в ключе: после нового ETL старые фигуры не отдаются
+    filters = normalize_sales_filters(start_date, end_date, categories, states)
+    key = (current_version(), filters, x_range)
+    figures = figure_cache.get_or_build(key, lambda: build_sales_figures(filters, x_range))
+    callback_stats.record('update_sales_figures', time.perf_counter() - started)
+    return figures
+
+
+@app.callback(
+    [Output(f'sales-kpi-{name}', 'children') for name in SALES_KPIS],
+    [Input('sales-date-range', 'start_date'),
+     Input('sales-date-range', 'end_date')]
+)
+def update_sales_kpis(start_date, end_date):
+    # В снимке нет хранилища — остаются KPI за весь период из бандла
+    if snapshot or not (start_date or end_date):
+        return [no_update] * len(SALES_KPIS)
+    started = time.perf_counter()
+
+    # Период покупки [start, end + 1 день): метрики читают только партиции этих месяцев
+    start, end = normalize_sales_filters(start_date, end_date, None, None)[:2]
+    end = (pd.Timestamp(end) + pd.Timedelta(days=1)).strftime('%Y-%m-%d') if end else None
+    results, _ = fan_out({
+        'period_kpis': (lambda conn: compute_metrics(conn, SALES_KPIS, start, end), {}),
+    })
+    callback_stats.record('update_sales_kpis', time.perf_counter() - started)
+    return [format_kpi(results['period_kpis'], name, SALES_KPI_FORMATS[name]) for name in SALES_KPIS]
+
+
+@app.server.route('/stats')
+def dashboard_stats():
+    return jsonify({
+        'figure_cache': figure_cache.stats(),
+        'series_cache': series_cache.stats(),
+        'callbacks': callback_stats.summary(),
+        'queries': query_stats.summary(),
+        'sql': top_statements(10),
+        'last_query_status': dict(query_status),
+        'snapshot': {k: v for k, v in snapshot.manifest.items() if k != 'members'} if snapshot else None,
+    })
+
+
+@app.callback(
+    [Output({'type': 'paged-table', 'name': MATCH}, 'data'),
+     Output({'type': 'paged-table', 'name': MATCH}, 'page_count')],
+    [Input({'type': 'paged-table', 'name': MATCH}, 'page_current'),
+     Input({'type': 'paged-table', 'name': MATCH}, 'page_size'),
+     Input({'type': 'paged-table', 'name': MATCH}, 'sort_by'),
+     Input({'type': 'paged-table', 'name': MATCH}, 'filter_query')],
+    [State({'type': 'paged-table', 'name': MATCH}, 'id')]
+)
+def update_paged_table(page_current, page_size, sort_by, filter_query, table_id):
+    started = time.perf_counter()
+    spec = PAGED_TABLES[table_id['name']]
+    if snapshot:
+        try:
+            rows, total = frame_page(snapshot.get(f"table:{table_id['name']}"), page_current, page_size,
+                                     sort_by, filter_query, spec.get('default_sort'))
+        except ValueError:
+            rows, total = [], 0
+        callback_stats.record('update_paged_table', time.perf_counter() - started)
+        return rows, max(1, -(-total // page_size))
+
+    conn = connect_readonly()
+    try:
+        # Только видимая страница: WHERE / ORDER BY / LIMIT / OFFSET по индексированной таблице
+        rows, total = query_page(conn, spec['table'], page_current, page_size, sort_by, filter_query,
+                                 spec.get('default_sort'))
+    except ValueError:
+        rows, total = [], 0
+    finally:
+        conn.close()
+    callback_stats.record('update_paged_table', time.perf_counter() - started)
+    return rows, max(1, -(-total // page_size))
+
+
+# Фильтры появляются только на странице когорт (suppress_callback_exceptions)
+@app.callback(
+    Output('cohort-slice', 'children'),
+    [Input(f'cohort-filter-{dim}', 'value') for dim in CUBE_DIMENSIONS]
+)
+def update_cohort_slice(*values):
+    filters = dict(zip(CUBE_DIMENSIONS, values))
+    if snapshot:
+        slice_df, _ = cohort_slice_from_cube(snapshot.get('cohort_cube'), **filters)
     else:
-        return sales_layout
+        conn = connect_readonly()
+        try:
+            slice_df, _ = load_cohort_slice(conn, **filters)
+        finally:
+            conn.close()
 
+    if slice_df.empty:
+        return html.P("No customers in this segment.", style={'color': '#666', 'fontStyle': 'italic'})
+    return render_retention_table(slice_df.fillna(0))
 
-if __name__ == "__main__":
+
+def main(host="127.0.0.1", port=8050, debug=True):
     print("Start")
+    if snapshot:
+        print(f"Serving snapshot {snapshot.path} (data up to {snapshot.manifest['watermark']}), no SQL")
+
+    print(f"Sales Page: http://{host}:{port}/")
+    print(f"Cohorts Page: http://{host}:{port}/cohorts")
+    print(f"Logistics Page: http://{host}:{port}/logistics")
+    print(f"Cache / latency stats: http://{host}:{port}/stats")
 
-    print("Sales Page: http://127.0.0.1:8050/")
-    print("Cohorts Page: http://127.0.0.1:8050/cohorts")
-    print("Logistics Page: http://127.0.0.1:8050/logistics")
+    app.run(debug=debug, host=host, port=port)
 
-    app.run(debug=True, host="127.0.0.1", port=8050)
\ No newline at end of file
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+Prebuilt dashboard snapshot bundle: after the marts are built, every page
+layout (KPIs and static figures included) plus the small frames behind the
+interactive callbacks are serialized into one compressed, versioned zip.
+The dashboard started with DASHBOARD_SNAPSHOT=<path|latest> serves pages and
+callbacks from the memory-mapped bundle and never opens the warehouse.
+"""
+import io
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import zipfile
+import zlib
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+from plotly.utils import PlotlyJSONEncoder
+
+from cohort_cube import CUBE_TABLE
+from metric_registry import data_version
+from metric_snapshots import data_watermark
+from query_log import connect, read_sql
+from sketches import register_sketch_functions
+
+DB = Path(__file__).resolve().parents[2] / "data" / "ecommerce.db"
+SNAPSHOT_DIR = Path(__file__).resolve().parents[2] / "data" / "snapshots"
+
+FORMAT_VERSION = 1
+# Сколько последних бандлов оставлять в SNAPSHOT_DIR
+SNAPSHOT_KEEP = 5
+
+PAGE_MEMBERS = {
+    'page:/': 'pages/sales.json',
+    'page:/cohorts': 'pages/cohorts.json',
+    'page:/logistics': 'pages/logistics.json',
+}
+
+
+def _frame_json(df):
+    return df.to_json(orient='split', index=False, date_format='iso')
+
+
+def collect_frames(conn, dashboard):
+    """Frames behind the interactive callbacks: sales series, paged tables, cohort cube."""
+    frames = {}
+    try:
+        frames['sales_daily'], _ = dashboard.query_filtered_sales((None, None, (), ()))
+        # Выручка аддитивна по дням и категориям — топ категорий за любой диапазон дат считается из неё
+        frames['sales_daily_category'] = read_sql(f"""
+            SELECT order_date, product_category_name, SUM(revenue) AS revenue
+            FROM {dashboard.SALES_FILTER_MART}
+            GROUP BY order_date, product_category_name
+        """, conn)
+    except (sqlite3.OperationalError, pd.errors.DatabaseError):
+        print("Sales filter mart not found — snapshot sales graphs will be empty")
+
+    for name, spec in dashboard.PAGED_TABLES.items():
+        try:
+            frames[f'table:{name}'] = read_sql(f"SELECT * FROM {spec['table']}", conn)
+        except (sqlite3.OperationalError, pd.errors.DatabaseError):
+            pass
+
+    try:
+        frames['cohort_cube'] = read_sql(f"SELECT * FROM {CUBE_TABLE}", conn)
+    except (sqlite3.OperationalError, pd.errors.DatabaseError):
+        pass
+    return frames
+
+
+def build_snapshot(output_dir=SNAPSHOT_DIR, keep=SNAPSHOT_KEEP, allow_degraded=False):
+    """
+    Write a new bundle to output_dir and return its path.
+    Raises RuntimeError without writing anything if a dashboard query fell
+    back to its placeholder (unless allow_degraded).
+    """
+    # Приложение Dash нужно только сборщику: сам бандл от него не зависит
+    import dashboard_app as dashboard
+
+    data = dashboard.load_sales_data()
+    query_status = dict(dashboard.query_status)
+    failed = {name: status for name, status in query_status.items() if status != 'ok'}
+    if failed and not allow_degraded:
+        # Бандл с заглушками отдавался бы как актуальный до следующей сборки
+        raise RuntimeError("dashboard queries did not complete: "
+                           + ", ".join(f"{name} ({status})" for name, status in sorted(failed.items())))
+    table_columns = dashboard.load_table_columns()
+    cohort_filters = dashboard.load_cohort_filters()
+
+    # Число заказов не аддитивно по категориям и штатам (нужны HLL-скетчи витрины),
+    # поэтому в снимке остаются только фильтр дат и зум
+    sales_data = {**data, 'sales_filters': {**data['sales_filters'], 'categories': [], 'states': []}}
+    pages = {
+        'page:/': dashboard.build_sales_layout(sales_data),
+        'page:/cohorts': dashboard.build_cohorts_layout(table_columns, cohort_filters),
+        'page:/logistics': dashboard.build_logistics_layout(data, table_columns),
+    }
+
+    conn = connect(DB)
+    register_sketch_functions(conn)
+    try:
+        frames = collect_frames(conn, dashboard)
+        watermark = data_watermark(conn)
+        version = data_version(conn)
+    finally:
+        conn.close()
+
+    created_at = datetime.now()
+    snapshot_id = f"{created_at:%Y%m%dT%H%M%S}"
+    members = {}
+    payloads = {}
+    for key, layout in pages.items():
+        members[key] = {'path': PAGE_MEMBERS[key], 'kind': 'json'}
+        payloads[PAGE_MEMBERS[key]] = json.dumps(layout, cls=PlotlyJSONEncoder)
+    for key, df in frames.items():
+        path = f"frames/{key.replace(':', '/')}.json"
+        members[key] = {'path': path, 'kind': 'frame', 'rows': len(df)}
+        payloads[path] = _frame_json(df)
+
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'snapshot_id': snapshot_id,
+        'created_at': created_at.isoformat(timespec='seconds'),
+        'watermark': watermark,
+        'data_version': version,
+        'query_status': query_status,
+        'members': members,
+    }
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    path = output_dir / f"dashboard-{snapshot_id}.zip"
+    tmp_path = path.with_suffix('.zip.tmp')
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as bundle:
+        bundle.writestr('manifest.json', json.dumps(manifest, indent=2))
+        for member, payload in payloads.items():
+            bundle.writestr(member, payload)
+    # Атомарная замена: читающий дашборд никогда не видит недописанный бандл
+    os.replace(tmp_path, path)
+
+    for old in sorted(output_dir.glob('dashboard-*.zip'))[:-keep]:
+        old.unlink()
+    return path
+
+
+def latest_snapshot(snapshot_dir=SNAPSHOT_DIR):
+    bundles = sorted(Path(snapshot_dir).glob('dashboard-*.zip'))
+    if not bundles:
+        raise FileNotFoundError(f"No dashboard snapshots in {snapshot_dir} — run dashboard_snapshot.py first")
+    return bundles[-1]
+
+
+class DashboardSnapshot:
+    """
+    Read side of a bundle. The file is memory-mapped (pages shared between
+    worker processes by the OS page cache) and members are sliced straight
+    out of the map; they are inflated and decoded on first access and kept,
+    so get() has the same contract as DataCache.get.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        # Центральный каталог читается один раз; дальше — только срезы mmap
+        with zipfile.ZipFile(self.path) as bundle:
+            self._infos = {info.filename: info for info in bundle.infolist()}
+        with open(self.path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.manifest = json.loads(self._read_member('manifest.json'))
+        if self.manifest.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot format: {self.manifest.get('format_version')}")
+        self.version = self.manifest['snapshot_id']
+        self._decoded = {}
+        self._lock = threading.Lock()
+
+    def _read_member(self, name):
+        info = self._infos[name]
+        # Локальный заголовок: 30 байт + имя + extra, затем сжатые данные
+        name_len, extra_len = struct.unpack_from('<HH', self._mmap, info.header_offset + 26)
+        start = info.header_offset + 30 + name_len + extra_len
+        data = self._mmap[start:start + info.compress_size]
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+        if zlib.crc32(data) != info.CRC:
+            raise zipfile.BadZipFile(f"CRC mismatch in {self.path}:{name}")
+        return data
+
+    def __contains__(self, key):
+        return key in self.manifest['members']
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._decoded:
+                self._decoded[key] = self._decode(key)
+            return self._decoded[key]
+
+    def _decode(self, key):
+        member = self.manifest['members'].get(key)
+        if member is None:
+            return None
+        raw = self._read_member(member['path']).decode('utf-8')
+        if member['kind'] == 'frame':
+            return pd.read_json(io.StringIO(raw), orient='split', convert_dates=False)
+        return json.loads(raw)
+
+
+def open_snapshot(path):
+    """DashboardSnapshot for a bundle path, or the newest bundle for 'latest'."""
+    return DashboardSnapshot(latest_snapshot() if path == 'latest' else path)
+
+
+def main():
+    if not DB.exists():
+        print(f"Database not found at {DB}. Run ETL first.")
+        sys.exit(1)
+
+    try:
+        path = build_snapshot()
+    except RuntimeError as e:
+        print(f"Dashboard snapshot not built: {e}")
+        sys.exit(1)
+    snapshot = open_snapshot(path)
+    print(f"Dashboard snapshot: {path} ({path.stat().st_size / 1024:.1f} KB)")
+    print(f"Watermark: {snapshot.manifest['watermark']}")
+    for key, member in snapshot.manifest['members'].items():
+        rows = f" ({member['rows']} rows)" if 'rows' in member else ""
+        print(f"  {key}: {member['path']}{rows}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Server-side downsampling for dashboard time series: calendar rollups
+(day -> week -> month) chosen from the visible range, then LTTB
+(Largest-Triangle-Three-Buckets) so a trace never carries more than
+TARGET_POINTS points, however long the history is.
+"""
+import numpy as np
+import pandas as pd
+
+TARGET_POINTS = 500
+
+# Ширина видимого диапазона (дни), до которой показываем дневные / недельные точки
+DAILY_MAX_SPAN_DAYS = 400
+WEEKLY_MAX_SPAN_DAYS = 3 * 365
+
+
+def choose_granularity(span_days):
+    if span_days <= DAILY_MAX_SPAN_DAYS:
+        return 'day'
+    if span_days <= WEEKLY_MAX_SPAN_DAYS:
+        return 'week'
+    return 'month'
+
+
+def rollup_series(series, date_col, value_cols, granularity):
+    """Sum value_cols per calendar week / month (day: returned as is, sorted)."""
+    series = series.sort_values(date_col)
+    if granularity == 'day':
+        return series.reset_index(drop=True)
+
+    period = 'W' if granularity == 'week' else 'M'
+    starts = pd.to_datetime(series[date_col]).dt.to_period(period).dt.start_time
+    rolled = series[value_cols].groupby(starts.rename(date_col)).sum().reset_index()
+    rolled[date_col] = rolled[date_col].dt.strftime('%Y-%m-%d')
+    return rolled
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Indices of the points kept by LTTB: first and last points plus, for each
+    of n_out - 2 buckets, the point forming the largest triangle with the
+    previously kept point and the mean of the next bucket.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.nan_to_num(np.asarray(y, dtype=np.float64))
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    edges = np.floor(np.arange(n_out - 1) * (n - 2) / (n_out - 2)).astype(np.int64) + 1
+    edges[-1] = n - 1
+    kept = np.empty(n_out, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        kept[i + 1] = a
+    return kept
+
+
+def downsample_series(series, date_col, value_cols, start=None, end=None, target_points=TARGET_POINTS):
+    """
+    Visible slice [start, end] of a daily series, rolled up to the granularity
+    that fits the span and thinned with LTTB to at most target_points rows
+    (selected on the first value column, shared by the others).
+    Returns (frame, granularity).
+    """
+    dates = pd.to_datetime(series[date_col])
+    mask = np.ones(len(series), dtype=bool)
+    if start is not None:
+        mask &= dates >= pd.Timestamp(start)
+    if end is not None:
+        mask &= dates <= pd.Timestamp(end)
+    visible = series[mask]
+    if visible.empty:
+        return visible, 'day'
+
+    visible_dates = dates[mask]
+    span_days = (visible_dates.max() - visible_dates.min()).days + 1
+    granularity = choose_granularity(span_days)
+    rolled = rollup_series(visible, date_col, value_cols, granularity)
+
+    x = (pd.to_datetime(rolled[date_col]) - pd.Timestamp('1970-01-01')).dt.days.to_numpy()
+    kept = lttb_indices(x, rolled[value_cols[0]].to_numpy(), target_points)
+    return rolled.iloc[kept].reset_index(drop=True), granularity
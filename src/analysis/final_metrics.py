@@ -1,29 +1,20 @@
-import sqlite3
-import pandas as pd
 from pathlib import Path
 import json
 
+from cohort_analysis import retention_from_state
+from metric_registry import compute_metrics
+from metric_snapshots import latest_deltas, record_snapshot
+from query_log import connect, read_sql
+
 DB_PATH = Path(__file__).resolve().parents[2] / "data" / "ecommerce.db"
 OUTPUT_PATH = Path(__file__).resolve().parents[2] / "docs" / "final_metrics_report.txt"
 
 
 def calculate_all_metrics(conn):
-    gmv_query = """
-    SELECT 
-        COUNT(DISTINCT o.order_id) as total_orders,
-        COUNT(DISTINCT o.customer_id) as total_customers,
-        SUM(i.price + i.freight_value) as gmv
-    FROM fact_orders o
-    JOIN fact_order_items i ON o.order_id = i.order_id
-    """
-    basics = pd.read_sql_query(gmv_query, conn)
-
-    if basics['total_orders'].iloc[0] > 0:
-        basics['aov'] = basics['gmv'] / basics['total_orders']
-    else:
-        basics['aov'] = 0
+    # GMV, AOV, заказы, покупатели и доля опозданий — из единого реестра метрик
+    basics = compute_metrics(conn)
 
-    top_categories = pd.read_sql_query("""
+    top_categories = read_sql("""
         SELECT product_category_name, SUM(total_revenue) as revenue
         FROM mart_product_performance
         WHERE product_category_name IS NOT NULL
@@ -32,13 +23,6 @@ def calculate_all_metrics(conn):
         LIMIT 10
     """, conn)
 
-    late_delivery = pd.read_sql_query("""
-        SELECT 
-            SUM(CASE WHEN delivery_time_days > 30 THEN 1 ELSE 0 END) * 100.0 / COUNT(*) as late_delivery_percent
-        FROM fact_orders
-        WHERE delivery_time_days IS NOT NULL
-    """, conn)
-
     cursor = conn.cursor()
     cursor.execute("PRAGMA table_info(mart_delivery_analysis)")
     columns = [col[1] for col in cursor.fetchall()]
@@ -61,27 +45,37 @@ def calculate_all_metrics(conn):
                 ORDER BY total_orders DESC
                 LIMIT 5
             """
-            delivery_metrics = pd.read_sql_query(query, conn).to_dict('records')
-
-    unique_customers = pd.read_sql_query(
-        "SELECT COUNT(DISTINCT customer_unique_id) as unique_customers FROM dim_customers",
-        conn
-    )
-
-    if not unique_customers.empty:
-        basics['total_customers'] = unique_customers['unique_customers'].iloc[0]
-
-    retention = {
-        'retention_m0_m1': '0.0%',
-        'note': 'All customers made only one purchase (no repeat buyers in dataset)'
-    }
+            delivery_metrics = read_sql(query, conn).to_dict('records')
 
     return {
-        'basics': basics.iloc[0].to_dict(),
+        'basics': basics,
+        'changes': [],
         'top_categories': top_categories.to_dict('records'),
-        'late_delivery_percent': late_delivery['late_delivery_percent'].iloc[0] if not late_delivery.empty else 0,
+        'late_delivery_percent': basics['late_delivery_rate'],
         'delivery_by_city': delivery_metrics,
-        'retention': retention
+        'retention': calculate_retention(conn)
+    }
+
+
+def calculate_retention(conn):
+    """M0 → M1 retention over all cohorts with an observed first month, from the cohort state."""
+    has_state = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'cohort_activity'"
+    ).fetchone()
+    cohort_df = retention_from_state(conn)[0] if has_state else None
+    if cohort_df is None or cohort_df.empty:
+        return {'retention_m0_m1': 'n/a', 'note': 'Cohort state is empty — run cohort_analysis.py first'}
+
+    # Последний когорт ещё не прожил месяц (NaN) и в расчёт не входит
+    observed = cohort_df[cohort_df['retention_month_1'].notna()]
+    customers = int(observed['cohort_size'].sum())
+    returned = (observed['cohort_size'] * observed['retention_month_1'] / 100).sum()
+    rate = returned / customers * 100 if customers else 0.0
+    return {
+        'retention_m0_m1': f"{rate:.1f}%",
+        'note': (f"{round(returned):,} of {customers:,} customers in {len(observed)} cohorts "
+                 f"({observed['cohort_month'].iloc[0]} – {observed['cohort_month'].iloc[-1]}) "
+                 f"ordered again in the month after their first purchase"),
     }
 
 
@@ -93,7 +87,13 @@ def save_report(metrics, output_path):
     report.append(f"AOV (Average Order Value): R${basics['aov']:,.2f}")
     report.append(f"Total Orders: {int(basics['total_orders']):,}")
     report.append(f"Unique Customers: {int(basics['total_customers']):,}")
-    report.append(f"Orders per Customer: {(basics['total_orders'] / basics['total_customers']):.2f}")
+    report.append(f"Orders per Customer: {basics['orders_per_customer']:.2f}")
+
+    if metrics['changes']:
+        report.append("\n CHANGE VS PREVIOUS DATA WATERMARK:")
+        report.append("-" * 40)
+        for change in metrics['changes']:
+            report.append(f"{change['metric']:<22} {change['current']:>14,.2f}  ({change['delta_pct']:+.2f}%)")
 
     report.append("\n COHORT RETENTION:")
     report.append("-" * 40)
@@ -133,10 +133,17 @@ def save_report(metrics, output_path):
 
 
 def main():
-    conn = sqlite3.connect(DB_PATH)
+    conn = connect(DB_PATH)
 
     try:
         metrics = calculate_all_metrics(conn)
+
+        # Каждый запуск дописывает снимок; сравнение берётся из истории, а не пересчётом
+        run_id = record_snapshot(conn, metrics['basics'])
+        changes = latest_deltas(conn).dropna(subset=['previous'])
+        metrics['changes'] = changes.to_dict('records')
+        metrics['run_id'] = run_id
+
         save_report(metrics, OUTPUT_PATH)
 
         json_path = OUTPUT_PATH.parent / "final_metrics.json"
@@ -0,0 +1,264 @@
+"""
+Seller -> customer distance analytics.
+
+The ETL collapses the Olist geolocation file (~1M lat/lng points) into one
+centroid per zip code prefix (dim_geolocation) with a grid cell id. Here the
+centroids become a dense array indexed by zip prefix, so coordinates for
+tens of millions of order items are a single NumPy gather, distances are a
+vectorized haversine, and a CSR grid index answers nearest-seller queries.
+"""
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from query_log import connect, read_sql
+
+DB = Path(__file__).resolve().parents[2] / "data" / "ecommerce.db"
+
+EARTH_RADIUS_KM = 6371.0
+GRID_CELL_DEG = 0.5
+ZIP_PREFIX_SPACE = 100_000  # zip_code_prefix — 5 цифр
+
+# Границы Бразилии: точки за их пределами в geolocation — мусор
+BRAZIL_LAT = (-34.0, 5.5)
+BRAZIL_LNG = (-74.0, -34.0)
+
+DISTANCE_BANDS = [0, 50, 200, 500, 1000, 2000, np.inf]
+DISTANCE_BAND_LABELS = ['0-50 km', '50-200 km', '200-500 km', '500-1000 km', '1000-2000 km', '2000+ km']
+
+
+def grid_cells(lat, lng, cell_deg=GRID_CELL_DEG):
+    """Integer grid cell id (row-major over a global lat/lng grid)."""
+    n_cols = int(np.ceil(360 / cell_deg))
+    row = np.floor((np.asarray(lat) + 90) / cell_deg).astype(np.int64)
+    col = np.floor((np.asarray(lng) + 180) / cell_deg).astype(np.int64)
+    return row * n_cols + col
+
+
+def build_zip_centroids(df_geo):
+    """
+    Collapse raw geolocation points into one centroid per zip code prefix:
+    zip_code_prefix, lat, lng, points, grid_cell. Points outside Brazil are dropped.
+    """
+    geo = pd.DataFrame({
+        'zip_code_prefix': pd.to_numeric(df_geo['geolocation_zip_code_prefix'], errors='coerce'),
+        'lat': pd.to_numeric(df_geo['geolocation_lat'], errors='coerce'),
+        'lng': pd.to_numeric(df_geo['geolocation_lng'], errors='coerce'),
+    }).dropna()
+    in_brazil = geo['lat'].between(*BRAZIL_LAT) & geo['lng'].between(*BRAZIL_LNG)
+    geo = geo[in_brazil]
+
+    centroids = geo.groupby(geo['zip_code_prefix'].astype(np.int64)).agg(
+        lat=('lat', 'mean'),
+        lng=('lng', 'mean'),
+        points=('lat', 'size'),
+    ).reset_index()
+    centroids['grid_cell'] = grid_cells(centroids['lat'], centroids['lng'])
+    return centroids
+
+
+def load_centroid_array(conn):
+    """Dense (lat, lng) float arrays indexed by zip prefix; NaN for unknown prefixes."""
+    centroids = read_sql("SELECT zip_code_prefix, lat, lng FROM dim_geolocation", conn)
+    lat = np.full(ZIP_PREFIX_SPACE, np.nan)
+    lng = np.full(ZIP_PREFIX_SPACE, np.nan)
+    zips = centroids['zip_code_prefix'].to_numpy(dtype=np.int64)
+    lat[zips] = centroids['lat'].to_numpy()
+    lng[zips] = centroids['lng'].to_numpy()
+    return lat, lng
+
+
+def lookup_coordinates(zip_prefixes, lat_arr, lng_arr):
+    """Vectorized zip prefix -> (lat, lng); NaN for missing/invalid prefixes."""
+    zips = pd.to_numeric(pd.Series(zip_prefixes), errors='coerce').to_numpy()
+    valid = ~np.isnan(zips) & (zips >= 0) & (zips < ZIP_PREFIX_SPACE)
+    idx = np.where(valid, zips, 0).astype(np.int64)
+    return np.where(valid, lat_arr[idx], np.nan), np.where(valid, lng_arr[idx], np.nan)
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lng1, lat2, lng2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class GeoGrid:
+    """
+    CSR grid index over points: point ids sorted by cell, with the start
+    offset of each non-empty cell. Nearest-point queries expand rings of
+    cells around all queries at once.
+    """
+
+    def __init__(self, lat, lng, cell_deg=GRID_CELL_DEG):
+        self.cell_deg = cell_deg
+        self.n_cols = int(np.ceil(360 / cell_deg))
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lng = np.asarray(lng, dtype=np.float64)
+
+        cells = grid_cells(self.lat, self.lng, cell_deg)
+        self.order = np.argsort(cells, kind='stable')
+        self.cells, self.starts = np.unique(cells[self.order], return_index=True)
+        self.ends = np.append(self.starts[1:], len(self.order))
+
+    def _ring_candidates(self, q_row, q_col, ring):
+        """(query index, point id) pairs for cells at Chebyshev distance == ring."""
+        offsets = np.arange(-ring, ring + 1)
+        d_row, d_col = np.meshgrid(offsets, offsets, indexing='ij')
+        on_ring = np.maximum(np.abs(d_row), np.abs(d_col)) == ring
+        d_row, d_col = d_row[on_ring], d_col[on_ring]
+
+        cell_keys = (q_row[:, None] + d_row[None, :]) * self.n_cols + (q_col[:, None] + d_col[None, :])
+        pos = np.searchsorted(self.cells, cell_keys.ravel())
+        pos_clipped = np.minimum(pos, len(self.cells) - 1)
+        found = self.cells[pos_clipped] == cell_keys.ravel()
+
+        query_idx = np.repeat(np.arange(len(q_row)), len(d_row))[found]
+        starts = self.starts[pos_clipped[found]]
+        lengths = self.ends[pos_clipped[found]] - starts
+
+        # Разворачиваем диапазоны [start, end) без цикла по ячейкам
+        pair_query = np.repeat(query_idx, lengths)
+        offsets_in_cell = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        pair_point = self.order[np.repeat(starts, lengths) + offsets_in_cell]
+        return pair_query, pair_point
+
+    def nearest(self, q_lat, q_lng, max_rings=40):
+        """Distance (km) and point id of the nearest indexed point for each query."""
+        q_lat = np.asarray(q_lat, dtype=np.float64)
+        q_lng = np.asarray(q_lng, dtype=np.float64)
+        best_dist = np.full(len(q_lat), np.inf)
+        best_point = np.full(len(q_lat), -1, dtype=np.int64)
+        if len(self.order) == 0:
+            return best_dist, best_point
+
+        located = ~np.isnan(q_lat) & ~np.isnan(q_lng)
+        q_row = np.floor((np.where(located, q_lat, 0) + 90) / self.cell_deg).astype(np.int64)
+        q_col = np.floor((np.where(located, q_lng, 0) + 180) / self.cell_deg).astype(np.int64)
+        active = np.flatnonzero(located)
+
+        for ring in range(max_rings + 1):
+            if len(active) == 0:
+                break
+            pair_query, pair_point = self._ring_candidates(q_row[active], q_col[active], ring)
+            if len(pair_query):
+                q = active[pair_query]
+                dist = haversine_km(q_lat[q], q_lng[q], self.lat[pair_point], self.lng[pair_point])
+                order = np.lexsort((dist, q))
+                first = np.ones(len(order), dtype=bool)
+                first[1:] = q[order][1:] != q[order][:-1]
+                q_best, d_best, p_best = q[order][first], dist[order][first], pair_point[order][first]
+                better = d_best < best_dist[q_best]
+                best_dist[q_best[better]] = d_best[better]
+                best_point[q_best[better]] = p_best[better]
+
+            # Всё, что дальше ring клеток, гарантированно дальше ring * размер клетки (км)
+            covered_km = ring * self.cell_deg * 111.32 * np.cos(np.radians(np.minimum(
+                np.abs(q_lat[active]) + (ring + 1) * self.cell_deg, 89.0)))
+            active = active[best_dist[active] > covered_km]
+
+        return best_dist, best_point
+
+
+def load_item_distances(conn):
+    """Order items with seller/customer coordinates, distance and delivery features."""
+    items = read_sql("""
+        SELECT
+            i.order_id,
+            i.order_item_id,
+            i.seller_id,
+            s.seller_zip_code_prefix,
+            c.customer_zip_code_prefix,
+            o.delivery_time_days,
+            o.is_delivered,
+            o.is_late
+        FROM fact_order_items i
+        JOIN fact_orders o ON o.order_id = i.order_id
+        JOIN dim_customers c ON c.customer_id = o.customer_id
+        LEFT JOIN dim_sellers s ON s.seller_id = i.seller_id
+    """, conn)
+
+    lat_arr, lng_arr = load_centroid_array(conn)
+    s_lat, s_lng = lookup_coordinates(items['seller_zip_code_prefix'], lat_arr, lng_arr)
+    c_lat, c_lng = lookup_coordinates(items['customer_zip_code_prefix'], lat_arr, lng_arr)
+    items['distance_km'] = haversine_km(s_lat, s_lng, c_lat, c_lng)
+
+    # Расстояние до ближайшего продавца (по всем продавцам) — через сеточный индекс
+    seller_zips = pd.unique(items['seller_zip_code_prefix'].dropna())
+    sz_lat, sz_lng = lookup_coordinates(seller_zips, lat_arr, lng_arr)
+    known = ~np.isnan(sz_lat)
+    grid = GeoGrid(sz_lat[known], sz_lng[known])
+
+    customer_zips, inverse = np.unique(items['customer_zip_code_prefix'].fillna(-1).to_numpy(), return_inverse=True)
+    cz_lat, cz_lng = lookup_coordinates(np.where(customer_zips < 0, np.nan, customer_zips), lat_arr, lng_arr)
+    nearest_km, _ = grid.nearest(cz_lat, cz_lng)
+    items['nearest_seller_km'] = np.where(np.isinf(nearest_km), np.nan, nearest_km)[inverse]
+    items['excess_distance_km'] = items['distance_km'] - items['nearest_seller_km']
+
+    items['distance_band'] = pd.cut(items['distance_km'], bins=DISTANCE_BANDS,
+                                    labels=DISTANCE_BAND_LABELS, right=False)
+    return items
+
+
+def _sla_summary(items, keys):
+    delivered = items[items['is_delivered'] == 1]
+    summary = items.groupby(keys, observed=True).agg(
+        items=('order_item_id', 'size'),
+        orders=('order_id', 'nunique'),
+        avg_distance_km=('distance_km', 'mean'),
+        avg_excess_distance_km=('excess_distance_km', 'mean'),
+    )
+    delivery = delivered.groupby(keys, observed=True).agg(
+        avg_delivery_days=('delivery_time_days', 'mean'),
+        late_delivery_rate=('is_late', 'mean'),
+    )
+    summary = summary.join(delivery).reset_index()
+    summary['late_delivery_rate'] = (summary['late_delivery_rate'] * 100).round(2)
+    return summary.round({'avg_distance_km': 1, 'avg_excess_distance_km': 1, 'avg_delivery_days': 2})
+
+
+def sla_by_distance_band(items):
+    return _sla_summary(items, ['distance_band'])
+
+
+def sla_by_seller(items, min_items=10):
+    summary = _sla_summary(items, ['seller_id'])
+    summary = summary[summary['items'] >= min_items]
+    return summary.sort_values('items', ascending=False).reset_index(drop=True)
+
+
+def main():
+    conn = connect(DB)
+
+    try:
+        items = load_item_distances(conn)
+    except (sqlite3.OperationalError, pd.errors.DatabaseError) as e:
+        print(f"Distance analysis needs dim_sellers and dim_geolocation — run ETL first ({e})")
+        conn.close()
+        return
+
+    located = items['distance_km'].notna().mean() * 100
+    print(f"Order items: {len(items):,}, with both coordinates: {located:.1f}%")
+
+    by_band = sla_by_distance_band(items)
+    by_seller = sla_by_seller(items)
+
+    print("\nSLA BY DISTANCE BAND:")
+    print(by_band.to_string(index=False))
+    print("\nTOP SELLERS (by items):")
+    print(by_seller.head(10).to_string(index=False))
+
+    by_band.astype({'distance_band': str}).to_sql("mart_distance_band", conn, if_exists="replace", index=False)
+    by_seller.to_sql("mart_seller_distance", conn, if_exists="replace", index=False)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_mart_seller_distance_seller ON mart_seller_distance(seller_id)")
+    conn.commit()
+    print(f"\nmart_distance_band created: {len(by_band)} rows")
+    print(f"mart_seller_distance created: {len(by_seller)} rows")
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Metric registry: every headline metric is declared once with its grain
+(the table scan it aggregates over) or its dependencies (derived metrics).
+The planner batches all requested base metrics of one grain into a single
+SELECT, computes derived metrics from them, and caches results per data
+version, so the report, JSON output, SLA analysis and dashboard share one
+definition and one set of scans. With a purchase date range the order
+grains read only the monthly partitions overlapping it (prune_partitions).
+"""
+import argparse
+import os
+import sqlite3
+from pathlib import Path
+
+from partitions import range_query
+from query_log import connect
+
+DB = Path(__file__).resolve().parents[2] / "data" / "ecommerce.db"
+
+# Источник (одно сканирование) для каждого грейна
+GRAINS = {
+    # Итоги заказа посчитаны в ETL — соединение с позициями не нужно
+    'order': "FROM fact_orders",
+    'customer': "FROM dim_customers",
+    # Покрывающий индекс idx_fact_orders_delivery — без чтения строк таблицы
+    'delivery': "FROM fact_orders WHERE is_delivered = 1",
+}
+
+# Те же грейны за период покупки: {orders} — партиции, пересекающие период
+RANGE_GRAINS = {
+    'order': "FROM {orders} WHERE {in_range}",
+    'customer': "FROM dim_customers WHERE customer_id IN (SELECT customer_id FROM {orders} WHERE {in_range})",
+    'delivery': "FROM {orders} WHERE is_delivered = 1 AND {in_range}",
+}
+
+
+class Metric:
+    """A base metric (grain + SQL aggregate) or a derived one (depends + formula)."""
+
+    def __init__(self, name, description, grain=None, sql=None, depends=(), formula=None):
+        if (sql is None) == (formula is None):
+            raise ValueError(f"Metric {name} needs either sql or formula")
+        if sql is not None and grain not in GRAINS:
+            raise ValueError(f"Metric {name}: unknown grain {grain!r}")
+        self.name = name
+        self.description = description
+        self.grain = grain
+        self.sql = sql
+        self.depends = tuple(depends)
+        self.formula = formula
+
+
+def _ratio(numerator, denominator, scale=1.0):
+    return numerator * scale / denominator if denominator else 0.0
+
+
+METRICS = {m.name: m for m in [
+    Metric('gmv', "Gross merchandise value: items + freight, R$",
+           grain='order', sql="SUM(order_total)"),
+    Metric('total_orders', "Orders with at least one item",
+           grain='order', sql="SUM(items_count > 0)"),
+    Metric('items_count', "Order items",
+           grain='order', sql="SUM(items_count)"),
+    Metric('total_customers', "Unique customers (customer_unique_id)",
+           grain='customer', sql="COUNT(DISTINCT customer_unique_id)"),
+    Metric('delivered_orders', "Delivered orders with a delivery date",
+           grain='delivery', sql="COUNT(*)"),
+    Metric('late_orders', "Delivered orders flagged is_late",
+           grain='delivery', sql="SUM(is_late)"),
+    Metric('avg_delivery_days', "Average purchase-to-delivery time, days",
+           grain='delivery', sql="AVG(delivery_time_days)"),
+    Metric('aov', "Average order value: GMV / orders, R$",
+           depends=('gmv', 'total_orders'), formula=lambda m: _ratio(m['gmv'], m['total_orders'])),
+    Metric('orders_per_customer', "Orders per unique customer",
+           depends=('total_orders', 'total_customers'),
+           formula=lambda m: _ratio(m['total_orders'], m['total_customers'])),
+    Metric('late_delivery_rate', "Late deliveries, % of delivered orders",
+           depends=('late_orders', 'delivered_orders'),
+           formula=lambda m: _ratio(m['late_orders'], m['delivered_orders'], 100.0)),
+]}
+
+# (data version, start, end, metric) -> значение
+_cache = {}
+
+
+def data_version(conn):
+    """
+    Version of the database file behind conn (mtime + size); None for
+    in-memory databases, which are never cached.
+    """
+    path = conn.execute("PRAGMA database_list").fetchone()[2]
+    if not path:
+        return None
+    st = os.stat(path)
+    return f"{st.st_mtime_ns}-{st.st_size}"
+
+
+def plan_metrics(names):
+    """
+    Resolve dependencies of the requested metrics.
+    Returns ({grain: [base metrics]}, [derived metrics in dependency order]).
+    """
+    scans, derived, seen = {}, [], set()
+
+    def visit(name):
+        if name in seen:
+            return
+        if name not in METRICS:
+            raise KeyError(f"Unknown metric: {name}")
+        seen.add(name)
+        metric = METRICS[name]
+        for dep in metric.depends:
+            visit(dep)
+        if metric.sql is not None:
+            scans.setdefault(metric.grain, []).append(metric)
+        else:
+            derived.append(metric)
+
+    for name in names:
+        visit(name)
+    return scans, derived
+
+
+def compute_metrics(conn, names=None, start=None, end=None):
+    """
+    Values of the requested metrics (all registered by default) as a dict,
+    optionally for orders purchased in [start, end). One SELECT per grain;
+    results are reused while the data version is unchanged.
+    """
+    names = list(names or METRICS)
+    version = data_version(conn)
+    scans, derived = plan_metrics(names)
+    period = (start, end)
+
+    values = {}
+    for grain, metrics in scans.items():
+        cached = [m.name for m in metrics if (version, *period, m.name) in _cache]
+        if version is not None and len(cached) == len(metrics):
+            values.update({name: _cache[(version, *period, name)] for name in cached})
+            continue
+
+        columns = ", ".join(f"{m.sql} AS {m.name}" for m in metrics)
+        if start is None and end is None:
+            row = conn.execute(f"SELECT {columns} {GRAINS[grain]}").fetchone()
+        else:
+            sql, params = range_query(conn, f"SELECT {columns} {RANGE_GRAINS[grain]}", start, end)
+            row = conn.execute(sql, params).fetchone()
+        values.update({m.name: (value if value is not None else 0) for m, value in zip(metrics, row)})
+
+    for metric in derived:
+        values[metric.name] = metric.formula(values)
+
+    if version is not None:
+        _cache.update({(version, *period, name): value for name, value in values.items()})
+    return {name: values[name] for name in names}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headline metrics from the registry")
+    parser.add_argument('--start', help="purchase date from (inclusive), YYYY-MM-DD")
+    parser.add_argument('--end', help="purchase date to (exclusive), YYYY-MM-DD")
+    args = parser.parse_args()
+
+    conn = connect(DB)
+    try:
+        metrics = compute_metrics(conn, start=args.start, end=args.end)
+    except sqlite3.OperationalError as e:
+        print(f"Cannot compute metrics — run ETL first ({e})")
+        return
+    finally:
+        conn.close()
+
+    for name, value in metrics.items():
+        print(f"{name:<22} {value:>16,.2f}  {METRICS[name].description}")
+
+
+if __name__ == "__main__":
+    main()
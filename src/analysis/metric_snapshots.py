@@ -0,0 +1,166 @@
+"""
+Append-only metric snapshots: every run of final_metrics stores the registry
+metrics under a run id together with the data watermark (latest order
+purchase timestamp). Trend and "vs previous run" views read these rows
+instead of recomputing metrics over the full history. Runs are ordered by
+metric_snapshot_seq (AUTOINCREMENT at insert), not by run_at, which has
+one-second resolution.
+"""
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from query_log import connect, read_sql
+
+DB = Path(__file__).resolve().parents[2] / "data" / "ecommerce.db"
+
+SNAPSHOT_DDL = """
+CREATE TABLE IF NOT EXISTS metric_snapshot_runs (
+    run_id TEXT PRIMARY KEY,
+    run_at TEXT NOT NULL,
+    watermark TEXT,
+    source TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_metric_snapshot_runs_watermark ON metric_snapshot_runs(watermark, run_at);
+CREATE TABLE IF NOT EXISTS metric_snapshots (
+    metric TEXT NOT NULL,
+    run_id TEXT NOT NULL REFERENCES metric_snapshot_runs(run_id),
+    value REAL,
+    PRIMARY KEY (metric, run_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_metric_snapshots_run ON metric_snapshots(run_id);
+-- Порядок запусков: run_at с точностью до секунды, а run_id оканчивается случайным uuid
+CREATE TABLE IF NOT EXISTS metric_snapshot_seq (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL UNIQUE REFERENCES metric_snapshot_runs(run_id)
+);
+
+-- Только добавление: изменить или удалить снимок нельзя
+CREATE TRIGGER IF NOT EXISTS metric_snapshot_runs_no_update BEFORE UPDATE ON metric_snapshot_runs
+BEGIN SELECT RAISE(ABORT, 'metric_snapshot_runs is append-only'); END;
+CREATE TRIGGER IF NOT EXISTS metric_snapshot_runs_no_delete BEFORE DELETE ON metric_snapshot_runs
+BEGIN SELECT RAISE(ABORT, 'metric_snapshot_runs is append-only'); END;
+CREATE TRIGGER IF NOT EXISTS metric_snapshots_no_update BEFORE UPDATE ON metric_snapshots
+BEGIN SELECT RAISE(ABORT, 'metric_snapshots is append-only'); END;
+CREATE TRIGGER IF NOT EXISTS metric_snapshots_no_delete BEFORE DELETE ON metric_snapshots
+BEGIN SELECT RAISE(ABORT, 'metric_snapshots is append-only'); END;
+CREATE TRIGGER IF NOT EXISTS metric_snapshot_seq_no_update BEFORE UPDATE ON metric_snapshot_seq
+BEGIN SELECT RAISE(ABORT, 'metric_snapshot_seq is append-only'); END;
+CREATE TRIGGER IF NOT EXISTS metric_snapshot_seq_no_delete BEFORE DELETE ON metric_snapshot_seq
+BEGIN SELECT RAISE(ABORT, 'metric_snapshot_seq is append-only'); END;
+"""
+
+
+HISTORY_COLUMNS = ['seq', 'run_id', 'run_at', 'watermark', 'value']
+RUNS_SOURCE = "metric_snapshot_runs r JOIN metric_snapshot_seq q ON q.run_id = r.run_id"
+
+
+def ensure_snapshot_tables(conn):
+    conn.executescript(SNAPSHOT_DDL)
+
+
+def has_snapshots(conn):
+    """Snapshot tables exist; readers may use a read-only connection and cannot create them."""
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'metric_snapshot_seq'"
+    ).fetchone() is not None
+
+
+def data_watermark(conn):
+    """Latest order purchase timestamp in the warehouse (None if empty)."""
+    return conn.execute("SELECT MAX(order_purchase_timestamp) FROM fact_orders").fetchone()[0]
+
+
+def record_snapshot(conn, metrics, source="final_metrics", run_id=None):
+    """Append one run's {metric: value} to the snapshot tables; returns the run id."""
+    run_at = datetime.now()
+    run_id = run_id or f"{run_at:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+    watermark = data_watermark(conn)
+
+    with conn:
+        ensure_snapshot_tables(conn)
+        conn.execute(
+            "INSERT INTO metric_snapshot_runs (run_id, run_at, watermark, source) VALUES (?, ?, ?, ?)",
+            (run_id, run_at.isoformat(timespec='seconds'), watermark, source)
+        )
+        conn.execute("INSERT INTO metric_snapshot_seq (run_id) VALUES (?)", (run_id,))
+        conn.executemany(
+            "INSERT INTO metric_snapshots (metric, run_id, value) VALUES (?, ?, ?)",
+            [(name, run_id, float(value)) for name, value in metrics.items() if value is not None]
+        )
+    return run_id
+
+
+def metric_history(conn, metric, since=None, per_watermark=False):
+    """
+    Values of one metric over runs, oldest first: seq, run_id, run_at, watermark, value.
+    per_watermark: keep only the latest run for each data watermark.
+    """
+    if not has_snapshots(conn):
+        return pd.DataFrame(columns=HISTORY_COLUMNS)
+    query = f"""
+        SELECT q.seq, r.run_id, r.run_at, r.watermark, s.value
+        FROM {RUNS_SOURCE}
+        JOIN metric_snapshots s ON s.run_id = r.run_id
+        WHERE s.metric = ?
+    """
+    params = [metric]
+    if since is not None:
+        query += " AND r.run_at >= ?"
+        params.append(str(pd.Timestamp(since).isoformat()))
+    history = read_sql(query + " ORDER BY q.seq", conn, params=params)
+
+    if per_watermark:
+        history = history.drop_duplicates('watermark', keep='last').reset_index(drop=True)
+    return history
+
+
+def metric_deltas(conn, metric, since=None, per_watermark=True):
+    """metric_history plus absolute and percent change vs the previous snapshot."""
+    history = metric_history(conn, metric, since, per_watermark)
+    history['delta'] = history['value'].diff()
+    history['delta_pct'] = (history['value'].pct_change() * 100).round(2)
+    return history
+
+
+def latest_deltas(conn):
+    """Every metric of the latest run next to the previous run with a different watermark."""
+    if not has_snapshots(conn):
+        return pd.DataFrame()
+    runs = read_sql(f"SELECT r.run_id, r.watermark FROM {RUNS_SOURCE} ORDER BY q.seq", conn)
+    if runs.empty:
+        return pd.DataFrame()
+
+    runs = runs.iloc[::-1]
+    latest = runs.iloc[0]
+    earlier = runs[runs['watermark'].ne(latest['watermark'])]
+    previous_run = earlier['run_id'].iloc[0] if not earlier.empty else None
+
+    snapshots = read_sql(
+        "SELECT metric, run_id, value FROM metric_snapshots WHERE run_id IN (?, ?)",
+        conn, params=[latest['run_id'], previous_run]
+    )
+    table = snapshots.pivot(index='metric', columns='run_id', values='value')
+    result = pd.DataFrame({'current': table[latest['run_id']]})
+    result['previous'] = table[previous_run] if previous_run in table else float('nan')
+    result['delta'] = result['current'] - result['previous']
+    result['delta_pct'] = (result['delta'] / result['previous'].abs() * 100).round(2)
+    return result.reset_index()
+
+
+def main():
+    conn = connect(DB)
+    deltas = latest_deltas(conn)
+    conn.close()
+
+    if deltas.empty:
+        print("No metric snapshots yet — run final_metrics.py first.")
+        return
+    print("METRICS VS PREVIOUS DATA WATERMARK:")
+    print(deltas.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
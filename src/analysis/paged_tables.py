@@ -0,0 +1,156 @@
+"""
+Server-side paging, sorting and filtering for dashboard tables.
+Dash DataTable state (page_current, page_size, sort_by, filter_query) is
+translated into a parameterized WHERE / ORDER BY / LIMIT / OFFSET query
+against an indexed table, so only the visible page is read and serialized.
+"""
+import re
+
+import pandas as pd
+
+# Операторы filter_query DataTable -> SQL
+FILTER_OPERATORS = {
+    '=': '=', 'eq': '=', 's=': '=',
+    '!=': '!=', 'ne': '!=', 's!=': '!=',
+    '<': '<', 'lt': '<', 's<': '<',
+    '<=': '<=', 'le': '<=', 's<=': '<=',
+    '>': '>', 'gt': '>', 's>': '>',
+    '>=': '>=', 'ge': '>=', 's>=': '>=',
+    'contains': 'LIKE', 'icontains': 'LIKE', 'scontains': 'LIKE',
+    'datestartswith': 'LIKE',
+}
+
+FILTER_PART = re.compile(
+    r"^\{(?P<column>[^}]+)\}\s*(?P<op>s?(?:>=|<=|!=|=|<|>)|[a-z]+)\s*(?P<value>.*)$"
+)
+
+
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def _parse_value(raw):
+    raw = raw.strip()
+    if len(raw) >= 2 and raw[0] == raw[-1] and raw[0] in "\"'`":
+        return raw[1:-1]
+    try:
+        return float(raw) if any(c in raw for c in '.eE') else int(raw)
+    except ValueError:
+        return raw
+
+
+def _escape_like(value):
+    return str(value).replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def parse_filter_query(filter_query, columns):
+    """
+    [(column, operator, value)] for a DataTable filter_query such as
+    '{customer_city} contains "sao" && {orders_count} >= 10'.
+    Unknown columns and operators are rejected with ValueError.
+    """
+    conditions = []
+    for part in (filter_query or '').split(' && '):
+        part = part.strip()
+        if not part:
+            continue
+        match = FILTER_PART.match(part)
+        if not match:
+            raise ValueError(f"Unsupported filter expression: {part}")
+        column, op, raw = match['column'], match['op'], match['value']
+        if column not in columns:
+            raise ValueError(f"Unknown column in filter: {column}")
+        if op not in FILTER_OPERATORS:
+            raise ValueError(f"Unsupported filter operator: {op}")
+        conditions.append((column, op, _parse_value(raw)))
+    return conditions
+
+
+def filter_to_sql(filter_query, columns):
+    """WHERE clause and params for a DataTable filter_query."""
+    clauses, params = [], []
+    for column, op, value in parse_filter_query(filter_query, columns):
+        if op in ('contains', 'icontains', 'scontains'):
+            clauses.append(f'"{column}" LIKE ? ESCAPE \'\\\'')
+            params.append(f"%{_escape_like(value)}%")
+        elif op == 'datestartswith':
+            clauses.append(f'"{column}" LIKE ? ESCAPE \'\\\'')
+            params.append(f"{_escape_like(value)}%")
+        else:
+            clauses.append(f'"{column}" {FILTER_OPERATORS[op]} ?')
+            params.append(value)
+
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+
+def sort_to_sql(sort_by, columns):
+    """ORDER BY clause for DataTable sort_by ([{'column_id': ..., 'direction': 'asc'|'desc'}])."""
+    _validate_sort(sort_by, columns)
+    terms = []
+    for sort in sort_by or []:
+        column = sort['column_id']
+        terms.append(f'"{column}" {"DESC" if sort.get("direction") == "desc" else "ASC"}')
+    return (" ORDER BY " + ", ".join(terms)) if terms else ""
+
+
+def query_page(conn, table, page_current=0, page_size=20, sort_by=None, filter_query=None, default_sort=None):
+    """
+    One page of a table: (records, total matching rows).
+    default_sort is applied when the user has not sorted, for stable paging.
+    """
+    columns = table_columns(conn, table)
+    if not columns:
+        return [], 0
+
+    where, params = filter_to_sql(filter_query, columns)
+    order = sort_to_sql(sort_by or default_sort, columns)
+    total = conn.execute(f"SELECT COUNT(*) FROM {table}{where}", params).fetchone()[0]
+
+    cursor = conn.execute(
+        f"SELECT * FROM {table}{where}{order} LIMIT ? OFFSET ?",
+        params + [int(page_size), int(page_current or 0) * int(page_size)]
+    )
+    names = [d[0] for d in cursor.description]
+    return [dict(zip(names, row)) for row in cursor.fetchall()], total
+
+
+def _validate_sort(sort_by, columns):
+    for sort in sort_by or []:
+        if sort['column_id'] not in columns:
+            raise ValueError(f"Unknown sort column: {sort['column_id']}")
+
+
+def frame_page(df, page_current=0, page_size=20, sort_by=None, filter_query=None, default_sort=None):
+    """query_page for an in-memory DataFrame (snapshot mode): same filter syntax and semantics."""
+    columns = list(df.columns)
+    mask = pd.Series(True, index=df.index)
+    for column, op, value in parse_filter_query(filter_query, columns):
+        series = df[column]
+        if op in ('contains', 'icontains', 'scontains'):
+            # LIKE в SQLite регистронезависим для ASCII — повторяем это поведение
+            mask &= series.astype(str).str.contains(str(value), case=False, regex=False)
+        elif op == 'datestartswith':
+            mask &= series.astype(str).str.startswith(str(value))
+        else:
+            mask &= series.notna() & _compare(series, FILTER_OPERATORS[op], value)
+
+    sort_by = sort_by or default_sort
+    _validate_sort(sort_by, columns)
+    result = df[mask]
+    if sort_by:
+        result = result.sort_values([s['column_id'] for s in sort_by],
+                                    ascending=[s.get('direction') != 'desc' for s in sort_by],
+                                    na_position='first', kind='stable')
+
+    start = int(page_current or 0) * int(page_size)
+    page = result.iloc[start:start + int(page_size)]
+    return page.astype(object).where(page.notna(), None).to_dict('records'), len(result)
+
+
+def _compare(series, op, value):
+    if isinstance(value, str) and series.dtype.kind in 'iuf':
+        return pd.Series(False, index=series.index)
+    return {
+        '=': series.__eq__, '!=': series.__ne__, '<': series.__lt__,
+        '<=': series.__le__, '>': series.__gt__, '>=': series.__ge__,
+    }[op](value)
@@ -0,0 +1,326 @@
+"""
+Monthly partitions of fact_orders / fact_order_items inside the warehouse:
+one pair of tables per purchase month (items follow their order),
+part_fact_orders_YYYY_MM and part_fact_order_items_YYYY_MM, described by
+the partition_catalog table.
+
+The ETL splits each load by purchase month and rewrites only the partitions
+whose content hash changed, so past months are written once. Full-history
+jobs (cohorts, RFM, SLA, data quality) keep reading fact_orders; anything
+filtered by purchase date goes through prune_partitions(), which keeps only
+the months overlapping [start, end), so recent periods cost the same however
+many years are stored:
+
+    sql, params = range_query(conn, (
+        "SELECT c.customer_state, SUM(o.order_total) AS gmv FROM {orders} o "
+        "JOIN dim_customers c ON c.customer_id = o.customer_id "
+        "WHERE {in_range} GROUP BY 1"
+    ), start='2018-06-01')
+
+{orders} / {items} expand to the pruned tables (UNION ALL when several
+months overlap) and {in_range} to the purchase timestamp condition. Closed
+months can be compacted one at a time: their tables are rewritten in key
+order and the freed pages are returned with incremental vacuum.
+"""
+import argparse
+import sqlite3
+import time
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from query_log import connect, read_sql
+
+DB = Path(__file__).resolve().parents[2] / "data" / "ecommerce.db"
+
+CATALOG_TABLE = "partition_catalog"
+ORDERS_PREFIX = "part_fact_orders_"
+ITEMS_PREFIX = "part_fact_order_items_"
+# Заказы без даты покупки: участвуют только в запросах без фильтра по дате
+UNDATED_KEY = "undated"
+# Партиции старше N месяцев от последней считаются закрытыми и сжимаются
+COMPACT_AFTER_MONTHS = 3
+PURCHASE_COLUMN = "order_purchase_timestamp"
+
+CATALOG_DDL = f"""
+CREATE TABLE IF NOT EXISTS {CATALOG_TABLE} (
+    partition_key TEXT PRIMARY KEY,
+    orders_table TEXT NOT NULL,
+    items_table TEXT NOT NULL,
+    range_start TEXT,
+    range_end TEXT,
+    orders INTEGER NOT NULL,
+    items INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    written_at TEXT NOT NULL,
+    compacted_at TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_{CATALOG_TABLE}_range ON {CATALOG_TABLE}(range_start, range_end);
+"""
+
+# Индексы партиции: {table} — имя таблицы заказов или позиций
+ORDERS_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_{table}_order_id ON {table}(order_id)",
+    "CREATE INDEX IF NOT EXISTS idx_{table}_purchase ON {table}(order_purchase_timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_{table}_customer ON {table}(customer_id)",
+]
+ITEMS_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_{table}_order_id ON {table}(order_id)",
+]
+
+
+def ensure_catalog(conn):
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({CATALOG_TABLE})")}
+    # Каталог прежнего файлового архива (без имён таблиц) пересоздаётся
+    if columns and 'orders_table' not in columns:
+        conn.execute(f"DROP TABLE {CATALOG_TABLE}")
+    conn.executescript(CATALOG_DDL)
+
+
+def partition_keys(purchase_timestamps):
+    """'YYYY-MM' partition key per order ('undated' where the timestamp is missing)."""
+    ts = pd.to_datetime(purchase_timestamps, errors='coerce')
+    return ts.dt.strftime('%Y-%m').fillna(UNDATED_KEY)
+
+
+def partition_tables(key):
+    """(orders table, items table) of a partition key."""
+    suffix = key.replace('-', '_')
+    return ORDERS_PREFIX + suffix, ITEMS_PREFIX + suffix
+
+
+def partition_range(key):
+    """[range_start, range_end) of a partition as ISO dates (None for undated)."""
+    if key == UNDATED_KEY:
+        return None, None
+    start = pd.Timestamp(f"{key}-01")
+    return start.strftime('%Y-%m-%d'), (start + pd.DateOffset(months=1)).strftime('%Y-%m-%d')
+
+
+def content_hash(orders, items):
+    """Order-independent fingerprint of a partition's rows."""
+    parts = []
+    for df in (orders, items):
+        hashed = pd.util.hash_pandas_object(df, index=False) if len(df) else pd.Series([], dtype='uint64')
+        parts.append(f"{len(df)}:{int(hashed.sum()) & 0xFFFFFFFFFFFFFFFF:016x}")
+    return "/".join(parts)
+
+
+def _swap_table(conn, table, staging, indexes):
+    """Replace table with staging and rebuild its indexes (inside the caller's transaction)."""
+    conn.execute(f'DROP TABLE IF EXISTS "{table}"')
+    conn.execute(f'ALTER TABLE "{staging}" RENAME TO "{table}"')
+    for ddl in indexes:
+        conn.execute(ddl.format(table=table))
+
+
+def write_partitions(conn, orders, items):
+    """
+    Split the fact frames by purchase month and (re)write changed partitions.
+    Returns {'written': [...], 'unchanged': n, 'removed': [...]}.
+    """
+    keys = partition_keys(orders[PURCHASE_COLUMN])
+    item_keys = items['order_id'].map(pd.Series(keys.to_numpy(), index=orders['order_id'].to_numpy()))
+    # Позиции без заказа в загрузке в партиции не попадают (как и в join витрин)
+    item_rows = items.groupby(item_keys, sort=False).indices
+
+    ensure_catalog(conn)
+    known = dict(conn.execute(f"SELECT partition_key, content_hash FROM {CATALOG_TABLE}").fetchall())
+
+    written, unchanged = [], 0
+    for key, part_orders in orders.groupby(keys, sort=True):
+        part_orders = part_orders.sort_values('order_id')
+        part_items = items.iloc[item_rows.get(key, [])].sort_values(['order_id', 'order_item_id'])
+        digest = content_hash(part_orders, part_items)
+        if known.get(key) == digest:
+            unchanged += 1
+            continue
+
+        orders_table, items_table = partition_tables(key)
+        range_start, range_end = partition_range(key)
+        # Данные пишутся в промежуточные таблицы (to_sql коммитит сам), подмена таблиц
+        # и строка каталога — одной транзакцией: читатели видят партицию целиком
+        part_orders.to_sql(f"{orders_table}__staging", conn, if_exists="replace", index=False)
+        part_items.to_sql(f"{items_table}__staging", conn, if_exists="replace", index=False)
+        with conn:
+            conn.execute("BEGIN")
+            _swap_table(conn, orders_table, f"{orders_table}__staging", ORDERS_INDEXES)
+            _swap_table(conn, items_table, f"{items_table}__staging", ITEMS_INDEXES)
+            conn.execute(f"""
+                INSERT OR REPLACE INTO {CATALOG_TABLE}
+                (partition_key, orders_table, items_table, range_start, range_end, orders, items,
+                 content_hash, written_at, compacted_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)
+            """, (key, orders_table, items_table, range_start, range_end, len(part_orders),
+                  len(part_items), digest, datetime.now().isoformat(timespec='seconds')))
+        written.append(key)
+
+    removed = sorted(set(known) - set(keys.unique()))
+    for key in removed:
+        with conn:
+            conn.execute("BEGIN")
+            for table in partition_tables(key):
+                conn.execute(f'DROP TABLE IF EXISTS "{table}"')
+            conn.execute(f"DELETE FROM {CATALOG_TABLE} WHERE partition_key = ?", (key,))
+    return {'written': written, 'unchanged': unchanged, 'removed': removed}
+
+
+def load_catalog(conn):
+    return read_sql(f"SELECT * FROM {CATALOG_TABLE} ORDER BY partition_key", conn)
+
+
+def prune_partitions(conn, start=None, end=None):
+    """Catalog rows of the partitions overlapping [start, end) (all of them without a range)."""
+    if start is None and end is None:
+        return load_catalog(conn)
+    # Границы — ISO-строки, поэтому сравниваются как текст
+    return read_sql(f"""
+        SELECT * FROM {CATALOG_TABLE}
+        WHERE range_start IS NOT NULL
+          AND (? IS NULL OR range_end > ?)
+          AND (? IS NULL OR range_start < ?)
+        ORDER BY partition_key
+    """, conn, params=(start, start, end, end))
+
+
+def union_source(tables, empty_table):
+    """FROM source over the given tables: one table as is, several as UNION ALL."""
+    if not tables:
+        return f"(SELECT * FROM {empty_table} WHERE 0)"
+    if len(tables) == 1:
+        return tables[0]
+    return "(" + " UNION ALL ".join(f"SELECT * FROM {table}" for table in tables) + ")"
+
+
+def range_query(conn, sql, start=None, end=None, params=()):
+    """
+    Expand {orders}, {items} and {in_range} in sql for [start, end).
+    Returns (sql, params) with the range bounds bound before params.
+    """
+    catalog = prune_partitions(conn, start, end)
+    in_range, range_params = ["1 = 1"], []
+    if start is not None:
+        in_range.append(f"{PURCHASE_COLUMN} >= ?")
+        range_params.append(str(start))
+    if end is not None:
+        in_range.append(f"{PURCHASE_COLUMN} < ?")
+        range_params.append(str(end))
+
+    expanded = sql.format(
+        orders=union_source(list(catalog['orders_table']), 'fact_orders'),
+        items=union_source(list(catalog['items_table']), 'fact_order_items'),
+        in_range=" AND ".join(in_range),
+    )
+    # {in_range} стоит в WHERE, до остальных параметров запроса
+    return expanded, range_params * sql.count("{in_range}") + list(params)
+
+
+def read_range(conn, sql, start=None, end=None, params=()):
+    """sql (with {orders} / {items} / {in_range}) over the partitions overlapping [start, end)."""
+    expanded, all_params = range_query(conn, sql, start, end, params)
+    return read_sql(expanded, conn, params=all_params)
+
+
+def ensure_incremental_vacuum(conn):
+    """
+    Switch the warehouse to auto_vacuum=INCREMENTAL so that compaction can
+    return one partition's free pages; an existing file needs one VACUUM.
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+
+
+def compact_partition(conn, key):
+    """
+    Rewrite one partition's tables in key order and release the pages freed;
+    other partitions are not touched. Returns bytes saved.
+    """
+    row = conn.execute(
+        f"SELECT orders_table, items_table FROM {CATALOG_TABLE} WHERE partition_key = ?", (key,)
+    ).fetchone()
+    if row is None:
+        raise KeyError(f"Unknown partition: {key}")
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    before = conn.execute("PRAGMA page_count").fetchone()[0]
+
+    with conn:
+        conn.execute("BEGIN")
+        for table, indexes, order in ((row[0], ORDERS_INDEXES, "order_id"),
+                                      (row[1], ITEMS_INDEXES, "order_id, order_item_id")):
+            conn.execute(f'CREATE TABLE "{table}__staging" AS SELECT * FROM "{table}" ORDER BY {order}')
+            _swap_table(conn, table, f"{table}__staging", indexes)
+        conn.execute(
+            f"UPDATE {CATALOG_TABLE} SET compacted_at = ? WHERE partition_key = ?",
+            (datetime.now().isoformat(timespec='seconds'), key),
+        )
+    # Освобождённые страницы возвращаются без перезаписи всего файла
+    conn.execute("PRAGMA incremental_vacuum").fetchall()
+    return (before - conn.execute("PRAGMA page_count").fetchone()[0]) * page_size
+
+
+def compact_old_partitions(conn, older_than_months=COMPACT_AFTER_MONTHS):
+    """Compact closed partitions (older than N months before the newest one) not compacted since their last write."""
+    catalog = load_catalog(conn)
+    dated = catalog[catalog['range_start'].notna()]
+    if dated.empty:
+        return {}
+    cutoff = (pd.Timestamp(dated['range_start'].max()) - pd.DateOffset(months=older_than_months)).strftime('%Y-%m-%d')
+    todo = dated[(dated['range_start'] < cutoff) & dated['compacted_at'].isna()]
+    if todo.empty:
+        return {}
+    ensure_incremental_vacuum(conn)
+    return {key: compact_partition(conn, key) for key in todo['partition_key']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monthly partitions of fact_orders / fact_order_items")
+    parser.add_argument('--compact', action='store_true', help="compact closed partitions")
+    parser.add_argument('--older-than', type=int, default=COMPACT_AFTER_MONTHS, help="months")
+    args = parser.parse_args()
+
+    if not DB.exists():
+        print(f"Database not found at {DB}. Run ETL first.")
+        return
+
+    conn = connect(DB)
+    try:
+        try:
+            catalog = load_catalog(conn)
+        except (sqlite3.OperationalError, pd.errors.DatabaseError):
+            print("No partitions — run ETL first.")
+            return
+
+        if args.compact:
+            saved = compact_old_partitions(conn, args.older_than)
+            for key, delta in saved.items():
+                print(f"  compacted {key}: {delta / 1024:.1f} KB freed")
+            print(f"Compacted {len(saved)} partitions")
+            catalog = load_catalog(conn)
+
+        print(f"{len(catalog)} partitions, {catalog['orders'].sum():,} orders, {catalog['items'].sum():,} items")
+        print(catalog[['partition_key', 'orders', 'items', 'written_at', 'compacted_at']].tail(6).to_string(index=False))
+
+        # Последние 3 месяца: пропуск лишних партиций против полного сканирования fact_orders
+        start = (pd.Timestamp(catalog['range_start'].dropna().max()) - pd.DateOffset(months=2)).strftime('%Y-%m-%d')
+        sql = "SELECT COUNT(*) AS orders, SUM(order_total) AS gmv FROM {orders} WHERE {in_range}"
+        started = time.perf_counter()
+        pruned = read_range(conn, sql, start=start)
+        pruned_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        full = read_sql(f"SELECT COUNT(*) AS orders, SUM(order_total) AS gmv FROM fact_orders "
+                        f"WHERE {PURCHASE_COLUMN} >= ?", conn, params=(start,))
+        full_ms = (time.perf_counter() - started) * 1000
+        scanned = len(prune_partitions(conn, start=start))
+    finally:
+        conn.close()
+
+    status = "✅ in sync" if int(pruned['orders'].iloc[0]) == int(full['orders'].iloc[0]) else "❌ out of sync"
+    print(f"\nOrders since {start}: {int(pruned['orders'].iloc[0]):,} from "
+          f"{scanned} partitions in {pruned_ms:.1f} ms, "
+          f"fact_orders scan {full_ms:.1f} ms ({status})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""
+Instrumented SQLite access for the pipeline scripts.
+
+connect() returns a sqlite3.Connection whose cursors record, for every
+statement: normalized text, call site, duration (execute + fetch), rows
+returned and, through read_sql(), bytes materialized into pandas. The
+EXPLAIN QUERY PLAN of each distinct SELECT is captured once.
+
+Statements slower than SLOW_QUERY_MS are appended to the slow-query log;
+per-statement aggregates are written at process exit and grouped by
+PIPELINE_RUN_ID (shared by all tasks of one DAG run), so
+
+    python src/analysis/query_log.py [--run RUN_ID] [--top 15]
+
+shows where SQL time went in the latest (or given) pipeline run.
+Set QUERY_LOG=0 to disable recording.
+"""
+import argparse
+import atexit
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+LOG_DIR = Path(__file__).resolve().parents[2] / "data" / "query_logs"
+SLOW_QUERY_LOG = LOG_DIR / "slow_queries.jsonl"
+
+ENABLED = os.environ.get("QUERY_LOG", "1") != "0"
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 250))
+RUN_ID = os.environ.get("PIPELINE_RUN_ID") or f"{datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}"
+TOP_N = 15
+
+_THIS_FILE = os.path.normcase(os.path.abspath(__file__))
+_SKIP_PATHS = (os.sep + 'pandas' + os.sep, os.sep + 'sqlite3' + os.sep)
+
+_COMMENT = re.compile(r"--[^\n]*")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE = re.compile(r"\s+")
+
+_stats = {}
+_lock = threading.Lock()
+_current = threading.local()
+
+
+def normalize_sql(sql):
+    """Statement shape: comments and whitespace collapsed, literals and IN lists replaced by ?."""
+    sql = _COMMENT.sub(" ", sql)
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = _IN_LIST.sub("(?...)", sql)
+    return _SPACE.sub(" ", sql).strip()
+
+
+def call_site():
+    """file:line function of the first caller outside this module, pandas and sqlite3."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        path = os.path.normcase(os.path.abspath(frame.f_code.co_filename))
+        if path != _THIS_FILE and not any(part in path for part in _SKIP_PATHS):
+            return f"{Path(path).name}:{frame.f_lineno} {frame.f_code.co_name}"
+        frame = frame.f_back
+    return "?"
+
+
+class QueryRecord:
+    """One execution of a statement; fetches and read_sql add to it."""
+
+    def __init__(self, sql, site):
+        self.sql = sql
+        self.normalized = normalize_sql(sql)
+        self.site = site
+        self.seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.logged = False
+        with _lock:
+            self.entry = _stats.setdefault((self.normalized, site), {
+                'normalized': self.normalized, 'call_site': site, 'calls': 0,
+                'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0, 'bytes': 0, 'plan': None,
+            })
+            self.entry['calls'] += 1
+
+    def add(self, seconds=0.0, rows=0, nbytes=0):
+        self.seconds += seconds
+        self.rows += rows
+        self.bytes += nbytes
+        with _lock:
+            self.entry['seconds'] += seconds
+            self.entry['rows'] += rows
+            self.entry['bytes'] += nbytes
+            self.entry['max_seconds'] = max(self.entry['max_seconds'], self.seconds)
+
+    def finish(self):
+        """Statement done: write it to the slow-query log if it was over the threshold."""
+        if self.logged or self.seconds * 1000 < SLOW_QUERY_MS:
+            return
+        self.logged = True
+        record = {
+            'at': datetime.now().isoformat(timespec='seconds'), 'run_id': RUN_ID,
+            'ms': round(self.seconds * 1000, 1), 'rows': self.rows, 'bytes': self.bytes,
+            'call_site': self.site, 'normalized': self.normalized, 'plan': self.entry['plan'],
+        }
+        with _lock:
+            LOG_DIR.mkdir(parents=True, exist_ok=True)
+            with open(SLOW_QUERY_LOG, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+class LoggedCursor(sqlite3.Cursor):
+    _record = None
+
+    def _start(self, sql):
+        self._record = QueryRecord(sql, call_site())
+        _current.record = self._record
+        return self._record
+
+    def _explain(self, record, sql, params):
+        if record.entry['plan'] is not None or not sql.lstrip()[:6].upper() in ('SELECT', 'WITH'):
+            return
+        try:
+            plan = sqlite3.Cursor(self.connection).execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+            record.entry['plan'] = [row[-1] for row in plan]
+        except sqlite3.Error:
+            record.entry['plan'] = []
+
+    def execute(self, sql, parameters=()):
+        record = self._start(sql)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record.add(time.perf_counter() - started)
+            if self.description is None:
+                record.add(rows=max(self.rowcount, 0))
+                record.finish()
+            self._explain(record, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        record = self._start(sql)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record.add(time.perf_counter() - started, rows=max(self.rowcount, 0))
+            record.finish()
+
+    def executescript(self, sql_script):
+        record = self._start(sql_script)
+        started = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            record.add(time.perf_counter() - started)
+            record.finish()
+
+    def _fetched(self, started, rows, done):
+        if self._record is not None:
+            self._record.add(time.perf_counter() - started, rows=rows)
+            if done:
+                self._record.finish()
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, int(row is not None), True)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._fetched(started, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows), True)
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(started, 0, True)
+            raise
+        self._fetched(started, 1, False)
+        return row
+
+
+class LoggedConnection(sqlite3.Connection):
+    def cursor(self, factory=LoggedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+def connect(database, **kwargs):
+    """sqlite3.connect with statement instrumentation (plain connection when QUERY_LOG=0)."""
+    if ENABLED:
+        kwargs.setdefault('factory', LoggedConnection)
+    return sqlite3.connect(database, **kwargs)
+
+
+def _frame_bytes(df):
+    return int(df.memory_usage(deep=True).sum())
+
+
+def read_sql(sql, conn, params=None, chunksize=None, **kwargs):
+    """pd.read_sql_query that also records the bytes of the resulting DataFrame(s)."""
+    _current.record = None
+    result = pd.read_sql_query(sql, conn, params=params, chunksize=chunksize, **kwargs)
+    if chunksize is not None:
+        return _logged_chunks(result)
+
+    record = getattr(_current, 'record', None)
+    if record is not None:
+        record.add(nbytes=_frame_bytes(result))
+        record.finish()
+    return result
+
+
+def _logged_chunks(chunks):
+    record = None
+    for chunk in chunks:
+        record = record or getattr(_current, 'record', None)
+        if record is not None:
+            record.add(nbytes=_frame_bytes(chunk))
+        yield chunk
+    if record is not None:
+        record.finish()
+
+
+def top_statements(n=TOP_N):
+    """Statements of this process by total time: list of dicts (for /stats and reports)."""
+    with _lock:
+        entries = [dict(e) for e in _stats.values()]
+    entries.sort(key=lambda e: e['seconds'], reverse=True)
+    return entries[:n]
+
+
+def write_run_stats():
+    """Aggregates of this process to LOG_DIR/run-<run_id>-<pid>.json (called at exit)."""
+    entries = top_statements(len(_stats))
+    if not entries:
+        return None
+    LOG_DIR.mkdir(parents=True, exist_ok=True)
+    path = LOG_DIR / f"run-{RUN_ID}-{os.getpid()}.json"
+    path.write_text(json.dumps({
+        'run_id': RUN_ID, 'pid': os.getpid(), 'argv': sys.argv,
+        'written_at': datetime.now().isoformat(timespec='seconds'), 'statements': entries,
+    }, ensure_ascii=False, indent=1))
+    return path
+
+
+if ENABLED:
+    atexit.register(write_run_stats)
+
+
+def load_run(run_id=None):
+    """Per-statement aggregates of one pipeline run (all its processes); latest run by default."""
+    files = sorted(LOG_DIR.glob("run-*.json"), key=lambda p: p.stat().st_mtime)
+    if not files:
+        return None, pd.DataFrame()
+    runs = [json.loads(p.read_text()) for p in files]
+    run_id = run_id or runs[-1]['run_id']
+
+    rows = []
+    for run in runs:
+        if run['run_id'] != run_id:
+            continue
+        script = Path(run['argv'][0]).name if run.get('argv') else '?'
+        for entry in run['statements']:
+            rows.append({**entry, 'script': script, 'plan': entry.get('plan') or []})
+    df = pd.DataFrame(rows)
+    if df.empty:
+        return run_id, df
+
+    report = df.groupby(['normalized', 'call_site'], as_index=False).agg(
+        script=('script', 'first'), calls=('calls', 'sum'), seconds=('seconds', 'sum'),
+        max_seconds=('max_seconds', 'max'), rows=('rows', 'sum'), bytes=('bytes', 'sum'),
+        plan=('plan', 'first'),
+    ).sort_values('seconds', ascending=False)
+    report['share_pct'] = (report['seconds'] / report['seconds'].sum() * 100).round(1)
+    return run_id, report.reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Top SQL statements of a pipeline run")
+    parser.add_argument('--run', help="PIPELINE_RUN_ID (default: latest)")
+    parser.add_argument('--top', type=int, default=TOP_N)
+    args = parser.parse_args()
+
+    run_id, report = load_run(args.run)
+    if report.empty:
+        print(f"No query statistics in {LOG_DIR} — run a pipeline script first.")
+        return
+
+    print(f"SQL TIME BY STATEMENT — run {run_id}: {report['seconds'].sum():.2f}s in "
+          f"{int(report['calls'].sum())} calls, {len(report)} distinct statements")
+    for i, row in enumerate(report.head(args.top).itertuples(), 1):
+        print(f"\n{i:2d}. {row.share_pct:5.1f}%  {row.seconds * 1000:9.1f} ms  {row.calls} calls  "
+              f"max {row.max_seconds * 1000:.1f} ms  {row.rows:,} rows  {row.bytes / 2 ** 20:.1f} MB")
+        print(f"    {row.call_site} ({row.script})")
+        print(f"    {row.normalized[:160]}")
+        for step in row.plan:
+            # SCAN без индекса — первый кандидат на оптимизацию
+            marker = "  <- full scan" if step.startswith('SCAN') and 'INDEX' not in step else ""
+            print(f"      {step}{marker}")
+
+    if SLOW_QUERY_LOG.exists():
+        slow = [json.loads(line) for line in SLOW_QUERY_LOG.read_text(encoding='utf-8').splitlines()]
+        slow = [s for s in slow if s['run_id'] == run_id]
+        print(f"\nSlow queries (>{SLOW_QUERY_MS:.0f} ms) in this run: {len(slow)} — see {SLOW_QUERY_LOG}")
+
+
+if __name__ == "__main__":
+    main()
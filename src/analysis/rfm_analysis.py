@@ -1,35 +1,161 @@
-import sqlite3
+"""
+RFM (Recency, Frequency, Monetary) segmentation keyed on customer_unique_id.
+Group reductions and 1-5 quantile scores are fully vectorized; results are
+persisted to the indexed mart_rfm table. The mart uses exact quantiles over
+all orders; rfm_state.rfm_from_state answers snapshot-date queries from the
+incremental state with sketch-based (approximate) breakpoints.
+"""
 import pandas as pd
-import matplotlib.pyplot as plt
+import numpy as np
 from pathlib import Path
 
+from query_log import connect, read_sql
+
 DB = Path(__file__).resolve().parents[2] / "data" / "ecommerce.db"
 OUT = Path(__file__).resolve().parents[2] / "docs" / "dashboard_rfm.png"
 
-def main():
-    conn = sqlite3.connect(DB)
-    df = pd.read_sql("SELECT order_id, customer_id, order_purchase_timestamp, price FROM fact_orders", conn, parse_dates=['order_purchase_timestamp'])
-    conn.close()
-    if df.empty:
+# Дата среза; None — следующий день после последнего заказа в данных
+SNAPSHOT_DATE = None
+N_SCORES = 5
+
+# Сегменты по сетке R x F (строки R=1..5, столбцы F=1..5)
+SEGMENT_GRID = np.array([
+    ['Lost', 'Hibernating', 'At Risk', 'At Risk', "Can't Lose Them"],
+    ['Hibernating', 'Hibernating', 'At Risk', 'At Risk', "Can't Lose Them"],
+    ['About to Sleep', 'About to Sleep', 'Need Attention', 'Loyal Customers', 'Loyal Customers'],
+    ['Promising', 'Potential Loyalists', 'Potential Loyalists', 'Loyal Customers', 'Champions'],
+    ['New Customers', 'Potential Loyalists', 'Potential Loyalists', 'Champions', 'Champions'],
+], dtype=object)
+
+
+def load_orders(conn):
+    """One row per non-cancelled order: order_id, customer_unique_id, order_day, order_value (items + freight), order_status."""
+    query = """
+    SELECT
+        o.order_id,
+        c.customer_unique_id,
+        CAST(julianday(o.order_purchase_timestamp) - 2440587.5 AS INTEGER) AS order_day,
+        o.order_total AS order_value,
+        o.order_status
+    FROM fact_orders o
+    JOIN dim_customers c ON o.customer_id = c.customer_id
+    WHERE o.order_status NOT IN ('cancelled', 'unavailable')
+      AND o.order_purchase_timestamp IS NOT NULL
+    """
+    return read_sql(query, conn)
+
+
+def to_epoch_day(date):
+    return int((pd.Timestamp(date).normalize() - pd.Timestamp('1970-01-01')).days)
+
+
+def quantile_breakpoints(values, n_scores=N_SCORES):
+    """Inner quantile cut points (n_scores - 1 values) of a distribution."""
+    return np.quantile(np.asarray(values, dtype=np.float64), np.arange(1, n_scores) / n_scores)
+
+
+def quantile_score(values, breakpoints, higher_is_better=True):
+    """
+    1..n score = 1 + number of breakpoints strictly below the value.
+    Ties (e.g. the mass of one-order customers) share the lowest score.
+    """
+    below = np.searchsorted(breakpoints, np.asarray(values, dtype=np.float64), side='left')
+    if higher_is_better:
+        return (below + 1).astype(np.int8)
+    return (len(breakpoints) + 1 - below).astype(np.int8)
+
+
+def score_rfm(rfm, breakpoints=None, n_scores=N_SCORES):
+    """
+    Add r/f/m scores, rfm_score and segment columns.
+    breakpoints: optional {'recency': ..., 'frequency': ..., 'monetary': ...};
+    computed from rfm itself when not given.
+    """
+    if breakpoints is None:
+        breakpoints = {col: quantile_breakpoints(rfm[col], n_scores)
+                       for col in ('recency', 'frequency', 'monetary')}
+
+    rfm['r_score'] = quantile_score(rfm['recency'], breakpoints['recency'], higher_is_better=False)
+    rfm['f_score'] = quantile_score(rfm['frequency'], breakpoints['frequency'])
+    rfm['m_score'] = quantile_score(rfm['monetary'], breakpoints['monetary'])
+    return add_segments(rfm, n_scores)
+
+
+def add_segments(rfm, n_scores=N_SCORES):
+    """rfm_score (e.g. 512) and named segment from r/f/m score columns."""
+    rfm['rfm_score'] = (rfm['r_score'].astype(np.int16) * 100
+                        + rfm['f_score'].astype(np.int16) * 10
+                        + rfm['m_score'])
+
+    # Сетка задана для 5 баллов; для другого числа баллов масштабируем
+    r_idx = (rfm['r_score'].to_numpy() - 1) * 5 // n_scores
+    f_idx = (rfm['f_score'].to_numpy() - 1) * 5 // n_scores
+    rfm['segment'] = SEGMENT_GRID[r_idx, f_idx]
+    return rfm
+
+
+def compute_rfm(orders, snapshot=None, n_scores=N_SCORES):
+    """
+    Vectorized RFM over per-order rows (customer_unique_id, order_day, order_value).
+    snapshot: date for recency; default is the day after the last order.
+    """
+    rfm = orders.groupby('customer_unique_id', sort=False).agg(
+        last_order_day=('order_day', 'max'),
+        frequency=('order_day', 'size'),
+        monetary=('order_value', 'sum'),
+    ).reset_index()
+
+    snapshot_day = to_epoch_day(snapshot) if snapshot is not None else int(orders['order_day'].max()) + 1
+    rfm['recency'] = snapshot_day - rfm['last_order_day']
+    rfm['snapshot_date'] = str(pd.Timestamp(snapshot_day, unit='D').date())
+    rfm = rfm.drop(columns=['last_order_day'])
+
+    return score_rfm(rfm, n_scores=n_scores)
+
+
+def save_rfm_mart(conn, rfm, table="mart_rfm"):
+    rfm.to_sql(table, conn, if_exists="replace", index=False)
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_customer ON {table}(customer_unique_id)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_segment ON {table}(segment)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_score ON {table}(rfm_score)")
+    conn.commit()
+    print(f"{table} created: {len(rfm)} rows")
+
+
+def plot_segments(rfm, output_path):
+    import matplotlib.pyplot as plt
+
+    counts = rfm['segment'].value_counts()
+    plt.figure(figsize=(10, 6))
+    counts.plot(kind='barh')
+    plt.title(f"RFM segments (snapshot {rfm['snapshot_date'].iloc[0]})")
+    plt.xlabel("Customers")
+    plt.gca().invert_yaxis()
+    plt.tight_layout()
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    plt.savefig(output_path)
+    plt.close()
+
+
+def main(snapshot=SNAPSHOT_DATE):
+    conn = connect(DB)
+
+    # Витрина — точные квантили по всем заказам; состояние из rfm_state
+    # (скетч-квантили) служит для быстрых запросов на произвольную дату среза
+    orders = load_orders(conn)
+    if orders.empty:
         print("No orders in DB — run ETL first.")
+        conn.close()
         return
-    snapshot = pd.Timestamp('2023-04-01')
-    rfm = df.groupby('customer_id').agg({
-        'order_purchase_timestamp': lambda x: (snapshot - x.max()).days,
-        'order_id': 'count',
-        'price': 'sum'
-    }).rename(columns={'order_purchase_timestamp':'Recency','order_id':'Frequency','price':'Monetary'}).reset_index()
+    rfm = compute_rfm(orders, snapshot)
+
     print(rfm.head())
+    print(rfm['segment'].value_counts().to_string())
 
-    # very simple segmentation
-    rfm['Segment'] = ['High' if m>300 else 'Low' for m in rfm['Monetary']]
+    save_rfm_mart(conn, rfm)
+    conn.close()
 
-    counts = rfm['Segment'].value_counts()
-    counts.plot(kind='bar')
-    plt.title("RFM segments (simple)")
-    plt.tight_layout()
-    OUT.parent.mkdir(parents=True, exist_ok=True)
-    plt.savefig(OUT)
+    plot_segments(rfm, OUT)
     print("Saved RFM chart to", OUT)
 
 if __name__ == "__main__":
@@ -0,0 +1,232 @@
+"""
+Incrementally maintained per-customer RFM state.
+
+rfm_customer_state keeps last purchase day, order count and monetary sum per
+customer_unique_id and is updated from each batch of orders with O(batch)
+work. rfm_applied_orders is the per-order ledger (value, day, status as
+applied): unchanged orders are skipped, changed ones re-aggregate only their
+customers, and cancelled / unavailable orders are retracted.
+
+Score breakpoints come from histograms maintained alongside the state
+(rfm_histogram): an exact per-day histogram of last purchase days and
+DDSketch log-bucket histograms of frequency and monetary. Because a batch
+moves a customer from one bucket to another (-1 / +1), re-scoring never
+needs a full sort of all customers, and recency is derived at query time
+for any snapshot date.
+"""
+import numpy as np
+import pandas as pd
+
+from query_log import read_sql
+from rfm_analysis import N_SCORES, add_segments, quantile_score, to_epoch_day
+from sketches import DDSketch, histogram_quantiles
+
+RFM_RELATIVE_ACCURACY = 0.01
+RETRACTED_STATUSES = ('cancelled', 'unavailable')
+
+RFM_STATE_DDL = """
+CREATE TABLE IF NOT EXISTS rfm_customer_state (
+    customer_unique_id TEXT PRIMARY KEY,
+    first_order_day INTEGER NOT NULL,
+    last_order_day INTEGER NOT NULL,
+    frequency INTEGER NOT NULL,
+    monetary REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rfm_applied_orders (
+    order_id TEXT PRIMARY KEY,
+    customer_unique_id TEXT NOT NULL,
+    order_day INTEGER NOT NULL,
+    order_value REAL NOT NULL,
+    order_status TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_rfm_applied_orders_customer ON rfm_applied_orders(customer_unique_id);
+CREATE TABLE IF NOT EXISTS rfm_histogram (
+    metric TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    customers INTEGER NOT NULL,
+    PRIMARY KEY (metric, bucket)
+) WITHOUT ROWID;
+"""
+
+_sketch = DDSketch(RFM_RELATIVE_ACCURACY)
+
+
+def ensure_rfm_state(conn):
+    conn.executescript(RFM_STATE_DDL)
+
+
+def build_order_batch(orders, customers):
+    """
+    Order batch for update_rfm_state from ETL frames (orders carry order_total):
+    order_id, customer_unique_id, order_day, order_value, order_status.
+    Cancelled orders are kept so that update_rfm_state can retract them.
+    """
+    valid = orders[orders['order_purchase_timestamp'].notna()]
+    batch = valid[['order_id', 'customer_id', 'order_purchase_timestamp', 'order_total', 'order_status']].merge(
+        customers[['customer_id', 'customer_unique_id']], on='customer_id', how='inner'
+    )
+    batch['order_day'] = (batch['order_purchase_timestamp'] - pd.Timestamp('1970-01-01')).dt.days
+    batch['order_value'] = batch['order_total'].astype('float64')
+    return batch[['order_id', 'customer_unique_id', 'order_day', 'order_value', 'order_status']]
+
+
+def _histogram_buckets(state):
+    """(metric, bucket) pairs a customer state row contributes to."""
+    return pd.concat([
+        pd.DataFrame({'metric': 'last_order_day', 'bucket': state['last_order_day'].to_numpy()}),
+        pd.DataFrame({'metric': 'frequency', 'bucket': _sketch.bucket_index(state['frequency'])}),
+        pd.DataFrame({'metric': 'monetary', 'bucket': _sketch.bucket_index(state['monetary'])}),
+    ], ignore_index=True)
+
+
+def update_rfm_state(conn, batch):
+    """
+    Apply a batch of orders (order_id, customer_unique_id, order_day, order_value, order_status).
+    Orders applied with the same values are skipped, so overlapping batches
+    are safe; a changed value or day replaces the applied one and an order
+    that became cancelled / unavailable is retracted.
+    Returns the number of new or changed orders.
+    """
+    if batch.empty:
+        return 0
+
+    batch = batch.drop_duplicates('order_id', keep='last')
+    with conn:
+        ensure_rfm_state(conn)
+        conn.execute("DROP TABLE IF EXISTS temp._rfm_batch")
+        conn.execute("DROP TABLE IF EXISTS temp._rfm_customers")
+        conn.execute("""
+            CREATE TEMP TABLE _rfm_batch (
+                order_id TEXT PRIMARY KEY,
+                customer_unique_id TEXT NOT NULL,
+                order_day INTEGER NOT NULL,
+                order_value REAL NOT NULL,
+                order_status TEXT NOT NULL
+            ) WITHOUT ROWID
+        """)
+        conn.executemany(
+            "INSERT INTO _rfm_batch VALUES (?, ?, ?, ?, ?)",
+            zip(batch['order_id'], batch['customer_unique_id'],
+                batch['order_day'].astype(int).tolist(), batch['order_value'].astype(float).tolist(),
+                batch['order_status'])
+        )
+        # Остаются только новые заказы и заказы, у которых что-то изменилось
+        conn.execute("""
+            DELETE FROM _rfm_batch
+            WHERE EXISTS (
+                SELECT 1 FROM rfm_applied_orders a
+                WHERE a.order_id = _rfm_batch.order_id
+                  AND a.customer_unique_id = _rfm_batch.customer_unique_id
+                  AND a.order_day = _rfm_batch.order_day
+                  AND a.order_value = _rfm_batch.order_value
+                  AND a.order_status = _rfm_batch.order_status
+            )
+        """)
+        applied = conn.execute("SELECT COUNT(*) FROM _rfm_batch").fetchone()[0]
+        if applied == 0:
+            conn.execute("DROP TABLE temp._rfm_batch")
+            return 0
+
+        # Затронутые покупатели: из батча и прежние владельцы изменившихся заказов
+        conn.execute("""
+            CREATE TEMP TABLE _rfm_customers AS
+            SELECT customer_unique_id FROM _rfm_batch
+            UNION
+            SELECT a.customer_unique_id
+            FROM rfm_applied_orders a
+            JOIN _rfm_batch b ON b.order_id = a.order_id
+        """)
+        old = read_sql("""
+            SELECT s.*
+            FROM rfm_customer_state s
+            WHERE s.customer_unique_id IN (SELECT customer_unique_id FROM _rfm_customers)
+        """, conn)
+
+        conn.execute("INSERT OR REPLACE INTO rfm_applied_orders SELECT * FROM _rfm_batch")
+        placeholders = ", ".join("?" * len(RETRACTED_STATUSES))
+        new = read_sql(f"""
+            SELECT customer_unique_id,
+                   MIN(order_day) AS first_order_day,
+                   MAX(order_day) AS last_order_day,
+                   COUNT(*) AS frequency,
+                   SUM(order_value) AS monetary
+            FROM rfm_applied_orders
+            WHERE customer_unique_id IN (SELECT customer_unique_id FROM _rfm_customers)
+              AND order_status NOT IN ({placeholders})
+            GROUP BY customer_unique_id
+        """, conn, params=RETRACTED_STATUSES)
+
+        # Покупатель переезжает из старых корзин гистограмм в новые (или уходит из них совсем)
+        hist_delta = pd.concat([
+            _histogram_buckets(old).assign(customers=-1),
+            _histogram_buckets(new).assign(customers=1),
+        ]).groupby(['metric', 'bucket'], as_index=False)['customers'].sum()
+        hist_delta = hist_delta[hist_delta['customers'] != 0]
+
+        conn.execute("""
+            DELETE FROM rfm_customer_state
+            WHERE customer_unique_id IN (SELECT customer_unique_id FROM _rfm_customers)
+        """)
+        conn.executemany(
+            "INSERT INTO rfm_customer_state VALUES (?, ?, ?, ?, ?)",
+            zip(new['customer_unique_id'], new['first_order_day'].astype(int).tolist(),
+                new['last_order_day'].astype(int).tolist(), new['frequency'].astype(int).tolist(),
+                new['monetary'].astype(float).tolist())
+        )
+        conn.executemany("""
+            INSERT INTO rfm_histogram (metric, bucket, customers) VALUES (?, ?, ?)
+            ON CONFLICT(metric, bucket) DO UPDATE SET customers = customers + excluded.customers
+        """, zip(hist_delta['metric'], hist_delta['bucket'].astype(int).tolist(),
+                 hist_delta['customers'].astype(int).tolist()))
+        conn.execute("DELETE FROM rfm_histogram WHERE customers = 0")
+
+        conn.execute("DROP TABLE temp._rfm_batch")
+        conn.execute("DROP TABLE temp._rfm_customers")
+
+    return applied
+
+
+def load_histograms(conn):
+    hist = read_sql("SELECT metric, bucket, customers FROM rfm_histogram ORDER BY metric, bucket", conn)
+    return {metric: group for metric, group in hist.groupby('metric')}
+
+
+def rfm_breakpoints(histograms, n_scores=N_SCORES):
+    """
+    Score breakpoints from the histograms: last purchase day (exact) and
+    DDSketch bucket indices for frequency / monetary.
+    """
+    qs = np.arange(1, n_scores) / n_scores
+    return {
+        metric: histogram_quantiles(hist['bucket'].to_numpy(), hist['customers'].to_numpy(), qs)
+        for metric, hist in histograms.items()
+    }
+
+
+def rfm_from_state(conn, snapshot=None, n_scores=N_SCORES):
+    """
+    RFM table for any snapshot date from the state tables alone.
+    Columns match rfm_analysis.compute_rfm; frequency / monetary breakpoints
+    come from the DDSketch histograms, so scores near a breakpoint can differ
+    from the exact ones in mart_rfm.
+    """
+    ensure_rfm_state(conn)
+    state = read_sql(
+        "SELECT customer_unique_id, last_order_day, frequency, monetary FROM rfm_customer_state", conn
+    )
+    if state.empty:
+        return pd.DataFrame()
+
+    breakpoints = rfm_breakpoints(load_histograms(conn), n_scores)
+    snapshot_day = to_epoch_day(snapshot) if snapshot is not None else int(state['last_order_day'].max()) + 1
+
+    # Более поздняя последняя покупка = меньший recency = выше балл
+    state['r_score'] = quantile_score(state['last_order_day'], breakpoints['last_order_day'])
+    state['f_score'] = quantile_score(_sketch.bucket_index(state['frequency']), breakpoints['frequency'])
+    state['m_score'] = quantile_score(_sketch.bucket_index(state['monetary']), breakpoints['monetary'])
+    state['recency'] = snapshot_day - state['last_order_day']
+    state['snapshot_date'] = str(pd.Timestamp(snapshot_day, unit='D').date())
+
+    rfm = state[['customer_unique_id', 'frequency', 'monetary', 'recency', 'snapshot_date',
+                 'r_score', 'f_score', 'm_score']]
+    return add_segments(rfm.copy(), n_scores)
@@ -1,12 +1,15 @@
 """
 SLA (Service Level Agreement) analysis for delivery performance.
-Calculates late delivery rates and median delivery time by city/category.
+Calculates late delivery rates and median / p90 / p95 / p99 delivery time
+by city/category from mergeable per-partition DDSketches.
 """
-import sqlite3
 import pandas as pd
-import matplotlib.pyplot as plt
+import numpy as np
 from pathlib import Path
-import seaborn as sns
+
+from metric_registry import compute_metrics
+from query_log import connect, read_sql
+from sketches import DDSketch, build_ddsketch_blobs, ddsketch_group_quantiles
 
 DB = Path(__file__).resolve().parents[2] / "data" / "ecommerce.db"
 OUT_CHART_CITY = Path(__file__).resolve().parents[2] / "docs" / "sla_city_analysis.png"
@@ -14,66 +17,131 @@ OUT_CHART_CATEGORY = Path(__file__).resolve().parents[2] / "docs" / "sla_categor
 OUT_DATA = Path(__file__).resolve().parents[2] / "docs" / "sla_analysis_results.csv"
 
 
-def calculate_sla_metrics(conn):
+LATE_THRESHOLD_DAYS = 30  # для подписей; флаг is_late считается в ETL
+PERCENTILES = [0.5, 0.9, 0.95, 0.99]
+PERCENTILE_COLUMNS = ['median_delivery_days', 'p90_delivery_days', 'p95_delivery_days', 'p99_delivery_days']
+SKETCH_RELATIVE_ACCURACY = 0.01
+STREAM_CHUNK_ROWS = 200_000
+
+# Партиции скетчей: заказ учитывается один раз в городской партиции
+# и один раз в каждой своей категории
+SKETCH_PARTITIONS = {
+    'sla_sketch_city': ['order_month', 'customer_state', 'customer_city'],
+    'sla_sketch_category': ['order_month', 'product_category_name'],
+}
+
+
+def build_delivery_sketches(conn, chunk_rows=STREAM_CHUNK_ROWS):
     """
-    Calculate SLA metrics: late delivery rate and median delivery time
-    by city and product category.
+    One streaming pass over delivered orders: per partition keep order count,
+    late count, sum of delivery days and a DDSketch of delivery days.
+    Memory is bounded by partitions x sketch buckets, not by rows.
     """
-    # Основные метрики по городам
-    query_city = """
+    query = """
     SELECT 
+        strftime('%Y-%m', o.order_purchase_timestamp) AS order_month,
+        c.customer_state,
         c.customer_city,
-        COUNT(o.order_id) AS total_orders,
-        SUM(CASE WHEN o.delivery_time_days > 30 THEN 1 ELSE 0 END) AS late_orders,
-        AVG(o.delivery_time_days) AS avg_delivery_days,
-        AVG(CASE 
-            WHEN o.delivery_time_days IS NOT NULL 
-            THEN o.delivery_time_days 
-            ELSE NULL 
-        END) AS avg_delivery_days_not_null
+        oc.product_category_name,
+        o.delivery_time_days,
+        o.is_late,
+        ROW_NUMBER() OVER (PARTITION BY o.order_id ORDER BY oc.product_category_name) = 1 AS is_first
     FROM fact_orders o
     JOIN dim_customers c ON o.customer_id = c.customer_id
-    WHERE o.delivery_time_days IS NOT NULL
-      AND c.customer_city IS NOT NULL
-    GROUP BY c.customer_city
-    HAVING COUNT(o.order_id) >= 10  -- Фильтр для статистической значимости
-    ORDER BY total_orders DESC
+    LEFT JOIN (
+        SELECT DISTINCT i.order_id, p.product_category_name
+        FROM fact_order_items i
+        JOIN dim_products p ON i.product_id = p.product_id
+        WHERE p.product_category_name IS NOT NULL
+    ) oc ON oc.order_id = o.order_id
+    WHERE o.is_delivered = 1
+    """
+    sketch = DDSketch(SKETCH_RELATIVE_ACCURACY)
+    stats = {table: [] for table in SKETCH_PARTITIONS}
+    buckets = {table: [] for table in SKETCH_PARTITIONS}
+
+    for chunk in read_sql(query, conn, chunksize=chunk_rows):
+        chunk['bucket'] = sketch.bucket_index(chunk['delivery_time_days'])
+        chunk['late'] = chunk['is_late'].astype(np.int64)
+
+        for table, keys in SKETCH_PARTITIONS.items():
+            part = chunk[chunk['is_first'] == 1] if table == 'sla_sketch_city' else chunk
+            part = part.dropna(subset=keys)
+            stats[table].append(part.groupby(keys).agg(
+                orders=('delivery_time_days', 'size'),
+                late_orders=('late', 'sum'),
+                delivery_days_sum=('delivery_time_days', 'sum'),
+            ))
+            buckets[table].append(part.groupby(keys + ['bucket']).size().rename('count'))
+
+            # Сворачиваем накопленное, чтобы память не росла с числом строк
+            stats[table] = [pd.concat(stats[table]).groupby(level=keys).sum()]
+            buckets[table] = [pd.concat(buckets[table]).groupby(level=keys + ['bucket']).sum()]
+
+    for table, keys in SKETCH_PARTITIONS.items():
+        part_stats = pd.concat(stats[table]).reset_index() if stats[table] else pd.DataFrame(columns=keys)
+        bucket_counts = pd.concat(buckets[table]).reset_index() if buckets[table] else pd.DataFrame(columns=keys)
+
+        if not part_stats.empty:
+            codes = pd.MultiIndex.from_frame(part_stats[keys]).get_indexer(
+                pd.MultiIndex.from_frame(bucket_counts[keys])
+            )
+            part_stats['delivery_days_sketch'] = build_ddsketch_blobs(
+                codes, bucket_counts['bucket'], bucket_counts['count'], len(part_stats),
+                SKETCH_RELATIVE_ACCURACY
+            )
+
+        part_stats.to_sql(table, conn, if_exists="replace", index=False)
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_keys ON {table}({', '.join(keys)})")
+        print(f"{table} created: {len(part_stats)} partitions")
+    conn.commit()
+
+
+def delivery_percentiles(conn, table, group_by, min_orders=0):
     """
+    Roll partitions of a sketch table up to group_by (e.g. ['customer_state'],
+    ['order_month'], [] for overall) by merging sketches; no fact-table scan.
+    """
+    parts = read_sql(f"SELECT * FROM {table}", conn)
+    if parts.empty:
+        return pd.DataFrame()
+
+    if group_by:
+        grouped = parts.groupby(group_by, sort=False)
+        codes = grouped.ngroup().to_numpy()
+        result = grouped[['orders', 'late_orders', 'delivery_days_sum']].sum().reset_index()
+    else:
+        codes = np.zeros(len(parts), dtype=np.int64)
+        result = parts[['orders', 'late_orders', 'delivery_days_sum']].sum().to_frame().T
 
-    df_city = pd.read_sql_query(query_city, conn)
+    quantiles = ddsketch_group_quantiles(codes, parts['delivery_days_sketch'], len(result), PERCENTILES)
+    for j, col in enumerate(PERCENTILE_COLUMNS):
+        result[col] = quantiles[:, j].round(2)
 
-    if not df_city.empty:
-        df_city['late_delivery_rate'] = (df_city['late_orders'] / df_city['total_orders'] * 100).round(2)
-        df_city['avg_delivery_days'] = df_city['avg_delivery_days'].round(2)
+    result = result.rename(columns={'orders': 'total_orders'})
+    result['avg_delivery_days'] = (result['delivery_days_sum'] / result['total_orders']).round(2)
+    result['late_delivery_rate'] = (result['late_orders'] / result['total_orders'] * 100).round(2)
+    result = result.drop(columns=['delivery_days_sum'])
 
-    # Метрики по категориям
-    query_category = """
-    SELECT 
-        p.product_category_name,
-        COUNT(o.order_id) AS total_orders,
-        SUM(CASE WHEN o.delivery_time_days > 30 THEN 1 ELSE 0 END) AS late_orders,
-        AVG(o.delivery_time_days) AS avg_delivery_days
-    FROM fact_orders o
-    JOIN fact_order_items i ON o.order_id = i.order_id
-    JOIN dim_products p ON i.product_id = p.product_id
-    WHERE o.delivery_time_days IS NOT NULL
-      AND p.product_category_name IS NOT NULL
-    GROUP BY p.product_category_name
-    HAVING COUNT(o.order_id) >= 5
-    ORDER BY total_orders DESC
-    """
+    result = result[result['total_orders'] >= min_orders]
+    return result.sort_values('total_orders', ascending=False).reset_index(drop=True)
 
-    df_category = pd.read_sql_query(query_category, conn)
-
-    if not df_category.empty:
-        df_category['late_delivery_rate'] = (df_category['late_orders'] / df_category['total_orders'] * 100).round(2)
-        df_category['avg_delivery_days'] = df_category['avg_delivery_days'].round(2)
 
+def calculate_sla_metrics(conn):
+    """
+    Calculate SLA metrics: late delivery rate, average and p50/p90/p95/p99
+    delivery time by city and product category (from the sketch tables).
+    """
+    # Фильтр для статистической значимости
+    df_city = delivery_percentiles(conn, 'sla_sketch_city', ['customer_city'], min_orders=10)
+    df_category = delivery_percentiles(conn, 'sla_sketch_category', ['product_category_name'], min_orders=5)
     return df_city, df_category
 
 
 def plot_city_sla(df_city, output_path):
     """Plot city-level SLA analysis"""
+    import matplotlib.pyplot as plt
+
     if df_city.empty:
         print("⚠️  No city data for SLA analysis")
         return
@@ -117,6 +185,8 @@ def plot_city_sla(df_city, output_path):
 
 def plot_category_sla(df_category, output_path):
     """Plot category-level SLA analysis"""
+    import matplotlib.pyplot as plt
+
     if df_category.empty:
         print("⚠️  No category data for SLA analysis")
         return
@@ -157,54 +227,41 @@ def plot_category_sla(df_category, output_path):
 
 
 def calculate_overall_sla(conn):
-    """Calculate overall SLA metrics"""
-    query = """
-    SELECT 
-        COUNT(*) AS total_orders,
-        SUM(CASE WHEN delivery_time_days > 30 THEN 1 ELSE 0 END) AS late_orders,
-        AVG(delivery_time_days) AS avg_delivery_days,
-        AVG(CASE 
-            WHEN delivery_time_days IS NOT NULL 
-            THEN delivery_time_days 
-            ELSE NULL 
-        END) AS avg_delivery_days_not_null
-    FROM fact_orders
-    WHERE delivery_time_days IS NOT NULL
-    """
-
-    result = pd.read_sql_query(query, conn)
+    """Overall SLA: counts and rates from the metric registry, percentiles from the sketches"""
+    result = delivery_percentiles(conn, 'sla_sketch_city', [])
 
     if not result.empty:
-        total = result['total_orders'].iloc[0]
-        late = result['late_orders'].iloc[0]
-        avg_days = result['avg_delivery_days_not_null'].iloc[0]
-
-        late_rate = (late / total * 100) if total > 0 else 0
-
+        row = result.iloc[0]
+        metrics = compute_metrics(conn, ['delivered_orders', 'late_orders',
+                                         'late_delivery_rate', 'avg_delivery_days'])
         return {
-            'total_orders_with_delivery': int(total),
-            'late_orders': int(late),
-            'late_delivery_rate': round(late_rate, 2),
-            'avg_delivery_days': round(avg_days, 2) if avg_days else 0
+            'total_orders_with_delivery': int(metrics['delivered_orders']),
+            'late_orders': int(metrics['late_orders']),
+            'late_delivery_rate': round(float(metrics['late_delivery_rate']), 2),
+            'avg_delivery_days': round(float(metrics['avg_delivery_days']), 2),
+            **{col: float(row[col]) for col in PERCENTILE_COLUMNS}
         }
 
     return None
 
 
 def main():
-    conn = sqlite3.connect(DB)
+    conn = connect(DB)
 
     print("=" * 60)
     print("SLA (DELIVERY PERFORMANCE) ANALYSIS")
     print("=" * 60)
 
+    build_delivery_sketches(conn)
     overall = calculate_overall_sla(conn)
 
     if overall:
         print(f"Total orders with delivery data: {overall['total_orders_with_delivery']:,}")
-        print(f"Late deliveries (>30 days): {overall['late_orders']:,}")
+        print(f"Late deliveries (>{LATE_THRESHOLD_DAYS} days): {overall['late_orders']:,}")
         print(f"Late delivery rate: {overall['late_delivery_rate']}%")
         print(f"Average delivery time: {overall['avg_delivery_days']} days")
+        print(f"Median / p90 / p95 / p99 delivery time: {overall['median_delivery_days']} / "
+              f"{overall['p90_delivery_days']} / {overall['p95_delivery_days']} / {overall['p99_delivery_days']} days")
 
     df_city, df_category = calculate_sla_metrics(conn)
 
@@ -244,6 +301,11 @@ def main():
         combined_df.to_csv(OUT_DATA, index=False)
         print(f"Detailed data saved to: {OUT_DATA}")
 
+        # Таблица для постраничного вывода в дашборде
+        combined_df.to_sql("mart_sla_results", conn, if_exists="replace", index=False)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_mart_sla_results_level ON mart_sla_results(level, total_orders)")
+        conn.commit()
+
     conn.close()
 
     print("THE END")
@@ -0,0 +1,356 @@
+"""
+Streaming export of fact / dimension / mart tables as Arrow IPC or Parquet.
+
+Rows are pulled from SQLite with fetchmany(batch_rows), converted to one
+Arrow record batch at a time and written straight to the output, so memory
+stays bounded by a single batch whatever the table size. Only the requested
+columns are selected; an optional [start, end) range filters on the table's
+date column (for 'YYYY-MM' month columns: the months overlapping the range);
+fact_orders by purchase date reads only the monthly partitions of the range.
+
+    python src/analysis/table_export.py --list
+    python src/analysis/table_export.py fact_orders --columns order_id,order_status \\
+        --start 2017-01-01 --end 2018-01-01 --format parquet --out orders_2017.parquet
+    python src/analysis/table_export.py --serve          # http://127.0.0.1:8060
+
+Over HTTP: GET /tables and GET /export/<table>?format=arrow&columns=..&start=..&end=..
+The Arrow stream can be consumed batch by batch:
+
+    reader = pyarrow.ipc.open_stream(urllib.request.urlopen(url))
+    for batch in reader: ...
+
+pyarrow is an optional dependency needed only by this module.
+"""
+import argparse
+import sys
+from pathlib import Path
+
+from partitions import PURCHASE_COLUMN, range_query
+from query_log import connect
+
+DB = Path(__file__).resolve().parents[2] / "data" / "ecommerce.db"
+
+EXPORT_PREFIXES = ('fact_', 'dim_', 'mart_')
+BATCH_ROWS = 65_536
+FORMATS = {
+    'arrow': ('application/vnd.apache.arrow.stream', '.arrows'),
+    'parquet': ('application/vnd.apache.parquet', '.parquet'),
+}
+# Колонка для фильтра --start/--end; у остальных таблиц фильтр по дате не поддерживается
+DATE_COLUMNS = {
+    'fact_orders': 'order_purchase_timestamp',
+    'fact_order_items': 'shipping_limit_date',
+    'mart_daily_category': 'order_date',
+    'mart_daily_category_state': 'order_date',
+    'mart_weekly_city': 'week_start',
+    'mart_cohort_retention': 'cohort_month',
+}
+# Колонки с месяцем 'YYYY-MM': строка месяца — период, попадающий в диапазон, если пересекается с ним
+MONTH_COLUMNS = {'cohort_month'}
+HOST = "127.0.0.1"
+PORT = 8060
+
+
+def require_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        raise RuntimeError("Table export needs pyarrow: pip install pyarrow") from None
+    return pa
+
+
+def connect_readonly(db_path=DB):
+    return connect(f"{Path(db_path).as_uri()}?mode=ro", uri=True, check_same_thread=False)
+
+
+def exportable_tables(conn):
+    """{table: [(column, declared_type), ...]} for every table that may be exported."""
+    names = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name"
+    ).fetchall()]
+    return {
+        name: [(col[1], col[2] or '') for col in conn.execute(f'PRAGMA table_info("{name}")').fetchall()]
+        for name in names if name.startswith(EXPORT_PREFIXES)
+    }
+
+
+def plan_export(conn, table, columns=None, start=None, end=None, date_column=None):
+    """
+    Validated SELECT for an export: (sql, params, [(column, declared_type)]).
+    Table and column names are checked against the schema, values are bound.
+    """
+    tables = exportable_tables(conn)
+    if table not in tables:
+        raise ValueError(f"Unknown table '{table}'. Exportable: {', '.join(tables)}")
+    declared = dict(tables[table])
+
+    columns = list(columns) if columns else list(declared)
+    unknown = [c for c in columns if c not in declared]
+    if unknown:
+        raise ValueError(f"Unknown column(s) in {table}: {', '.join(unknown)}")
+
+    select = ", ".join(f'"{c}"' for c in columns)
+    where, params = [], []
+    if start is not None or end is not None:
+        date_column = date_column or DATE_COLUMNS.get(table)
+        if table == 'fact_orders' and date_column == PURCHASE_COLUMN:
+            # Период покупки — только партиции нужных месяцев
+            sql, params = range_query(conn, f"SELECT {select} FROM {{orders}} WHERE {{in_range}}", start, end)
+            return sql, params, [(c, declared[c]) for c in columns]
+        if date_column is None:
+            raise ValueError(f"{table} has no date column; pass date_column explicitly")
+        if date_column not in declared:
+            raise ValueError(f"Unknown date column '{date_column}' in {table}")
+        # Даты хранятся текстом ISO — сравнение строк совпадает с хронологическим
+        if date_column in MONTH_COLUMNS:
+            # Месяц [YYYY-MM-01, следующий месяц) пересекается с [start, end)
+            if start is not None:
+                where.append(f'"{date_column}" >= ?')
+                params.append(str(start)[:7])
+            if end is not None:
+                where.append(f'"{date_column}" || \'-01\' < ?')
+                params.append(str(end))
+        else:
+            if start is not None:
+                where.append(f'"{date_column}" >= ?')
+                params.append(str(start))
+            if end is not None:
+                where.append(f'"{date_column}" < ?')
+                params.append(str(end))
+
+    sql = f'SELECT {select} FROM "{table}"'
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return sql, params, [(c, declared[c]) for c in columns]
+
+
+def column_type(pa, declared, values):
+    """Arrow type from the values of the first batch, or from the declared SQLite type if they are all NULL."""
+    declared = declared.upper()
+    kinds = {type(v) for v in values if v is not None}
+    if kinds == {bytes}:
+        # HLL/DDSketch колонки объявлены TEXT, но хранят BLOB
+        return pa.binary()
+    if str in kinds:
+        return pa.string()
+    if float in kinds or (kinds and any(t in declared for t in ('REAL', 'FLOA', 'DOUB'))):
+        return pa.float64()
+    if kinds:
+        return pa.int64()
+
+    if 'INT' in declared:
+        return pa.int64()
+    if any(t in declared for t in ('CHAR', 'CLOB', 'TEXT', 'DATE', 'TIME')):
+        return pa.string()
+    if 'BLOB' in declared:
+        return pa.binary()
+    return pa.float64()
+
+
+class _ChunkSink:
+    """Write-only file object collecting what the Arrow writer produced since the last drain()."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_export(conn, sql, params, columns, fmt='arrow', batch_rows=BATCH_ROWS):
+    """Generator of output bytes: one chunk per record batch, then the stream/file footer."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format '{fmt}', expected one of {', '.join(FORMATS)}")
+    pa = require_pyarrow()
+
+    cursor = conn.execute(sql, params)
+    sink = _ChunkSink()
+    output = pa.PythonFile(sink, mode='w')
+    schema = None
+    writer = None
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_rows)
+            if schema is None:
+                values = list(zip(*rows)) if rows else [()] * len(columns)
+                schema = pa.schema([
+                    pa.field(name, column_type(pa, declared, col_values))
+                    for (name, declared), col_values in zip(columns, values)
+                ])
+                if fmt == 'arrow':
+                    writer = pa.ipc.new_stream(output, schema)
+                else:
+                    writer = pa.parquet.ParquetWriter(output, schema, compression='snappy')
+            if not rows:
+                break
+
+            arrays = []
+            for field, col_values in zip(schema, zip(*rows)):
+                try:
+                    arrays.append(pa.array(list(col_values), type=field.type))
+                except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError) as e:
+                    raise ValueError(f"Column {field.name}: values do not fit {field.type} ({e})") from None
+            batch = pa.RecordBatch.from_arrays(arrays, schema=schema)
+            if fmt == 'arrow':
+                writer.write_batch(batch)
+            else:
+                # Одна группа строк на батч: читатель Parquet тоже может идти по группам
+                writer.write_table(pa.Table.from_batches([batch]))
+            del rows, arrays, batch
+            yield sink.drain()
+    finally:
+        cursor.close()
+        if writer is not None:
+            writer.close()
+    yield sink.drain()
+
+
+def export_table(table, out, fmt='arrow', columns=None, start=None, end=None,
+                 date_column=None, batch_rows=BATCH_ROWS, db_path=DB):
+    """Write an export to a binary file object; returns the number of bytes written."""
+    conn = connect_readonly(db_path)
+    try:
+        sql, params, cols = plan_export(conn, table, columns, start, end, date_column)
+        written = 0
+        for chunk in stream_export(conn, sql, params, cols, fmt, batch_rows):
+            out.write(chunk)
+            written += len(chunk)
+        return written
+    finally:
+        conn.close()
+
+
+def create_app(db_path=DB):
+    """Small Flask app: GET /tables, GET /export/<table> streamed with chunked transfer."""
+    from flask import Flask, Response, jsonify, request
+
+    app = Flask(__name__)
+
+    @app.route('/tables')
+    def tables():
+        conn = connect_readonly(db_path)
+        try:
+            return jsonify({
+                name: {'columns': [c for c, _ in cols], 'date_column': DATE_COLUMNS.get(name)}
+                for name, cols in exportable_tables(conn).items()
+            })
+        finally:
+            conn.close()
+
+    @app.route('/export/<table>')
+    def export(table):
+        fmt = request.args.get('format', 'arrow')
+        columns = [c for c in request.args.get('columns', '').split(',') if c] or None
+        try:
+            batch_rows = max(1, int(request.args.get('batch_rows', BATCH_ROWS)))
+            require_pyarrow()
+            if fmt not in FORMATS:
+                raise ValueError(f"Unknown format '{fmt}', expected one of {', '.join(FORMATS)}")
+        except RuntimeError as e:
+            return jsonify({'error': str(e)}), 501
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        conn = connect_readonly(db_path)
+        try:
+            sql, params, cols = plan_export(
+                conn, table, columns, request.args.get('start'), request.args.get('end'),
+                request.args.get('date_column'),
+            )
+        except ValueError as e:
+            conn.close()
+            return jsonify({'error': str(e)}), 400
+
+        def generate():
+            try:
+                yield from stream_export(conn, sql, params, cols, fmt, batch_rows)
+            finally:
+                conn.close()
+
+        mimetype, suffix = FORMATS[fmt]
+        return Response(generate(), mimetype=mimetype,
+                        headers={'Content-Disposition': f'attachment; filename="{table}{suffix}"'})
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream a fact/mart table as Arrow IPC or Parquet")
+    parser.add_argument('table', nargs='?')
+    parser.add_argument('--format', choices=list(FORMATS), default='arrow')
+    parser.add_argument('--columns', help="comma-separated column list (default: all)")
+    parser.add_argument('--start', help="inclusive lower bound on the date column")
+    parser.add_argument('--end', help="exclusive upper bound on the date column")
+    parser.add_argument('--date-column', help="override the table's date column")
+    parser.add_argument('--batch-rows', type=int, default=BATCH_ROWS)
+    parser.add_argument('--out', default='-', help="output file ('-' for stdout)")
+    parser.add_argument('--list', action='store_true', help="list exportable tables")
+    parser.add_argument('--serve', action='store_true', help=f"serve over HTTP on {HOST}")
+    parser.add_argument('--port', type=int, default=PORT)
+    args = parser.parse_args()
+
+    if not DB.exists():
+        print(f"Database not found at {DB}. Run ETL first.")
+        sys.exit(1)
+
+    if args.list:
+        conn = connect_readonly()
+        try:
+            for name, cols in exportable_tables(conn).items():
+                date_column = DATE_COLUMNS.get(name)
+                print(f"{name}: {', '.join(c for c, _ in cols)}" + (f"  [date: {date_column}]" if date_column else ""))
+        finally:
+            conn.close()
+        return
+
+    if args.serve:
+        print(f"Export service: http://{HOST}:{args.port}/tables")
+        create_app().run(host=HOST, port=args.port, threaded=True)
+        return
+
+    if not args.table:
+        parser.error("table is required (or --list / --serve)")
+    columns = args.columns.split(',') if args.columns else None
+    try:
+        if args.out == '-':
+            written = export_table(args.table, sys.stdout.buffer, args.format, columns,
+                                   args.start, args.end, args.date_column, args.batch_rows)
+        else:
+            with open(args.out, 'wb') as f:
+                written = export_table(args.table, f, args.format, columns,
+                                       args.start, args.end, args.date_column, args.batch_rows)
+            print(f"Exported {args.table} to {args.out} ({written / 2 ** 20:.1f} MB)")
+    except (ValueError, RuntimeError) as e:
+        print(f"Export failed: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
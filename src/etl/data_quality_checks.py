@@ -1,7 +1,9 @@
 import sqlite3
+import sys
 from pathlib import Path
 
 DB_PATH = Path(__file__).resolve().parents[2] / "data" / "ecommerce.db"
+ANALYSIS_DIR = Path(__file__).resolve().parents[1] / "analysis"
 
 def check_pk_uniqueness(conn):
     q = "SELECT order_id, COUNT(*) c FROM fact_orders GROUP BY order_id HAVING c>1"
@@ -22,11 +24,66 @@ def check_allowed_statuses(conn):
     q = "SELECT DISTINCT order_status FROM fact_orders"
     return [r[0] for r in conn.execute(q).fetchall()]
 
+def check_order_totals(conn):
+    # Итоги на fact_orders должны совпадать с суммой позиций
+    q = """
+    SELECT o.order_id
+    FROM fact_orders o
+    LEFT JOIN (
+        SELECT order_id, SUM(price + freight_value) AS total, COUNT(*) AS n
+        FROM fact_order_items
+        GROUP BY order_id
+    ) i ON i.order_id = o.order_id
+    WHERE ABS(o.order_total - COALESCE(i.total, 0)) > 0.005
+       OR o.items_count != COALESCE(i.n, 0)
+    LIMIT 5
+    """
+    return conn.execute(q).fetchall()
+
+def check_cohort_backdated_order():
+    # Заказ, загруженный позже, но с более ранней датой покупки, должен перенести покупателя в ранний когорт
+    if str(ANALYSIS_DIR) not in sys.path:
+        sys.path.append(str(ANALYSIS_DIR))
+    from cohort_analysis import calculate_cohort_retention, refresh_cohort_state, retention_from_state
+
+    conn = sqlite3.connect(":memory:")
+    conn.executescript("""
+    CREATE TABLE dim_customers (customer_id TEXT, customer_unique_id TEXT);
+    CREATE TABLE fact_orders (order_id TEXT, customer_id TEXT, order_status TEXT, order_purchase_timestamp TEXT);
+    INSERT INTO dim_customers VALUES ('c1', 'u1'), ('c2', 'u1'), ('c3', 'u2'), ('c4', 'u1');
+    INSERT INTO fact_orders VALUES
+        ('o1', 'c1', 'delivered', '2017-03-05 10:00:00'),
+        ('o2', 'c2', 'delivered', '2017-04-02 10:00:00'),
+        ('o3', 'c3', 'delivered', '2017-03-20 10:00:00');
+    """)
+    problems = []
+    try:
+        refresh_cohort_state(conn)
+        _, before = retention_from_state(conn)
+        conn.execute("INSERT INTO fact_orders VALUES ('o4', 'c4', 'delivered', '2017-02-10 10:00:00')")
+        refresh_cohort_state(conn)
+        _, after = retention_from_state(conn)
+        _, expected = calculate_cohort_retention(conn, granularity='month')
+        # Ненаблюдаемые возрасты — NaN-колонки, их число зависит от способа расчёта
+        before, after, expected = (m.dropna(axis=1, how='all').fillna(-1) for m in (before, after, expected))
+
+        if after.equals(before):
+            problems.append("retention matrix did not change after a back-dated order")
+        if not after.equals(expected):
+            problems.append("incremental retention differs from a full recompute")
+    finally:
+        conn.close()
+    return problems
+
 def main():
     if not DB_PATH.exists():
         print("DB not found. Run ETL first.")
         return
-    conn = sqlite3.connect(DB_PATH)
+    if str(ANALYSIS_DIR) not in sys.path:
+        sys.path.append(str(ANALYSIS_DIR))
+    from query_log import connect
+
+    conn = connect(DB_PATH)
     dupes = check_pk_uniqueness(conn)
     if dupes:
         print("❌ Duplicate PKs found:", dupes[:5])
@@ -39,6 +96,18 @@ def main():
     else:
         print("✅ FK integrity OK (customer_id)")
 
+    bad_totals = check_order_totals(conn)
+    if bad_totals:
+        print("❌ order_total differs from order items:", bad_totals[:5])
+    else:
+        print("✅ Order totals match order items")
+
+    cohort_problems = check_cohort_backdated_order()
+    if cohort_problems:
+        print("❌ Cohort state with back-dated orders:", "; ".join(cohort_problems))
+    else:
+        print("✅ Back-dated orders move customers to the earlier cohort")
+
     statuses = check_allowed_statuses(conn)
     allowed = {'delivered','cancelled','approved','shipped','unknown'}
     bad = set(statuses) - allowed
@@ -1,9 +1,24 @@
 import pandas as pd
 import sqlite3
+import sys
 from pathlib import Path
 
 DATA_DIR = Path(__file__).resolve().parents[2] / "data"
 DB_PATH = DATA_DIR / "ecommerce.db"
+ANALYSIS_DIR = Path(__file__).resolve().parents[1] / "analysis"
+
+# Заказ считается опоздавшим, если доставка заняла больше N дней
+LATE_THRESHOLD_DAYS = 30
+
+# Итоги заказа на fact_orders (сумма по fact_order_items)
+TOTAL_COLUMNS = ['order_total', 'items_total', 'freight_total', 'items_count']
+
+DELIVERY_TIMESTAMPS = [
+    'order_approved_at',
+    'order_delivered_carrier_date',
+    'order_delivered_customer_date',
+    'order_estimated_delivery_date',
+]
 
 def load_csv(name):
     path = DATA_DIR / name
@@ -16,16 +31,24 @@ def deduplicate_customers(df_customers):
     report = []
     initial_count = len(df_customers)
 
-    mask_duplicate_id = df_customers.duplicated(subset=['customer_unique_id'], keep=False)
+    # customer_id в Olist выдаётся на заказ: дубликат — повтор того же customer_id.
+    # Несколько customer_id у одного customer_unique_id — повторные покупки, их не удаляем
+    # (иначе заказы повторных покупателей отсекаются проверкой FK и удержание равно 0%)
+    mask_duplicate_id = df_customers.duplicated(subset=['customer_id'], keep=False)
     duplicate_ids = df_customers[mask_duplicate_id]
 
     if not duplicate_ids.empty:
         dup_count = len(duplicate_ids)
-        report.append(f"Exact duplicates by customer_unique_id: {dup_count} records")
-        dup_groups = duplicate_ids.groupby('customer_unique_id').size()
-        report.append(f"  Affected unique customers: {len(dup_groups)}")
+        report.append(f"Exact duplicates by customer_id: {dup_count} records")
+        dup_groups = duplicate_ids.groupby('customer_id').size()
+        report.append(f"  Affected customer ids: {len(dup_groups)}")
         report.append(f"  Example duplicates: {dup_groups.head(3).to_dict()}")
-        df_customers = df_customers.drop_duplicates(subset=['customer_unique_id'], keep='first')
+        df_customers = df_customers.drop_duplicates(subset=['customer_id'], keep='first')
+
+    if 'customer_unique_id' in df_customers.columns:
+        orders_per_customer = df_customers.groupby('customer_unique_id').size()
+        report.append(f"Repeat customers (several customer_id per customer_unique_id): "
+                      f"{(orders_per_customer > 1).sum()}")
 
     if all(col in df_customers.columns for col in ['customer_city', 'customer_zip_code_prefix']):
         df_customers['city_normalized'] = df_customers['customer_city'].str.lower().str.strip()
@@ -70,6 +93,41 @@ def deduplicate_sellers(df_sellers):
     return df_sellers
 
 
+def add_delivery_features(df_orders):
+    """
+    Vectorized delivery features, NULL where the underlying event did not happen:
+    hours_to_approval / hours_to_carrier / hours_to_customer (from purchase),
+    delivery_time_days (whole days), days_vs_estimate (>0 means after the
+    estimated date), is_delivered, is_late (> LATE_THRESHOLD_DAYS) and
+    is_late_vs_estimate.
+    """
+    for col in DELIVERY_TIMESTAMPS:
+        if col in df_orders.columns:
+            df_orders[col] = pd.to_datetime(df_orders[col], errors='coerce')
+        else:
+            df_orders[col] = pd.NaT
+
+    purchase = df_orders['order_purchase_timestamp']
+    delivered = df_orders['order_delivered_customer_date']
+
+    df_orders['hours_to_approval'] = (df_orders['order_approved_at'] - purchase).dt.total_seconds() / 3600
+    df_orders['hours_to_carrier'] = (df_orders['order_delivered_carrier_date'] - purchase).dt.total_seconds() / 3600
+    df_orders['hours_to_customer'] = (delivered - purchase).dt.total_seconds() / 3600
+
+    df_orders['delivery_time_days'] = (delivered - purchase).dt.days.astype('Int64')
+    df_orders['days_vs_estimate'] = (
+        (delivered - df_orders['order_estimated_delivery_date']).dt.total_seconds() / 86400
+    )
+
+    is_delivered = delivered.notna() & purchase.notna()
+    df_orders['is_delivered'] = is_delivered.astype('int8')
+    df_orders['is_late'] = (df_orders['delivery_time_days'] > LATE_THRESHOLD_DAYS).astype('Int8').where(is_delivered)
+    df_orders['is_late_vs_estimate'] = (df_orders['days_vs_estimate'] > 0).astype('Int8').where(
+        is_delivered & df_orders['order_estimated_delivery_date'].notna()
+    )
+    return df_orders
+
+
 def transform_orders(df_orders, valid_customer_ids=None):
     df_orders['order_purchase_timestamp'] = pd.to_datetime(df_orders['order_purchase_timestamp'], errors='coerce')
 
@@ -92,14 +150,8 @@ def transform_orders(df_orders, valid_customer_ids=None):
     # Удаление дубликатов
     df_orders = df_orders.drop_duplicates(subset=['order_id'])
 
-    # Расчёт времени доставки
-    if 'order_delivered_customer_date' in df_orders.columns:
-        df_orders['order_delivered_customer_date'] = pd.to_datetime(
-            df_orders['order_delivered_customer_date'], errors='coerce'
-        )
-        df_orders['delivery_time_days'] = (
-                df_orders['order_delivered_customer_date'] - df_orders['order_purchase_timestamp']
-        ).dt.days.fillna(0).astype(int)
+    # Признаки доставки
+    df_orders = add_delivery_features(df_orders)
 
     # Проверка FK: удаление заказов с несуществующими клиентами
     if valid_customer_ids is not None:
@@ -115,6 +167,12 @@ def transform_orders(df_orders, valid_customer_ids=None):
     return df_orders
 
 def transform_items(df_items):
+    # Дубликаты позиций по (order_id, order_item_id)
+    duplicates = df_items.duplicated(subset=['order_id', 'order_item_id'])
+    if duplicates.any():
+        print(f"  Removed duplicate order items: {duplicates.sum()}")
+        df_items = df_items[~duplicates]
+
     if 'price' in df_items.columns:
         bad_prices = df_items['price'] <= 0
         if bad_prices.any():
@@ -129,8 +187,41 @@ def transform_items(df_items):
 
     return df_items
 
-def upsert_sqlite(df_orders, df_customers, df_products, df_items, df_sellers=None):
+def add_order_totals(df_orders, df_items):
+    """
+    order_total / items_total / freight_total / items_count on each order,
+    aggregated from the cleaned items in one groupby. Orders without items get 0.
+    """
+    totals = df_items.groupby('order_id', sort=False).agg(
+        items_total=('price', 'sum'),
+        freight_total=('freight_value', 'sum'),
+        items_count=('order_item_id', 'size'),
+    )
+    totals['order_total'] = totals['items_total'] + totals['freight_total']
+
+    # Итоги пересчитываются на каждой загрузке из того же набора позиций, что пишется
+    # в fact_order_items, поэтому не расходятся с ними при догрузке позиций к старым заказам
+    df_orders = df_orders.drop(columns=TOTAL_COLUMNS, errors='ignore').join(totals[TOTAL_COLUMNS], on='order_id')
+    df_orders[TOTAL_COLUMNS] = df_orders[TOTAL_COLUMNS].fillna(0)
+    df_orders['items_count'] = df_orders['items_count'].astype('int64')
+    return df_orders
+
+def build_geolocation(df_geo):
+    """Collapse raw geolocation points to one centroid per zip code prefix (with grid cell)."""
+    if str(ANALYSIS_DIR) not in sys.path:
+        sys.path.append(str(ANALYSIS_DIR))
+    from geo_distance import build_zip_centroids
+
+    print("Building zip prefix centroids...")
+    centroids = build_zip_centroids(df_geo)
+    print(f"   Geolocation points: {len(df_geo)} -> zip prefixes: {len(centroids)}")
+    return centroids
+
+
+def upsert_sqlite(df_orders, df_customers, df_products, df_items, df_sellers=None, df_geolocation=None):
     conn = sqlite3.connect(DB_PATH)
+    # Для нового файла: сжатие месячной партиции возвращает страницы без VACUUM всего хранилища
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
 
     df_orders.to_sql("fact_orders", conn, if_exists="replace", index=False)
     df_items.to_sql("fact_order_items", conn, if_exists="replace", index=False)
@@ -140,9 +231,60 @@ def upsert_sqlite(df_orders, df_customers, df_products, df_items, df_sellers=Non
     if df_sellers is not None and not df_sellers.empty:
         df_sellers.to_sql("dim_sellers", conn, if_exists="replace", index=False)
 
+    if df_geolocation is not None and not df_geolocation.empty:
+        df_geolocation.to_sql("dim_geolocation", conn, if_exists="replace", index=False)
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_dim_geolocation_zip ON dim_geolocation(zip_code_prefix)")
+        # Сеточный индекс: соседние точки ищутся по набору grid_cell
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_dim_geolocation_cell ON dim_geolocation(grid_cell)")
+
+    create_fact_indexes(conn)
     conn.close()
 
 
+def create_fact_indexes(conn):
+    """Indexes for SLA aggregations: late/delivered counts are answered from the index."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fact_orders_order_id ON fact_orders(order_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fact_orders_customer ON fact_orders(customer_id)")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_fact_orders_delivery "
+        "ON fact_orders(is_delivered, is_late, delivery_time_days)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fact_order_items_order_id ON fact_order_items(order_id)")
+    conn.commit()
+
+
+def update_incremental_state(orders, customers):
+    """Apply new and changed orders to the per-customer RFM state; unchanged ones are skipped."""
+    if str(ANALYSIS_DIR) not in sys.path:
+        sys.path.append(str(ANALYSIS_DIR))
+    from query_log import connect
+    from rfm_state import build_order_batch, update_rfm_state
+
+    conn = connect(DB_PATH)
+    try:
+        batch = build_order_batch(orders, customers)
+        applied = update_rfm_state(conn, batch)
+    finally:
+        conn.close()
+    print(f"   RFM state: {applied} new or changed orders applied")
+
+
+def update_partitions(orders, items):
+    """Rewrite only the monthly fact partitions whose content changed."""
+    if str(ANALYSIS_DIR) not in sys.path:
+        sys.path.append(str(ANALYSIS_DIR))
+    from partitions import write_partitions
+    from query_log import connect
+
+    conn = connect(DB_PATH)
+    try:
+        result = write_partitions(conn, orders, items)
+    finally:
+        conn.close()
+    print(f"   Partitions written: {len(result['written'])}, unchanged: {result['unchanged']}, "
+          f"removed: {len(result['removed'])}")
+
+
 def main():
     print("\n1. Loading data...")
     orders = load_csv("olist_orders.csv")
@@ -157,6 +299,13 @@ def main():
         print("   Sellers file not found, skipping")
         sellers = None
 
+    try:
+        geolocation = load_csv("olist_geolocation.csv")
+        print(f"   Geolocation points loaded: {len(geolocation)}")
+    except FileNotFoundError:
+        print("   Geolocation file not found, skipping")
+        geolocation = None
+
     print(f"\n2. Initial sizes:")
     print(f"   Orders: {orders.shape}")
     print(f"   Customers: {customers.shape}")
@@ -167,6 +316,8 @@ def main():
     customers = deduplicate_customers(customers)
     if sellers is not None:
         sellers = deduplicate_sellers(sellers)
+    if geolocation is not None:
+        geolocation = build_geolocation(geolocation)
 
     print("\n4. Data transformation...")
 
@@ -176,6 +327,7 @@ def main():
     # Передаём valid_customer_ids в transform_orders
     orders = transform_orders(orders, valid_customer_ids)
     items = transform_items(items)
+    orders = add_order_totals(orders, items)
 
     print(f"\n5. Final sizes:")
     print(f"   Orders: {orders.shape}")
@@ -185,7 +337,15 @@ def main():
 
     print("\n6. Saving to SQLite...")
     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    upsert_sqlite(orders, customers, products, items, sellers)
+    upsert_sqlite(orders, customers, products, items, sellers, geolocation)
+
+    print("\n7. Updating incremental state...")
+    # Передаём все заказы: уже применённые без изменений состояние пропускает само,
+    # так что падение шага 7 не теряет заказы для следующего запуска
+    update_incremental_state(orders, customers)
+
+    print("\n8. Writing monthly partitions...")
+    update_partitions(orders, items)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,491 @@
+"""
+Synthetic Olist-format dataset for benchmarking the pipeline at any scale.
+
+Scale 1 is roughly the public Kaggle drop (~99k orders); the catalog
+(products, sellers) grows with sqrt(scale), orders and customers linearly.
+Distributions follow Olist: growth plus weekly/holiday seasonality, repeat
+buyers (new customer_id per order, shared customer_unique_id), 1-5 items per
+order, delivery time driven by seller-customer distance, and a small share
+of dirty records covered by CLEANING_RULES.md (duplicates, price <= 0,
+odd statuses, unparseable dates, orphan orders).
+
+Orders are generated in fixed-size chunks, each from its own seed derived
+from (seed, chunk), in parallel worker processes; the output is identical
+for a given seed and scale whatever the number of workers.
+
+    python src/etl/generate_synthetic_data.py --scale 10 --seed 42 --out data/synthetic_10x
+"""
+import argparse
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+DATA_DIR = Path(__file__).resolve().parents[2] / "data"
+
+BASE_ORDERS = 99_441
+BASE_PRODUCTS = 32_951
+BASE_SELLERS = 3_095
+# Заказов в одной части: от него (а не от числа процессов) зависят сиды
+CHUNK_ORDERS = 100_000
+
+START_DATE = pd.Timestamp('2016-09-01')
+END_DATE = pd.Timestamp('2018-09-01')
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Доля покупателей с повторными заказами и средний интервал между заказами (дни)
+REPEAT_SHARE = 0.12
+REPEAT_GAP_DAYS = 75
+
+ITEMS_PER_ORDER = {1: 0.900, 2: 0.075, 3: 0.015, 4: 0.006, 5: 0.004}
+
+ORDER_STATUSES = {
+    'delivered': 0.970, 'shipped': 0.011, 'canceled': 0.006, 'unavailable': 0.006,
+    'invoiced': 0.003, 'processing': 0.003, 'created': 0.0005, 'approved': 0.0005,
+}
+
+# Доли «грязных» записей (умножаются на --dirty)
+DIRTY_RATES = {
+    'duplicate_order': 0.002,      # повтор строки заказа
+    'duplicate_item': 0.002,       # повтор (order_id, order_item_id)
+    'duplicate_customer': 0.003,   # повтор строки покупателя
+    'city_variant': 0.01,          # 'SAO PAULO ' вместо 'sao paulo'
+    'bad_price': 0.001,            # price <= 0
+    'bad_freight': 0.0005,         # freight_value < 0 или > 1000
+    'status_noise': 0.005,         # регистр / пустой статус
+    'bad_date': 0.001,             # нераспознаваемая дата
+    'orphan_order': 0.0005,        # customer_id, которого нет в customers
+}
+
+# Координаты столиц штатов, доли покупателей и продавцов (по Olist), диапазоны zip-префиксов
+STATES = {
+    'SP': (-23.55, -46.63, 41.9, 59.7, (1000, 19999)),
+    'RJ': (-22.91, -43.17, 12.9, 5.4, (20000, 28999)),
+    'MG': (-19.92, -43.94, 11.7, 7.9, (30000, 39999)),
+    'RS': (-30.03, -51.23, 5.5, 4.2, (90000, 99999)),
+    'PR': (-25.43, -49.27, 5.1, 11.3, (80000, 87999)),
+    'SC': (-27.59, -48.55, 3.7, 6.1, (88000, 89999)),
+    'BA': (-12.97, -38.50, 3.4, 0.6, (40000, 48999)),
+    'DF': (-15.79, -47.88, 2.2, 1.0, (70000, 72799)),
+    'ES': (-20.32, -40.34, 2.0, 0.7, (29000, 29999)),
+    'GO': (-16.68, -49.25, 2.0, 1.3, (72800, 76799)),
+    'PE': (-8.05, -34.88, 1.7, 0.3, (50000, 56999)),
+    'CE': (-3.73, -38.52, 1.3, 0.4, (60000, 63999)),
+    'PA': (-1.46, -48.50, 1.0, 0.05, (66000, 68899)),
+    'MT': (-15.60, -56.10, 0.9, 0.3, (78000, 78899)),
+    'MA': (-2.53, -44.30, 0.75, 0.05, (65000, 65999)),
+    'MS': (-20.44, -54.65, 0.7, 0.2, (79000, 79999)),
+    'PB': (-7.12, -34.86, 0.5, 0.1, (58000, 58999)),
+    'PI': (-5.09, -42.80, 0.5, 0.05, (64000, 64999)),
+    'RN': (-5.79, -35.21, 0.5, 0.1, (59000, 59999)),
+    'AL': (-9.65, -35.73, 0.4, 0.03, (57000, 57999)),
+    'SE': (-10.91, -37.07, 0.35, 0.03, (49000, 49999)),
+    'TO': (-10.18, -48.33, 0.3, 0.02, (77000, 77999)),
+    'RO': (-8.76, -63.90, 0.25, 0.05, (78900, 78999)),
+    'AM': (-3.12, -60.02, 0.15, 0.03, (69000, 69299)),
+    'AC': (-9.97, -67.81, 0.08, 0.01, (69900, 69999)),
+    'AP': (0.03, -51.07, 0.07, 0.01, (68900, 68999)),
+    'RR': (2.82, -60.67, 0.05, 0.01, (69300, 69399)),
+}
+
+CITIES = {
+    'SP': ['sao paulo', 'campinas', 'guarulhos', 'santo andre', 'osasco', 'sao jose dos campos',
+           'ribeirao preto', 'sorocaba', 'santos', 'sao bernardo do campo'],
+    'RJ': ['rio de janeiro', 'niteroi', 'sao goncalo', 'duque de caxias', 'nova iguacu', 'petropolis'],
+    'MG': ['belo horizonte', 'uberlandia', 'contagem', 'juiz de fora', 'betim', 'montes claros'],
+    'RS': ['porto alegre', 'caxias do sul', 'canoas', 'pelotas', 'santa maria'],
+    'PR': ['curitiba', 'londrina', 'maringa', 'ponta grossa', 'cascavel'],
+    'SC': ['florianopolis', 'joinville', 'blumenau', 'sao jose', 'itajai'],
+    'BA': ['salvador', 'feira de santana', 'vitoria da conquista', 'camacari'],
+    'DF': ['brasilia'],
+    'ES': ['vitoria', 'vila velha', 'serra', 'cariacica'],
+    'GO': ['goiania', 'anapolis', 'aparecida de goiania'],
+    'PE': ['recife', 'jaboatao dos guararapes', 'olinda', 'caruaru'],
+    'CE': ['fortaleza', 'caucaia', 'juazeiro do norte'],
+    'PA': ['belem', 'ananindeua', 'santarem'],
+    'MT': ['cuiaba', 'varzea grande', 'rondonopolis'],
+    'MA': ['sao luis', 'imperatriz'],
+    'MS': ['campo grande', 'dourados'],
+    'PB': ['joao pessoa', 'campina grande'],
+    'PI': ['teresina', 'parnaiba'],
+    'RN': ['natal', 'mossoro'],
+    'AL': ['maceio', 'arapiraca'],
+    'SE': ['aracaju'],
+    'TO': ['palmas', 'araguaina'],
+    'RO': ['porto velho', 'ji-parana'],
+    'AM': ['manaus'],
+    'AC': ['rio branco'],
+    'AP': ['macapa'],
+    'RR': ['boa vista'],
+}
+
+# Категория: (доля товаров, медианная цена R$); None — товар без категории, как в Olist
+CATEGORIES = {
+    'cama_mesa_banho': (0.100, 70), 'beleza_saude': (0.090, 90), 'esporte_lazer': (0.080, 80),
+    'moveis_decoracao': (0.075, 70), 'informatica_acessorios': (0.070, 80),
+    'utilidades_domesticas': (0.065, 60), 'relogios_presentes': (0.055, 140),
+    'telefonia': (0.040, 40), 'ferramentas_jardim': (0.040, 80), 'automotivo': (0.040, 70),
+    'brinquedos': (0.037, 75), 'cool_stuff': (0.035, 120), 'perfumaria': (0.031, 85),
+    'bebes': (0.027, 110), 'eletronicos': (0.025, 50), 'papelaria': (0.022, 60),
+    'fashion_bolsas_e_acessorios': (0.018, 60), 'pet_shop': (0.017, 70),
+    'moveis_escritorio': (0.015, 170), 'consoles_games': (0.010, 100),
+    'malas_acessorios': (0.010, 120), 'construcao_ferramentas_construcao': (0.008, 90),
+    'eletrodomesticos': (0.007, 80), 'instrumentos_musicais': (0.006, 140),
+    'eletroportateis': (0.006, 180), 'casa_construcao': (0.005, 90),
+    'livros_interesse_geral': (0.005, 40), 'alimentos': (0.004, 50), 'moveis_sala': (0.004, 140),
+    'casa_conforto': (0.004, 100), None: (0.015, 70), 'outros': (0.034, 80),
+}
+
+STATE_CODES = list(STATES)
+STATE_LAT = np.array([STATES[s][0] for s in STATE_CODES])
+STATE_LNG = np.array([STATES[s][1] for s in STATE_CODES])
+
+
+def _probs(weights):
+    weights = np.asarray(weights, dtype=np.float64)
+    return weights / weights.sum()
+
+
+def hex_ids(rng, n):
+    """n random 32-character hex ids (the Olist id format)."""
+    words = rng.integers(0, 2 ** 63, size=(n, 2), dtype=np.int64)
+    return np.array([f"{a:016x}{b:016x}" for a, b in words], dtype=object)
+
+
+def state_distance_km(a, b):
+    lat1, lng1, lat2, lng2 = map(np.radians, (STATE_LAT[a], STATE_LNG[a], STATE_LAT[b], STATE_LNG[b]))
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371.0 * np.arcsin(np.sqrt(h))
+
+
+def city_and_zip(rng, state_idx):
+    """City (Zipf-weighted within the state) and a zip prefix in that city's block of the state range."""
+    cities = np.empty(len(state_idx), dtype=object)
+    zips = np.empty(len(state_idx), dtype=np.int64)
+    for s in np.unique(state_idx):
+        rows = np.flatnonzero(state_idx == s)
+        names = CITIES[STATE_CODES[s]]
+        city = rng.choice(len(names), size=len(rows), p=_probs(1 / np.arange(1, len(names) + 1)))
+        low, high = STATES[STATE_CODES[s]][4]
+        block = (high - low + 1) // len(names)
+        cities[rows] = np.array(names, dtype=object)[city]
+        zips[rows] = low + city * block + rng.integers(0, block, size=len(rows))
+    return cities, zips
+
+
+def daily_weights():
+    """Relative order volume per day: ramp-up, weekday profile, Black Friday and year-end dip."""
+    days = pd.date_range(START_DATE, END_DATE - pd.Timedelta(days=1), freq='D')
+    t = np.arange(len(days)) / len(days)
+    trend = np.minimum(0.08 + 1.6 * t, 1.0)
+    weekday = np.array([1.12, 1.12, 1.08, 1.04, 0.98, 0.80, 0.86])[days.dayofweek]
+    season = np.ones(len(days))
+    season[(days.month == 12) & (days.day > 20)] = 0.75
+    for black_friday in ('2016-11-25', '2017-11-24'):
+        delta = (days - pd.Timestamp(black_friday)).days
+        season[(delta >= -3) & (delta <= 3)] *= 1.6
+        season[delta == 0] *= 3.0
+    return days, _probs(trend * weekday * season)
+
+
+HOURLY = _probs([3, 1.5, 0.7, 0.4, 0.3, 0.5, 1.5, 3, 5, 6.5, 7, 7, 6.5, 7, 7, 6.8, 6.8, 6.3, 6, 6.2, 6.5, 6.7, 6.3, 5])
+
+
+def purchase_times(rng, n, days, day_probs):
+    day = rng.choice(len(days), size=n, p=day_probs)
+    seconds = rng.choice(24, size=n, p=HOURLY) * 3600 + rng.integers(0, 3600, size=n)
+    return days.values[day] + seconds.astype('timedelta64[s]')
+
+
+def build_catalog(seed, scale):
+    """Products (with weight, price level and main seller) and sellers; shared by all chunks."""
+    rng = np.random.default_rng(np.random.SeedSequence([seed, 0]))
+    n_products = max(100, round(BASE_PRODUCTS * scale ** 0.5))
+    n_sellers = max(20, round(BASE_SELLERS * scale ** 0.5))
+
+    seller_state = rng.choice(len(STATE_CODES), size=n_sellers, p=_probs([s[3] for s in STATES.values()]))
+    seller_city, seller_zip = city_and_zip(rng, seller_state)
+    sellers = pd.DataFrame({
+        'seller_id': hex_ids(rng, n_sellers),
+        'seller_zip_code_prefix': seller_zip,
+        'seller_city': seller_city,
+        'seller_state': np.array(STATE_CODES, dtype=object)[seller_state],
+    })
+
+    names = list(CATEGORIES)
+    category = rng.choice(len(names), size=n_products, p=_probs([v[0] for v in CATEGORIES.values()]))
+    median_price = np.array([v[1] for v in CATEGORIES.values()], dtype=np.float64)[category]
+    weight = np.clip(rng.lognormal(np.log(700), 1.0, n_products), 50, 40000).round()
+    products = pd.DataFrame({
+        'product_id': hex_ids(rng, n_products),
+        'product_category_name': np.array(names, dtype=object)[category],
+        'product_name_lenght': rng.integers(10, 76, n_products),
+        'product_description_lenght': rng.integers(20, 3000, n_products),
+        'product_photos_qty': rng.integers(1, 7, n_products),
+        'product_weight_g': weight,
+        'product_length_cm': rng.integers(11, 105, n_products),
+        'product_height_cm': rng.integers(2, 105, n_products),
+        'product_width_cm': rng.integers(6, 118, n_products),
+    })
+
+    # Популярность товаров — по закону Ципфа, у каждого товара основной продавец
+    popularity = _probs(1 / np.arange(1, n_products + 1) ** 0.9)
+    catalog = {
+        'product_id': products['product_id'].to_numpy(),
+        'base_price': rng.lognormal(np.log(median_price), 0.6),
+        'weight_kg': weight / 1000,
+        'popularity_cdf': np.cumsum(rng.permutation(popularity)),
+        'seller_idx': rng.integers(0, n_sellers, n_products),
+        'seller_id': sellers['seller_id'].to_numpy(),
+        'seller_state': seller_state,
+    }
+    return products, sellers, catalog
+
+
+def orders_per_customer(rng, n_orders):
+    """Order count per unique customer summing to about n_orders (most buy once)."""
+    mean = 1 + REPEAT_SHARE * 1.6
+    counts = np.ones(int(n_orders / mean * 1.05) + 10, dtype=np.int64)
+    repeat = rng.random(len(counts)) < REPEAT_SHARE
+    counts[repeat] = 2 + rng.geometric(0.6, size=repeat.sum()) - 1
+    cutoff = np.searchsorted(np.cumsum(counts), n_orders)
+    return counts[:cutoff + 1]
+
+
+def _dirty(rng, n, rate, dirty):
+    return np.flatnonzero(rng.random(n) < rate * dirty)
+
+
+def generate_chunk(task):
+    """Orders, customers and items for one chunk; writes header-less CSV parts and returns row counts."""
+    seed, chunk, n_orders, catalog, parts_dir, dirty = task
+    rng = np.random.default_rng(np.random.SeedSequence([seed, chunk + 1]))
+    days, day_probs = daily_weights()
+
+    # Покупатели: каждому — штат, город, zip; у повторных несколько заказов с интервалами
+    counts = orders_per_customer(rng, n_orders)
+    n_unique = len(counts)
+    customer_state = rng.choice(len(STATE_CODES), size=n_unique, p=_probs([s[2] for s in STATES.values()]))
+    customer_city, customer_zip = city_and_zip(rng, customer_state)
+    unique_ids = hex_ids(rng, n_unique)
+
+    owner = np.repeat(np.arange(n_unique), counts)
+    first = purchase_times(rng, n_unique, days, day_probs)
+    nth = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts)
+    gaps = rng.exponential(REPEAT_GAP_DAYS, size=len(owner)) * (nth > 0) + (nth > 0)
+    gap_sum = pd.Series(gaps).groupby(owner).cumsum().to_numpy()
+    purchase = first[owner] + (gap_sum * 86400).astype('timedelta64[s]')
+    keep = purchase < np.datetime64(END_DATE)
+    owner, purchase = owner[keep], purchase[keep]
+    n = len(owner)
+
+    # В Olist customer_id выдаётся на каждый заказ, покупателя связывает customer_unique_id
+    customer_ids = hex_ids(rng, n)
+    order_ids = hex_ids(rng, n)
+    customers = pd.DataFrame({
+        'customer_id': customer_ids,
+        'customer_unique_id': unique_ids[owner],
+        'customer_zip_code_prefix': customer_zip[owner],
+        'customer_city': customer_city[owner],
+        'customer_state': np.array(STATE_CODES, dtype=object)[customer_state[owner]],
+    })
+
+    # Товары заказа: первый по популярности, следующие — иногда тот же товар
+    n_items = rng.choice(list(ITEMS_PER_ORDER), size=n, p=_probs(list(ITEMS_PER_ORDER.values())))
+    item_order = np.repeat(np.arange(n), n_items)
+    item_number = np.arange(len(item_order)) - np.repeat(np.cumsum(n_items) - n_items, n_items) + 1
+    product = np.searchsorted(catalog['popularity_cdf'], rng.random(len(item_order)) * catalog['popularity_cdf'][-1])
+    product = np.minimum(product, len(catalog['product_id']) - 1)
+    same_as_first = (item_number > 1) & (rng.random(len(item_order)) < 0.5)
+    first_item = np.repeat(np.cumsum(n_items) - n_items, n_items)
+    product[same_as_first] = product[first_item[same_as_first]]
+    seller = catalog['seller_idx'][product]
+
+    distance = state_distance_km(catalog['seller_state'][seller], customer_state[owner][item_order])
+    price = (catalog['base_price'][product] * rng.lognormal(0, 0.08, len(product))).round(2)
+    freight = (8 + 0.004 * distance + 1.2 * catalog['weight_kg'][product]) * rng.lognormal(0, 0.25, len(product))
+
+    # Сроки: одобрение -> передача перевозчику -> доставка (зависит от расстояния до самого дальнего продавца)
+    status = rng.choice(list(ORDER_STATUSES), size=n, p=_probs(list(ORDER_STATUSES.values())))
+    order_distance = pd.Series(distance).groupby(item_order).max().to_numpy()
+    approved = purchase + (rng.lognormal(np.log(10), 1.0, n) * 3600).astype('timedelta64[s]')
+    carrier = approved + (rng.gamma(2.0, 1.5, n) * 86400).astype('timedelta64[s]')
+    typical_transit = 5 + order_distance / 250
+    transit_days = rng.lognormal(np.log(typical_transit), 0.5)
+    transit_days += (rng.random(n) < 0.03) * rng.uniform(10, 40, n)
+    delivered = carrier + (transit_days * 86400).astype('timedelta64[s]')
+    # Обещанный срок с запасом: опаздывает примерно каждый 11-й заказ, как в Olist
+    expected_days = 6 + 1.7 * typical_transit + rng.integers(0, 8, n)
+    estimated = purchase.astype('datetime64[D]') + expected_days.astype('timedelta64[D]')
+
+    orders = pd.DataFrame({
+        'order_id': order_ids,
+        'customer_id': customer_ids,
+        'order_status': status.astype(object),
+        'order_purchase_timestamp': pd.to_datetime(purchase).strftime(TIMESTAMP_FORMAT),
+        'order_approved_at': pd.to_datetime(approved).strftime(TIMESTAMP_FORMAT),
+        'order_delivered_carrier_date': pd.to_datetime(carrier).strftime(TIMESTAMP_FORMAT),
+        'order_delivered_customer_date': pd.to_datetime(delivered).strftime(TIMESTAMP_FORMAT),
+        'order_estimated_delivery_date': pd.to_datetime(estimated).strftime(TIMESTAMP_FORMAT),
+    })
+    orders.loc[status == 'created', 'order_approved_at'] = None
+    orders.loc[(status == 'canceled') & (rng.random(n) < 0.5), 'order_approved_at'] = None
+    orders.loc[~np.isin(status, ['delivered', 'shipped']), 'order_delivered_carrier_date'] = None
+    orders.loc[status != 'delivered', 'order_delivered_customer_date'] = None
+
+    items = pd.DataFrame({
+        'order_id': order_ids[item_order],
+        'order_item_id': item_number,
+        'product_id': catalog['product_id'][product],
+        'seller_id': catalog['seller_id'][seller],
+        'shipping_limit_date': pd.to_datetime(approved[item_order] + np.timedelta64(6, 'D')).strftime(TIMESTAMP_FORMAT),
+        'price': price,
+        'freight_value': freight.round(2),
+    })
+
+    orders, customers, items = add_dirty_records(rng, orders, customers, items, dirty)
+
+    parts_dir = Path(parts_dir)
+    for name, df in (('orders', orders), ('customers', customers), ('order_items', items)):
+        df.to_csv(parts_dir / f"{name}.{chunk:05d}.csv", index=False, header=False)
+    return {'orders': len(orders), 'customers': len(customers), 'order_items': len(items)}
+
+
+def add_dirty_records(rng, orders, customers, items, dirty):
+    """Inject the defects handled by the ETL (see CLEANING_RULES.md)."""
+    if not dirty:
+        return orders, customers, items
+
+    rows = _dirty(rng, len(orders), DIRTY_RATES['status_noise'], dirty)
+    orders.loc[orders.index[rows], 'order_status'] = np.where(
+        rng.random(len(rows)) < 0.7, orders['order_status'].iloc[rows].str.upper(), None)
+    rows = _dirty(rng, len(orders), DIRTY_RATES['bad_date'], dirty)
+    orders.loc[orders.index[rows], 'order_approved_at'] = rng.choice(['0000-00-00 00:00:00', 'n/a', '31/02/2018'], len(rows))
+    rows = _dirty(rng, len(orders), DIRTY_RATES['orphan_order'], dirty)
+    orders.loc[orders.index[rows], 'customer_id'] = hex_ids(rng, len(rows))
+
+    rows = _dirty(rng, len(customers), DIRTY_RATES['city_variant'], dirty)
+    customers.loc[customers.index[rows], 'customer_city'] = customers['customer_city'].iloc[rows].str.upper() + ' '
+
+    rows = _dirty(rng, len(items), DIRTY_RATES['bad_price'], dirty)
+    items.loc[items.index[rows], 'price'] = -rng.choice([0, 1], len(rows)) * items['price'].iloc[rows]
+    rows = _dirty(rng, len(items), DIRTY_RATES['bad_freight'], dirty)
+    items.loc[items.index[rows], 'freight_value'] = rng.choice([-5.0, 1500.0], len(rows))
+
+    # Дубликаты строк — в конец части, как в дозагруженных выгрузках
+    orders = pd.concat([orders, orders.iloc[_dirty(rng, len(orders), DIRTY_RATES['duplicate_order'], dirty)]])
+    customers = pd.concat([customers, customers.iloc[_dirty(rng, len(customers), DIRTY_RATES['duplicate_customer'], dirty)]])
+    items = pd.concat([items, items.iloc[_dirty(rng, len(items), DIRTY_RATES['duplicate_item'], dirty)]])
+    return orders, customers, items
+
+
+def geolocation_points(seed, zips, points_per_zip=3):
+    """Olist-style geolocation rows around each zip prefix (for dim_geolocation)."""
+    rng = np.random.default_rng(np.random.SeedSequence([seed, 10 ** 6]))
+    zips = np.unique(zips)
+    state = np.zeros(len(zips), dtype=np.int64)
+    offset = np.zeros(len(zips))
+    for i, (_, _, _, _, (low, high)) in enumerate(STATES.values()):
+        in_range = (zips >= low) & (zips <= high)
+        state[in_range] = i
+        offset[in_range] = (zips[in_range] - low) / (high - low + 1)
+    # Zip-блоки штата раскладываются по дуге вокруг столицы (до ~2°)
+    angle = offset * 2 * np.pi * 3
+    lat = STATE_LAT[state] + 2 * offset * np.sin(angle)
+    lng = STATE_LNG[state] + 2 * offset * np.cos(angle)
+
+    rows = np.repeat(np.arange(len(zips)), points_per_zip)
+    return pd.DataFrame({
+        'geolocation_zip_code_prefix': zips[rows],
+        'geolocation_lat': (lat[rows] + rng.normal(0, 0.02, len(rows))).round(6),
+        'geolocation_lng': (lng[rows] + rng.normal(0, 0.02, len(rows))).round(6),
+        'geolocation_city': '',
+        'geolocation_state': np.array(STATE_CODES, dtype=object)[state[rows]],
+    })
+
+
+def _concat_parts(parts_dir, name, header, out_path):
+    with open(out_path, 'wb') as out:
+        out.write((",".join(header) + "\n").encode())
+        for part in sorted(Path(parts_dir).glob(f"{name}.*.csv")):
+            with open(part, 'rb') as f:
+                shutil.copyfileobj(f, out, length=1 << 20)
+
+
+ORDER_COLUMNS = ['order_id', 'customer_id', 'order_status', 'order_purchase_timestamp', 'order_approved_at',
+                 'order_delivered_carrier_date', 'order_delivered_customer_date', 'order_estimated_delivery_date']
+CUSTOMER_COLUMNS = ['customer_id', 'customer_unique_id', 'customer_zip_code_prefix', 'customer_city', 'customer_state']
+ITEM_COLUMNS = ['order_id', 'order_item_id', 'product_id', 'seller_id', 'shipping_limit_date', 'price', 'freight_value']
+
+
+def generate_dataset(out_dir, scale=1.0, seed=42, workers=None, dirty=1.0, geolocation=False):
+    """Write the Olist CSVs for one scale factor to out_dir; returns row counts per file."""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    parts_dir = out_dir / ".parts"
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    parts_dir.mkdir()
+
+    products, sellers, catalog = build_catalog(seed, scale)
+    total_orders = round(BASE_ORDERS * scale)
+    chunks = [min(CHUNK_ORDERS, total_orders - start) for start in range(0, total_orders, CHUNK_ORDERS)]
+    tasks = [(seed, i, size, catalog, str(parts_dir), dirty) for i, size in enumerate(chunks)]
+
+    workers = workers or min(len(tasks), os.cpu_count() or 1)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            counts = list(pool.map(generate_chunk, tasks))
+    else:
+        counts = [generate_chunk(task) for task in tasks]
+
+    _concat_parts(parts_dir, 'orders', ORDER_COLUMNS, out_dir / "olist_orders.csv")
+    _concat_parts(parts_dir, 'customers', CUSTOMER_COLUMNS, out_dir / "olist_customers.csv")
+    _concat_parts(parts_dir, 'order_items', ITEM_COLUMNS, out_dir / "olist_order_items.csv")
+    shutil.rmtree(parts_dir)
+
+    products.to_csv(out_dir / "olist_products.csv", index=False)
+    sellers.to_csv(out_dir / "olist_sellers.csv", index=False)
+
+    summary = {name: sum(c[name] for c in counts) for name in ('orders', 'customers', 'order_items')}
+    summary.update(products=len(products), sellers=len(sellers))
+    if geolocation:
+        zips = np.concatenate([
+            pd.read_csv(out_dir / "olist_customers.csv", usecols=['customer_zip_code_prefix'])['customer_zip_code_prefix'].to_numpy(),
+            sellers['seller_zip_code_prefix'].to_numpy(),
+        ])
+        geo = geolocation_points(seed, zips)
+        geo.to_csv(out_dir / "olist_geolocation.csv", index=False)
+        summary['geolocation'] = len(geo)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Olist dataset")
+    parser.add_argument('--scale', type=float, default=1.0, help="1 = size of the public Olist drop (~99k orders)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', type=Path, default=DATA_DIR)
+    parser.add_argument('--workers', type=int, help="worker processes (default: CPU count)")
+    parser.add_argument('--dirty', type=float, default=1.0, help="multiplier for dirty record rates (0 = clean)")
+    parser.add_argument('--geolocation', action='store_true', help="also write olist_geolocation.csv")
+    parser.add_argument('--force', action='store_true', help="overwrite existing Olist CSVs in --out")
+    args = parser.parse_args()
+
+    existing = [p.name for p in args.out.glob("olist_*.csv")] if args.out.exists() else []
+    if existing and not args.force:
+        print(f"{args.out} already has {', '.join(sorted(existing))}; use --force to overwrite.")
+        sys.exit(1)
+
+    started = time.perf_counter()
+    summary = generate_dataset(args.out, args.scale, args.seed, args.workers, args.dirty, args.geolocation)
+    print(f"Synthetic Olist x{args.scale:g} (seed {args.seed}) in {time.perf_counter() - started:.1f}s -> {args.out}")
+    for name, rows in summary.items():
+        print(f"   {name}: {rows:,}")
+
+
+if __name__ == "__main__":
+    main()
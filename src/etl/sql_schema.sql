@@ -18,6 +18,16 @@ CREATE TABLE IF NOT EXISTS dim_geography (
     state TEXT
 );
 
+CREATE TABLE IF NOT EXISTS dim_geolocation (
+    zip_code_prefix INT PRIMARY KEY,
+    lat REAL,
+    lng REAL,
+    points INT,
+    grid_cell INT
+);
+
+CREATE INDEX IF NOT EXISTS idx_dim_geolocation_cell ON dim_geolocation(grid_cell);
+
 CREATE TABLE IF NOT EXISTS dim_calendar (
     date DATE PRIMARY KEY,
     week INT,
@@ -35,9 +45,22 @@ CREATE TABLE IF NOT EXISTS fact_orders (
     price REAL,
     freight_value REAL,
     delivery_time_days INT,
+    hours_to_approval REAL,
+    hours_to_carrier REAL,
+    hours_to_customer REAL,
+    days_vs_estimate REAL,
+    is_delivered INT,
+    is_late INT,
+    is_late_vs_estimate INT,
+    order_total REAL,
+    items_total REAL,
+    freight_total REAL,
+    items_count INT,
     PRIMARY KEY(order_id, order_item_id)
 );
 
+CREATE INDEX IF NOT EXISTS idx_fact_orders_delivery ON fact_orders(is_delivered, is_late, delivery_time_days);
+
 CREATE TABLE IF NOT EXISTS fact_order_items (
     order_id TEXT,
     order_item_id INT,